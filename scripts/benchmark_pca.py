@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Phase 3: PCA Benchmark - Exact vs Randomized
+Times pca_smallN against pca_randomized on synthetic cohorts (a few smooth
+breathing modes plus noise) and reports accuracy of the top-K modes:
+relative singular-value error and the largest principal angle between the
+U subspaces.
+"""
+
+import contextlib
+import io
+import json
+import time
+from pathlib import Path
+
+import numpy as np
+
+from run_pca_dvf import pca_randomized, pca_smallN
+
+def synthetic_cohort(P, N, n_modes=5, noise=0.05, seed=0):
+    """(P, N) float32 samples with a decaying spectrum of n_modes plus noise."""
+    rng = np.random.default_rng(seed)
+    basis, _ = np.linalg.qr(rng.standard_normal((P, n_modes)))
+    amps = 10.0 / (1 + np.arange(n_modes))
+    coeffs = rng.standard_normal((n_modes, N)) * amps[:, None]
+    X = basis @ coeffs + noise * rng.standard_normal((P, N)) + rng.standard_normal((P, 1))
+    return X.astype(np.float32)
+
+def subspace_angle_deg(U1, U2):
+    """Largest principal angle between span(U1) and span(U2), in degrees."""
+    Q1, _ = np.linalg.qr(U1.astype(np.float64))
+    Q2, _ = np.linalg.qr(U2.astype(np.float64))
+    cos = np.linalg.svd(Q1.T @ Q2, compute_uv=False)
+    return float(np.degrees(np.arccos(np.clip(cos.min(), -1.0, 1.0))))
+
+def _timed(fn, *args, **kwargs):
+    with contextlib.redirect_stdout(io.StringIO()):   # silence per-mode prints
+        t0 = time.perf_counter()
+        out = fn(*args, **kwargs)
+        return out, time.perf_counter() - t0
+
+def benchmark(P, N, K, n_power_iter=4):
+    """
+    One exact vs randomized comparison.
+
+    Returns:
+        dict with timings, speedup, max relative S error and subspace angle
+    """
+    X = synthetic_cohort(P, N)
+    (_, U_e, S_e, _), t_exact = _timed(pca_smallN, X, n_components=K)
+    (_, U_r, S_r, _), t_rand = _timed(pca_randomized, X, K, n_power_iter=n_power_iter)
+    return {
+        'P': P, 'N': N, 'K': K,
+        'exact_s': t_exact,
+        'randomized_s': t_rand,
+        'speedup': t_exact / t_rand,
+        'max_rel_S_error': float(np.max(np.abs(S_r - S_e[:K]) / S_e[:K])),
+        'subspace_angle_deg': subspace_angle_deg(U_e[:, :K], U_r)
+    }
+
+def main():
+    print("="*70)
+    print("Phase 3: PCA Benchmark (exact vs randomized)")
+    print("="*70)
+
+    out_dir = Path("results/pca")
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    cases = [(200_000, 50, 5), (200_000, 200, 5), (200_000, 500, 5), (100_000, 1000, 5)]
+    results = []
+    print(f"\n{'P':>8s} {'N':>6s} {'K':>3s} {'exact s':>9s} {'rand s':>8s} {'speedup':>8s} "
+          f"{'S err':>9s} {'angle':>8s}")
+    for P, N, K in cases:
+        r = benchmark(P, N, K)
+        results.append(r)
+        print(f"{P:8d} {N:6d} {K:3d} {r['exact_s']:9.2f} {r['randomized_s']:8.2f} "
+              f"{r['speedup']:7.1f}x {r['max_rel_S_error']:9.2e} {r['subspace_angle_deg']:7.3f}d")
+
+    with open(out_dir/"benchmark_pca.json", 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"\n[OK] Saved: {out_dir/'benchmark_pca.json'}")
+    print("="*70)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+"""
+Phase 3 QC: Beta-Space Safety Map
+Maps where the PCA motion model passes the Jacobian safety gate
+(neg% < 0.5, p01 > 0.80, p99 < 1.25) over a (beta1, beta2[, beta3]) grid.
+
+The grid starts coarse and is refined only in cells whose corners disagree
+(pass/fail boundary), halving the step at every level. Points are evaluated
+on a process pool; the gradient engine (jacobian.pca_jacobian_engine) is
+placed once in shared memory and every worker maps it without copying.
+
+The saved map (safety_map.npz) comes with a KD-tree lookup, is_safe(), that
+samplers use to reject unsafe states before synthesis or warping. The map
+only covers the first d modes with the others at zero, so betas with a
+non-zero mode beyond d are rejected, and the map records the mode count of
+the model it was built from (model_K) so consumers can refuse a mismatch.
+"""
+
+import json
+from itertools import product
+from multiprocessing import shared_memory
+from pathlib import Path
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from jacobian import pca_jacobian_engine, pca_jacobian_stats
+from parallel import available_cores, make_process_pool
+from pca_model import load_pca_model
+
+DEFAULT_MAP = Path("results/pca/safety_map.npz")
+
+_WORKER = {}
+
+def _attach_engine(specs):
+    """Worker initializer: map the shared engine arrays."""
+    engine = {}
+    for key, (name, shape) in specs.items():
+        shm = shared_memory.SharedMemory(name=name)
+        _WORKER.setdefault('shm', []).append(shm)
+        engine[key] = np.ndarray(shape, dtype=np.float32, buffer=shm.buf)
+    engine['K'] = engine['GU'].shape[0]
+    engine['n_mask'] = engine['G0'].shape[0]
+    _WORKER['engine'] = engine
+
+def _eval_points(points):
+    """Worker: gate statistics for (m, d) beta points."""
+    return _gate_rows(pca_jacobian_stats(_WORKER['engine'], np.asarray(points).T))
+
+def _gate_rows(stats):
+    """(m, 4) rows of passed, neg_percent, p01, p99."""
+    return np.array([[st['passed'], st['neg_percent'], st['p01'], st['p99']] for st in stats],
+                    dtype=np.float64).reshape(-1, 4)
+
+def _share_engine(engine):
+    """Copy engine arrays into shared memory; returns (blocks, specs)."""
+    blocks, specs = [], {}
+    for key in ('G0', 'GU'):
+        a = np.ascontiguousarray(engine[key], dtype=np.float32)
+        shm = shared_memory.SharedMemory(create=True, size=max(1, a.nbytes))
+        np.ndarray(a.shape, dtype=np.float32, buffer=shm.buf)[...] = a
+        blocks.append(shm)
+        specs[key] = (shm.name, a.shape)
+    return blocks, specs
+
+def _cell_corners(lo, size, d):
+    return [tuple(lo[i] + size * o[i] for i in range(d)) for o in product((0, 1), repeat=d)]
+
+def build_safety_map(engine, d=2, radius_sd=3.0, step_sd=0.5, levels=3,
+                     n_workers=None, batch=16, model_K=None):
+    """
+    Adaptive pass/fail map over the first d modes.
+
+    Points live on an integer lattice with spacing step_sd / 2**levels;
+    level-0 cells have 2**levels lattice units per side and each refinement
+    halves the cells that straddle the boundary.
+
+    Args:
+        engine: jacobian.pca_jacobian_engine output (K >= d)
+        radius_sd: map covers [-radius_sd, radius_sd]^d
+        step_sd: coarse grid step
+        levels: refinement levels
+        n_workers: worker processes (1 = in-process)
+        batch: points per task
+        model_K: modes of the PCA model the engine came from (default: engine K)
+
+    Returns:
+        map dict: betas (n, d), passed (n,) bool, neg_percent, p01, p99,
+        unit_sd, radius_sd, levels, d, model_K
+    """
+    if engine['K'] < d:
+        raise ValueError(f"Engine has {engine['K']} modes, map needs {d}")
+    n_workers = n_workers or available_cores()
+    unit = step_sd / 2**levels
+    n0 = int(round(radius_sd / step_sd))
+    size0 = 2**levels
+    results = {}
+    sub_engine = dict(engine, GU=engine['GU'][:d], K=d)
+
+    if n_workers > 1:
+        blocks, specs = _share_engine(sub_engine)
+        pool = make_process_pool(n_workers, threads_per_worker=1,
+                                 initializer=_attach_engine, initargs=(specs,))
+    else:
+        blocks, pool = [], None
+
+    def evaluate(points):
+        points = [p for p in dict.fromkeys(points) if p not in results]
+        if not points:
+            return
+        betas = np.array(points, dtype=np.float64) * unit
+        if pool is None:
+            rows = _gate_rows(pca_jacobian_stats(sub_engine, betas.T))
+        else:
+            futures = [pool.submit(_eval_points, betas[i:i + batch]) for i in range(0, len(betas), batch)]
+            rows = np.concatenate([f.result() for f in futures])
+        for p, r in zip(points, rows):
+            results[p] = r
+
+    try:
+        axis = range(-n0 * size0, n0 * size0 + 1, size0)
+        evaluate(list(product(axis, repeat=d)))
+        cells = [lo for lo in product(range(-n0 * size0, n0 * size0, size0), repeat=d)]
+        size = size0
+        print(f"   Level 0: {len(results)} points")
+
+        for level in range(1, levels + 1):
+            mixed = [lo for lo in cells
+                     if len({bool(results[c][0]) for c in _cell_corners(lo, size, d)}) > 1]
+            size //= 2
+            cells = [tuple(lo[i] + size * o[i] for i in range(d))
+                     for lo in mixed for o in product((0, 1), repeat=d)]
+            before = len(results)
+            evaluate([c for lo in cells for c in _cell_corners(lo, size, d)])
+            print(f"   Level {level}: {len(mixed)} boundary cells, +{len(results) - before} points")
+    finally:
+        if pool is not None:
+            pool.shutdown()
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+
+    keys = np.array(list(results.keys()), dtype=np.int64).reshape(-1, d)
+    rows = np.array(list(results.values()))
+    return {
+        'betas': keys * unit,
+        'passed': rows[:, 0].astype(bool),
+        'neg_percent': rows[:, 1],
+        'p01': rows[:, 2],
+        'p99': rows[:, 3],
+        'unit_sd': unit,
+        'radius_sd': radius_sd,
+        'levels': levels,
+        'd': d,
+        'model_K': int(model_K if model_K is not None else engine['K'])
+    }
+
+def save_safety_map(smap, path=DEFAULT_MAP):
+    """Write the map as .npz plus a JSON summary next to it."""
+    path = Path(path)
+    np.savez(path, **{k: np.asarray(v) for k, v in smap.items()})
+    summary = {
+        'n_points': int(smap['passed'].size),
+        'pass_fraction_of_points': float(smap['passed'].mean()),
+        'd': int(smap['d']),
+        'model_K': int(smap['model_K']),
+        'radius_sd': float(smap['radius_sd']),
+        'finest_step_sd': float(smap['unit_sd']),
+        'gate': "neg% < 0.5, p01 > 0.80, p99 < 1.25"
+    }
+    with open(path.with_suffix(".json"), 'w') as f:
+        json.dump(summary, f, indent=2)
+
+def load_safety_map(path=DEFAULT_MAP):
+    """Load a saved map and build its KD-tree lookup."""
+    data = np.load(path)
+    smap = {k: data[k] for k in data.files}
+    for k in ('unit_sd', 'radius_sd', 'levels', 'd'):
+        smap[k] = smap[k].item()
+    # Maps saved before model_K was recorded: unknown
+    smap['model_K'] = smap['model_K'].item() if 'model_K' in smap else None
+    smap['tree'] = cKDTree(smap['betas'])
+    return smap
+
+def check_map_model(smap, K):
+    """Raise ValueError if the map was built for a model with other than K modes."""
+    if smap.get('model_K') is not None and smap['model_K'] != K:
+        raise ValueError(f"Safety map was built for a {smap['model_K']}-mode model, "
+                         f"this model has {K} modes; rebuild the map")
+
+def is_safe(smap, betas, k=1):
+    """
+    Lookup: True where the nearest mapped point(s) pass the gate.
+
+    Args:
+        betas: (N, K) or (K,) betas in SD units; missing modes are zero.
+               Modes beyond the map's d were not sampled (they were zero
+               when the map was built), so any non-zero one is unsafe.
+        k: require all k nearest map points to pass (conservative for k > 1)
+
+    Returns:
+        (N,) bool (scalar bool for a single beta); outside the mapped box is unsafe
+    """
+    b = np.atleast_2d(np.asarray(betas, dtype=np.float64))
+    d = smap['d']
+    q = np.zeros((b.shape[0], d))
+    q[:, :min(d, b.shape[1])] = b[:, :d]
+    _, nn = smap['tree'].query(q, k=k)
+    ok = smap['passed'][nn.reshape(b.shape[0], -1)].all(axis=1)
+    ok &= np.all(np.abs(q) <= smap['radius_sd'] + 1e-9, axis=1)
+    ok &= np.all(np.abs(b[:, d:]) <= 1e-9, axis=1)
+    return bool(ok[0]) if np.ndim(betas) == 1 else ok
+
+def main():
+    print("="*70)
+    print("Phase 3 QC: Beta-Space Safety Map")
+    print("="*70)
+
+    print("\n1. Loading PCA model and gradient engine...")
+    model = load_pca_model()
+    engine = pca_jacobian_engine(model, n_components=2)
+    print(f"   Modes: {engine['K']}, mask voxels: {engine['n_mask']}")
+
+    print("\n2. Adaptive grid over (beta1, beta2) in [-3, 3] SD...")
+    smap = build_safety_map(engine, d=2, radius_sd=3.0, step_sd=0.5, levels=3,
+                            model_K=model['U'].shape[1])
+    save_safety_map(smap)
+
+    print("\n3. Summary:")
+    print(f"   Points evaluated: {smap['passed'].size} "
+          f"(uniform grid at finest step: {(2 * int(3.0 / smap['unit_sd']) + 1) ** 2})")
+    print(f"   Passing points:   {int(smap['passed'].sum())}")
+    origin_ok = is_safe(load_safety_map(), [0.0, 0.0])
+    print(f"   Mean state (beta = 0): {'[PASS]' if origin_ok else '[FAIL]'}")
+
+    print("\n" + "="*70)
+    print(f"Safety map saved to: {DEFAULT_MAP}")
+    print("="*70)
+
+if __name__ == "__main__":
+    main()
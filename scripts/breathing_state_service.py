@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+"""
+Phase 3: On-Demand Breathing-State Service
+Long-lived local HTTP service that loads the PCA model (pca_model.bin) and the
+phase50 CT once and synthesizes breathing states from beta vectors.
+
+    GET  /info   -> JSON model summary and cache statistics
+    POST /state  -> body {"beta": [b1, b2, ...], "warp": false}
+                    returns an .npz with dvf (X,Y,Z,3), optional hu (X,Y,Z)
+                    warped phase50 HU, and grid origin/spacing/direction
+
+Betas are in SD units and rounded to BETA_DECIMALS; the rounded vector is both
+the synthesized state and the key of a byte-bounded LRU cache, so repeated
+requests from CBCT simulation are served without recomputation. If a safety
+map (beta_safety_map.py) is present, betas in its failing region, or with a
+non-zero mode the map does not cover, are rejected with 400 before anything
+is synthesized. A map built for a model with a different mode count is
+refused at startup.
+
+Client side: request_state(beta, warp=True) returns the arrays as a dict.
+"""
+
+import io
+import json
+import threading
+import time
+import urllib.request
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import ants
+import numpy as np
+
+from beta_safety_map import DEFAULT_MAP, check_map_model, is_safe, load_safety_map
+from dvf_ops import make_field
+from pca_model import DEFAULT_MASK, DEFAULT_PCA_DIR, load_pca_model, synthesize_field
+from warp_plan import apply_warp_plan, build_warp_plan
+
+HOST = "127.0.0.1"
+PORT = 8765
+CACHE_BYTES = 2 << 30       # 2 GiB of cached states
+BETA_DECIMALS = 3
+DEFAULT_HU = Path("data/preprocessed/popi_ants/phase50.nii.gz")
+
+class StateCache:
+    """Thread-safe LRU cache of state dicts (name -> ndarray) bounded in bytes."""
+
+    def __init__(self, max_bytes=CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, entry):
+        size = sum(a.nbytes for a in entry.values())
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.nbytes -= sum(a.nbytes for a in old.values())
+            if size > self.max_bytes:
+                return
+            self._entries[key] = entry
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.nbytes -= sum(a.nbytes for a in evicted.values())
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self.nbytes,
+                    'max_bytes': self.max_bytes, 'hits': self.hits, 'misses': self.misses}
+
+def state_key(beta, decimals=BETA_DECIMALS):
+    """Rounded beta tuple without trailing zero modes ([1, 0] == [1])."""
+    b = [round(float(v), decimals) + 0.0 for v in np.atleast_1d(beta)]
+    while b and b[-1] == 0.0:
+        b.pop()
+    return tuple(b)
+
+def load_service(pca_dir=DEFAULT_PCA_DIR, mask_path=DEFAULT_MASK, hu_path=DEFAULT_HU,
+                 cache_bytes=CACHE_BYTES, decimals=BETA_DECIMALS, safety_map_path=DEFAULT_MAP):
+    """
+    Load everything the service keeps resident.
+
+    Returns:
+        service dict: model, hu (ANTs image or None), cache, decimals,
+        safety_map (or None)
+    """
+    model = load_pca_model(pca_dir, mask_path)
+    hu = ants.image_read(str(hu_path)) if hu_path is not None and Path(hu_path).exists() else None
+    smap = (load_safety_map(safety_map_path)
+            if safety_map_path is not None and Path(safety_map_path).exists() else None)
+    if smap is not None:
+        check_map_model(smap, model['U'].shape[1])
+    return {'model': model, 'hu': hu, 'cache': StateCache(cache_bytes), 'decimals': decimals,
+            'safety_map': smap}
+
+def breathing_state(service, beta, warp=False):
+    """
+    Synthesized DVF (and warped HU) for a beta vector, served from the cache
+    when the rounded beta was seen before.
+
+    Returns:
+        dict name -> ndarray (dvf, optional hu, beta, origin, spacing, direction)
+    """
+    model = service['model']
+    key = state_key(beta, service['decimals'])
+    if len(key) > model['U'].shape[1]:
+        raise ValueError(f"beta has {len(key)} modes, model has {model['U'].shape[1]}")
+    if warp and service['hu'] is None:
+        raise ValueError("No HU volume loaded; warp not available")
+    smap = service.get('safety_map')
+    if smap is not None and not is_safe(smap, np.array(key, dtype=np.float64)):
+        raise ValueError(f"beta {list(key)} is outside the Jacobian safety map "
+                         f"(modes 1-{smap['d']} mapped, later modes must be 0)")
+
+    entry = service['cache'].get(key)
+    if entry is not None and (not warp or 'hu' in entry):
+        return entry
+
+    field = synthesize_field(model, key) if entry is None else None
+    if entry is None:
+        geom = field['geom']
+        entry = {
+            'dvf': field['array'],
+            'beta': np.array(key, dtype=np.float32),
+            'origin': geom['origin'], 'spacing': geom['spacing'], 'direction': geom['direction']
+        }
+    if warp:
+        if field is None:
+            field = make_field(entry['dvf'], model['geom'])
+        plan = build_warp_plan(field, service['hu'])
+        entry = dict(entry, hu=apply_warp_plan(plan, [service['hu']])[0])
+    service['cache'].put(key, entry)
+    return entry
+
+def encode_state(entry):
+    """State dict -> uncompressed .npz bytes."""
+    buf = io.BytesIO()
+    np.savez(buf, **entry)
+    return buf.getvalue()
+
+class _Handler(BaseHTTPRequestHandler):
+    def _send(self, code, body, content_type):
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, code, obj):
+        self._send(code, json.dumps(obj).encode(), "application/json")
+
+    def do_GET(self):
+        if self.path != "/info":
+            return self._send_json(404, {'error': f"unknown path {self.path}"})
+        service = self.server.service
+        model = service['model']
+        self._send_json(200, {
+            'n_components': int(model['U'].shape[1]),
+            'n_samples': model['n_samples'],
+            'scale': model['scale'].tolist(),
+            'variance_explained': model['var_ratio'].tolist(),
+            'vol_shape': list(model['vol_shape']),
+            'hu_loaded': service['hu'] is not None,
+            'safety_map': service.get('safety_map') is not None,
+            'beta_decimals': service['decimals'],
+            'cache': service['cache'].stats()
+        })
+
+    def do_POST(self):
+        if self.path != "/state":
+            return self._send_json(404, {'error': f"unknown path {self.path}"})
+        try:
+            req = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            entry = breathing_state(self.server.service, req['beta'], warp=bool(req.get('warp', False)))
+        except (KeyError, ValueError, TypeError) as e:
+            return self._send_json(400, {'error': str(e)})
+        self._send(200, encode_state(entry), "application/octet-stream")
+
+    def log_message(self, fmt, *args):
+        pass
+
+def make_server(service, host=HOST, port=PORT):
+    """Threaded HTTP server bound to the loaded service."""
+    server = ThreadingHTTPServer((host, port), _Handler)
+    server.daemon_threads = True
+    server.service = service
+    return server
+
+def request_state(beta, warp=False, url=f"http://{HOST}:{PORT}", timeout=300):
+    """
+    Client helper: fetch one breathing state from a running service.
+
+    Returns:
+        dict name -> ndarray (dvf (X,Y,Z,3), optional hu, grid geometry)
+    """
+    body = json.dumps({'beta': [float(b) for b in np.atleast_1d(beta)], 'warp': warp}).encode()
+    req = urllib.request.Request(f"{url}/state", data=body,
+                                 headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(req, timeout=timeout) as resp:
+        data = np.load(io.BytesIO(resp.read()))
+        return {k: data[k] for k in data.files}
+
+def main():
+    print("="*70)
+    print("Phase 3: Breathing-State Service")
+    print("="*70)
+
+    t0 = time.time()
+    print("\n1. Loading PCA model and phase50 CT...")
+    service = load_service()
+    model = service['model']
+    print(f"   Modes: {model['U'].shape[1]}, mask voxels: {model['idx'].size}, "
+          f"grid: {model['vol_shape']}")
+    print(f"   Per-mode SD: {model['scale'].tolist()}")
+    print(f"   HU volume: {'loaded' if service['hu'] is not None else 'not found (warp disabled)'}")
+    smap = service['safety_map']
+    if smap is None:
+        print("   Safety map: not found (no beta check)")
+    else:
+        print(f"   Safety map: loaded, modes 1-{smap['d']} of {model['U'].shape[1]} "
+              f"(betas with later non-zero modes are rejected)")
+    print(f"   Cache budget: {CACHE_BYTES / 2**30:.1f} GiB, beta rounding: {BETA_DECIMALS} decimals")
+    print(f"   Ready in {time.time() - t0:.1f} s")
+
+    server = make_server(service)
+    print(f"\n2. Serving on http://{HOST}:{PORT} (GET /info, POST /state) - Ctrl+C to stop")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    print(f"\nCache: {service['cache'].stats()}")
+
+if __name__ == "__main__":
+    main()
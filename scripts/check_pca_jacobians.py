@@ -2,83 +2,67 @@
 """
 Phase 3 QC: Jacobian safety check for synthesized DVFs
 """
-import ants
 import numpy as np
 import json
 from pathlib import Path
-import SimpleITK as sitk
+
+from dvf_ops import load_field
+from jacobian import jacobian_determinant, jacobian_stats, pca_jacobian_engine, pca_jacobian_stats
+from mask_cache import resampled_mask
+from pca_model import load_pca_model
 
 def jacobian_qc(warp_path, ref_iso_path, mask_path):
     """Compute Jacobian determinant QC metrics for a DVF"""
-    # Load reference and mask
-    ref = ants.image_read(str(ref_iso_path))
-    mask = ants.image_read(str(mask_path)).clone('unsigned char')
-    mask = ants.apply_transforms(
-        fixed=ref,
-        moving=mask,
-        transformlist=[],
-        interpolator='nearestNeighbor'
-    ).clone('unsigned char')
-    
-    # Compute Jacobian using SimpleITK (more reliable)
-    dvf_sitk = sitk.ReadImage(str(warp_path))
-    jac = sitk.DisplacementFieldJacobianDeterminant(dvf_sitk)
+    # Mask on the reference grid (cached across DVFs on the same grid)
+    m = resampled_mask(mask_path, ref_iso_path, rule='nearest')
     
-    # Extract masked values
-    jac_arr = sitk.GetArrayFromImage(jac).flatten()
-    mask_arr = mask.numpy().flatten() > 0
-    vals = jac_arr[mask_arr].astype(np.float32)
+    # Native det(I + grad u), only inside the mask
+    field = load_field(warp_path)
+    jac = jacobian_determinant(field['array'], field['geom']['spacing'], field['geom']['direction'], mask=m)
+    vals = jac[m]
     
-    # Compute stats
-    neg = float((vals < 0).mean() * 100.0)
-    
-    return {
-        'p01': float(np.percentile(vals, 1)),
-        'p50': float(np.median(vals)),
-        'p99': float(np.percentile(vals, 99)),
-        'neg_percent': neg,
-        'min': float(vals.min()),
-        'max': float(vals.max())
-    }
+    return jacobian_stats(vals)
 
 def main():
     print("="*70)
     print("Phase 3 QC: Jacobian Safety Check")
     print("="*70)
     
-    ref_iso = "results/synthetic/phase50_iso_like_dvf.nii.gz"
     mask50 = "data/preprocessed/popi_ants/phase50_lung_mask.nii.gz"
     pca_dir = Path("results/pca")
     
+    # Gradients of mu and the PCs once; each beta is then a contraction
+    print("\nPrecomputing PCA gradient engine...")
+    model = load_pca_model(pca_dir, mask50)
+    engine = pca_jacobian_engine(model, n_components=2)
+    print(f"  Modes: {engine['K']}, mask voxels: {engine['n_mask']}")
+    
     # Check all synthesized DVFs
     print("\nChecking synthesized DVFs at ±1 SD and ±2 SD...")
     print("-"*70)
     
-    results = {}
-    sd_files = sorted(pca_dir.glob("pc*_*sd.nii.gz"))
+    specs = [(k, s) for k in range(engine['K']) for s in [-2.0, -1.0, 1.0, 2.0]]
+    betas = np.zeros((engine['K'], len(specs)))
+    for j, (k, s) in enumerate(specs):
+        betas[k, j] = s
+    
+    names = [f"pc{k+1}_{'m' if s<0 else 'p'}{int(abs(s))}sd.nii.gz" for k, s in specs]
     
-    for dvf_path in sd_files:
-        print(f"\n{dvf_path.name}:")
-        try:
-            qc = jacobian_qc(dvf_path, ref_iso, mask50)
-            results[dvf_path.name] = qc
-            
-            # Print results
-            print(f"  Jacobian P01: {qc['p01']:.3f}")
-            print(f"  Jacobian P50: {qc['p50']:.3f}")
-            print(f"  Jacobian P99: {qc['p99']:.3f}")
-            print(f"  Negative %:   {qc['neg_percent']:.2f}%")
-            print(f"  Range: [{qc['min']:.3f}, {qc['max']:.3f}]")
-            
-            # Check safety
-            passed = (qc['neg_percent'] < 0.5 and 
-                     qc['p01'] > 0.80 and 
-                     qc['p99'] < 1.25)
-            print(f"  Safety: {'[PASS]' if passed else '[FAIL]'}")
-            
-        except Exception as e:
-            print(f"  ERROR: {e}")
-            results[dvf_path.name] = {"error": str(e)}
+    results = {}
+    for name, qc in sorted(zip(names, pca_jacobian_stats(engine, betas)), key=lambda t: t[0]):
+        passed = qc.pop('passed')
+        results[name] = qc
+        print(f"\n{name}:")
+        
+        # Print results
+        print(f"  Jacobian P01: {qc['p01']:.3f}")
+        print(f"  Jacobian P50: {qc['p50']:.3f}")
+        print(f"  Jacobian P99: {qc['p99']:.3f}")
+        print(f"  Negative %:   {qc['neg_percent']:.2f}%")
+        print(f"  Range: [{qc['min']:.3f}, {qc['max']:.3f}]")
+        
+        # Check safety
+        print(f"  Safety: {'[PASS]' if passed else '[FAIL]'}")
     
     # Save results
     out_json = pca_dir / "jacobian_qc.json"
@@ -2,67 +2,98 @@
 import sys
 sys.path.insert(0, 'scripts')
 from compute_phase70_qc import load_popi_landmarks, compute_tre_ants
+from dvf_ops import load_field, invert_dvf_file, inverse_consistency_field
+from mask_cache import resampled_mask
+from quantile_sketch import QuantileSketch
 from pathlib import Path
 import ants
-import SimpleITK as sitk
 import numpy as np
 import json
 
+def resample_mask_to_field(mask_path, field):
+    """Resample a mask to a DVF grid (linear + 0.5 threshold, cached). Returns (X,Y,Z) bool."""
+    return resampled_mask(mask_path, field, rule='linear')
+
 def inverse_consistency_mm(dvf_f_path, dvf_b_path, mask_path):
     """Compute inverse consistency: ||u_forward + u_backward(x + u_forward)|| in mm"""
     print(f"  Loading forward DVF: {dvf_f_path}")
-    u_f = ants.image_read(str(dvf_f_path))     # A→B
+    u_f = load_field(dvf_f_path)     # A→B
     
     print(f"  Loading backward DVF: {dvf_b_path}")
-    u_b = ants.image_read(str(dvf_b_path))     # B→A
+    u_b = load_field(dvf_b_path)     # B→A
     
     print(f"  Loading mask: {mask_path}")
-    mask = ants.image_read(str(mask_path)).clone('unsigned char')
-    
-    print("  Warping backward DVF using forward DVF...")
-    b_in_f = ants.apply_transforms(
-        fixed=u_f, 
-        moving=u_b,
-        transformlist=[u_f], 
-        interpolator='linear', 
-        imagetype=3
-    )
-    
-    print("  Computing composition magnitude...")
-    comp = b_in_f + u_f
-    mag = np.linalg.norm(comp.numpy(), axis=-1)
-    m = mask.numpy() > 0
+    m = resample_mask_to_field(mask_path, u_f)
+    
+    print("  Sampling backward DVF at forward-warped points...")
+    mag = inverse_consistency_field(u_f, u_b)
+    
+    sk = QuantileSketch.for_metric('ic').add(mag[m])
     
     return {
-        'median_mm': float(np.median(mag[m])), 
-        'p95_mm': float(np.percentile(mag[m], 95)),
-        'mean_mm': float(np.mean(mag[m]))
+        'median_mm': float(sk.percentile(50)), 
+        'p95_mm': float(sk.percentile(95)),
+        'mean_mm': float(sk.mean)
     }
 
+def backward_dvf_path(dvf_fwd_path):
+    """dvf_70_to_50_FINAL.nii.gz -> dvf_50_to_70_FINAL.nii.gz"""
+    dvf_fwd_path = Path(dvf_fwd_path)
+    parts = dvf_fwd_path.name.split('_')  # ['dvf', '70', 'to', '50', ...]
+    parts[1], parts[3] = parts[3], parts[1]
+    return dvf_fwd_path.with_name('_'.join(parts))
+
+def backward_is_current(dvf_fwd_path, dvf_bwd_path):
+    """True if the backward DVF exists and is not older than the forward DVF."""
+    dvf_bwd_path = Path(dvf_bwd_path)
+    return dvf_bwd_path.exists() and \
+        dvf_bwd_path.stat().st_mtime_ns >= Path(dvf_fwd_path).stat().st_mtime_ns
+
+def backward_qc(dvf_fwd_path, mask_path):
+    """
+    Generate the backward field by fixed-point inversion (if missing or older
+    than the forward DVF) and compute inverse consistency for the pair.
+    """
+    dvf_bwd_path = backward_dvf_path(dvf_fwd_path)
+    residual_path = Path(str(dvf_bwd_path).replace('.nii.gz', '_residual.nii.gz'))
+    
+    if backward_is_current(dvf_fwd_path, dvf_bwd_path):
+        source = 'existing'
+        print(f"  Backward DVF: existing {dvf_bwd_path.name} (newer than forward)")
+    else:
+        source = 'inverted'
+        reason = "older than forward DVF" if dvf_bwd_path.exists() else "missing"
+        print(f"  Backward DVF: {reason}, inverting forward DVF -> {dvf_bwd_path.name}")
+        invert_dvf_file(dvf_fwd_path, dvf_bwd_path, residual_path)
+    
+    ic = inverse_consistency_mm(dvf_fwd_path, dvf_bwd_path, mask_path)
+    ic['backward_dvf'] = str(dvf_bwd_path)
+    ic['backward_source'] = source
+    print(f"  IC Median: {ic['median_mm']:.3f} mm")
+    print(f"  IC P95:    {ic['p95_mm']:.3f} mm")
+    return ic
+
 def dvf_magnitude_qc(dvf_path, mask_path):
     """Compute DVF magnitude statistics in mm"""
     print(f"  Loading DVF: {dvf_path}")
     u = ants.image_read(str(dvf_path))
     
     print(f"  Loading mask: {mask_path}")
-    mask_orig = ants.image_read(str(mask_path)).clone('unsigned char')
-    
-    # Resample mask to DVF space using first component as scalar reference
-    print(f"  Resampling mask to DVF space...")
-    u_scalar = u.split_channels()[0]  # Use first component as scalar reference
-    mask = ants.resample_image_to_target(mask_orig, u_scalar, interp_type=1)
-    mask = (mask > 0.5).astype('uint8')  # Threshold after interpolation
+    # Resampled to the DVF grid (linear + 0.5 threshold), cached per grid
+    m = resampled_mask(mask_path, u, rule='linear')
     
     print("  Computing magnitude...")
     mag = np.linalg.norm(u.numpy(), axis=-1)
-    m = mask.numpy() > 0
+    
+    sk = QuantileSketch.for_metric('magnitude').add(mag[m])
+    p50, p75, p95 = sk.percentile([50, 75, 95])
     
     return {
-        'median_mm': float(np.median(mag[m])), 
-        'p75_mm': float(np.percentile(mag[m], 75)),
-        'p95_mm': float(np.percentile(mag[m], 95)),
-        'mean_mm': float(np.mean(mag[m])),
-        'max_mm': float(np.max(mag[m]))
+        'median_mm': float(p50), 
+        'p75_mm': float(p75),
+        'p95_mm': float(p95),
+        'mean_mm': float(sk.mean),
+        'max_mm': sk.max
     }
 
 def compute_all_qc():
@@ -96,10 +127,9 @@ def compute_all_qc():
         'dvf_magnitude': mag_70
     }
     
-    # Note: Inverse consistency requires backward DVF (50->70)
-    # We don't have this, so we'll note it as N/A
-    print("\nInverse Consistency (70->50): N/A (backward DVF not generated)")
-    results['phase_70']['inverse_consistency'] = 'N/A - backward transform not generated'
+    # Backward DVF (50->70) from fixed-point inversion of the forward field
+    print("\nInverse Consistency (70->50):")
+    results['phase_70']['inverse_consistency'] = backward_qc(dvf_70_fwd, mask_50)
     
     # Phase 30->50
     print("\n[2/3] Phase 30->50 QC")
@@ -114,9 +144,10 @@ def compute_all_qc():
     print(f"  P95:    {mag_30['p95_mm']:.2f} mm")
     print(f"  Mean:   {mag_30['mean_mm']:.2f} mm")
     
+    print("\nInverse Consistency (30->50):")
     results['phase_30'] = {
         'dvf_magnitude': mag_30,
-        'inverse_consistency': 'N/A - backward transform not generated'
+        'inverse_consistency': backward_qc(dvf_30_fwd, mask_50)
     }
     
     # Phase 00->50
@@ -132,9 +163,10 @@ def compute_all_qc():
     print(f"  P95:    {mag_00['p95_mm']:.2f} mm")
     print(f"  Mean:   {mag_00['mean_mm']:.2f} mm")
     
+    print("\nInverse Consistency (00->50):")
     results['phase_00'] = {
         'dvf_magnitude': mag_00,
-        'inverse_consistency': 'N/A - backward transform not generated'
+        'inverse_consistency': backward_qc(dvf_00_fwd, mask_50)
     }
     
     # Save results
@@ -11,6 +11,16 @@ import ants
 import numpy as np
 from pathlib import Path
 import json
+import SimpleITK as sitk
+
+from dvf_ops import load_field
+from image_bridge import to_numpy
+from jacobian import jacobian_determinant
+from quantile_sketch import QuantileSketch
+from tre import field_tre, load_pts_landmarks
+
+TRE_MEDIAN_MAX_MM = 2.5
+TRE_P95_MAX_MM = 5.0
 
 def load_popi_landmarks(phase):
     """
@@ -25,147 +35,59 @@ def load_popi_landmarks(phase):
         raise FileNotFoundError(f"Landmarks not found: {lm_path}")
     
     # POPI .pts format: each line is "x y z"
-    landmarks = []
-    with open(lm_path, 'r') as f:
-        for line in f:
-            line = line.strip()
-            if line and not line.startswith('#'):
-                coords = line.split()
-                if len(coords) >= 3:
-                    landmarks.append([float(coords[0]), float(coords[1]), float(coords[2])])
-    
-    return np.array(landmarks)
+    return load_pts_landmarks(lm_path)
 
 def compute_tre_ants(dvf_path, fixed_landmarks, moving_landmarks):
     """
     Compute TRE using ANTs displacement field.
     
+    Landmarks are mapped to the DVF grid with its full direction matrix and
+    interpolated in one vectorized call (tre.field_tre). Landmarks outside
+    the grid are excluded from the statistics and counted.
+    
     Args:
         dvf_path: Path to DVF
         fixed_landmarks: Nx3 array (reference positions in mm)
         moving_landmarks: Nx3 array (original positions in mm)
     
     Returns:
-        dict with median_mm, p95_mm, max_mm
+        dict with median_mm, p95_mm, max_mm, mean_mm, n_landmarks, n_out_of_bounds
     """
-    dvf = ants.image_read(str(dvf_path))
-    
-    # Convert landmarks to voxel indices
-    spacing = np.array(dvf.spacing)
-    origin = np.array(dvf.origin)
-    
-    # Moving landmarks in voxel space
-    mov_vox = (moving_landmarks - origin) / spacing
-    
-    # Sample DVF at moving landmark positions
-    dvf_arr = dvf.numpy()  # Shape: (Z, Y, X, 3)
-    
-    # Interpolate DVF at each landmark
-    warped_landmarks = []
-    for i, lm_vox in enumerate(mov_vox):
-        z, y, x = lm_vox
-        
-        # Trilinear interpolation
-        z0, y0, x0 = int(np.floor(z)), int(np.floor(y)), int(np.floor(x))
-        z1, y1, x1 = z0 + 1, y0 + 1, x0 + 1
-        
-        # Check bounds
-        if (0 <= z0 < dvf_arr.shape[0]-1 and 
-            0 <= y0 < dvf_arr.shape[1]-1 and 
-            0 <= x0 < dvf_arr.shape[2]-1):
-            
-            # Trilinear weights
-            dz, dy, dx = z - z0, y - y0, x - x0
-            
-            # Sample 8 corners
-            c000 = dvf_arr[z0, y0, x0]
-            c001 = dvf_arr[z0, y0, x1]
-            c010 = dvf_arr[z0, y1, x0]
-            c011 = dvf_arr[z0, y1, x1]
-            c100 = dvf_arr[z1, y0, x0]
-            c101 = dvf_arr[z1, y0, x1]
-            c110 = dvf_arr[z1, y1, x0]
-            c111 = dvf_arr[z1, y1, x1]
-            
-            # Interpolate
-            c00 = c000 * (1-dx) + c001 * dx
-            c01 = c010 * (1-dx) + c011 * dx
-            c10 = c100 * (1-dx) + c101 * dx
-            c11 = c110 * (1-dx) + c111 * dx
-            
-            c0 = c00 * (1-dy) + c01 * dy
-            c1 = c10 * (1-dy) + c11 * dy
-            
-            displacement = c0 * (1-dz) + c1 * dz
-            
-            # Apply displacement
-            warped_pos = moving_landmarks[i] + displacement
-            warped_landmarks.append(warped_pos)
-        else:
-            # Out of bounds - use original position
-            warped_landmarks.append(moving_landmarks[i])
-    
-    warped_landmarks = np.array(warped_landmarks)
-    
-    # Compute Euclidean errors
-    errors = np.linalg.norm(warped_landmarks - fixed_landmarks, axis=1)
-    
-    return {
-        'median_mm': float(np.median(errors)),
-        'p95_mm': float(np.percentile(errors, 95)),
-        'max_mm': float(errors.max()),
-        'mean_mm': float(errors.mean()),
-        'n_landmarks': len(errors)
-    }
+    res = field_tre(load_field(dvf_path), {'tre': (fixed_landmarks, moving_landmarks)})['tre']
+    res.pop('errors_mm')
+    return res
 
 def compute_jacobian_stats_ants(dvf_path, mask_path=None):
     """
     Compute Jacobian determinant statistics.
     
-    Uses SimpleITK for correct det(I + grad u) computation.
+    det(I + grad u) with SimpleITK-compatible central differences
+    (jacobian.jacobian_determinant), evaluated only inside the mask.
     
     Returns:
         dict with p01, p50, p99, pct_negative
     """
-    import SimpleITK as sitk
-    
-    # Load DVF
-    dvf_ants = ants.image_read(str(dvf_path))
-    
-    # Convert to SimpleITK for Jacobian computation
-    # Write temp file and reload with SimpleITK
-    temp_dvf = Path("results/popi_ants/temp_dvf_for_jac.nii.gz")
-    ants.image_write(dvf_ants, str(temp_dvf))
-    
-    dvf_sitk = sitk.ReadImage(str(temp_dvf))
-    
-    # Compute Jacobian determinant (det(I + grad u))
-    jac_sitk = sitk.DisplacementFieldJacobianDeterminant(dvf_sitk)
-    
-    # Get array
-    jac_arr = sitk.GetArrayFromImage(jac_sitk)
+    field = load_field(dvf_path)
+    geom = field['geom']
     
+    mask = None
     if mask_path and Path(mask_path).exists():
-        # Load mask with SimpleITK to match Jacobian array shape
-        mask_sitk = sitk.ReadImage(str(mask_path))
-        mask_arr = sitk.GetArrayFromImage(mask_sitk)
-        jac_masked = jac_arr[mask_arr > 0]
-    else:
-        jac_masked = jac_arr.flatten()
+        # Mask is on the DVF grid
+        mask = to_numpy(sitk.ReadImage(str(mask_path)), order="xyz") > 0
     
-    neg_pct = float((jac_masked < 0).mean() * 100.0)
+    jac_arr = jacobian_determinant(field['array'], geom['spacing'], geom['direction'], mask=mask)
+    jac_masked = jac_arr[mask] if mask is not None else jac_arr.reshape(-1)
     
-    # Clean up temp
-    if temp_dvf.exists():
-        temp_dvf.unlink()
+    sk = QuantileSketch.for_metric('jacobian').add(jac_masked)
+    p01, p50, p99 = sk.percentile([1, 50, 99])
     
     return {
-        'min': float(jac_masked.min()),
-        'p01': float(np.percentile(jac_masked, 1)),
-        'p50': float(np.percentile(jac_masked, 50)),
-        'p99': float(np.percentile(jac_masked, 99)),
-        'max': float(jac_masked.max()),
-        'pct_negative': neg_pct
+        'min': sk.min,
+        'p01': float(p01),
+        'p50': float(p50),
+        'p99': float(p99),
+        'max': sk.max,
+        'pct_negative': float(sk.fraction_below(0.0) * 100.0)
     }
 
 def compute_dvf_magnitude(dvf_path):
@@ -176,14 +98,36 @@ def compute_dvf_magnitude(dvf_path):
     dvf_arr = dvf.numpy()
     
     mag = np.linalg.norm(dvf_arr, axis=-1)
+    sk = QuantileSketch.for_metric('magnitude').add(mag)
     
     return {
-        'median_mm': float(np.median(mag)),
-        'p95_mm': float(np.percentile(mag, 95)),
-        'max_mm': float(mag.max()),
-        'mean_mm': float(mag.mean())
+        'median_mm': float(sk.percentile(50)),
+        'p95_mm': float(sk.percentile(95)),
+        'max_mm': sk.max,
+        'mean_mm': float(sk.mean)
     }
 
+def tre_issues(tre):
+    """
+    TRE part of the QC gate: median <= 2.5 mm, P95 <= 5.0 mm, every landmark
+    inside the DVF grid.
+    
+    Returns:
+        list of issues (empty if the TRE passes)
+    """
+    issues = []
+    # NaN statistics compare False, so unmeasured TRE must fail explicitly
+    if not (np.isfinite(tre['median_mm']) and np.isfinite(tre['p95_mm'])):
+        issues.append("TRE not measured (no landmarks inside the DVF grid)")
+    else:
+        if tre['median_mm'] > TRE_MEDIAN_MAX_MM:
+            issues.append(f"TRE median {tre['median_mm']:.2f}mm > {TRE_MEDIAN_MAX_MM}mm")
+        if tre['p95_mm'] > TRE_P95_MAX_MM:
+            issues.append(f"TRE P95 {tre['p95_mm']:.2f}mm > {TRE_P95_MAX_MM}mm")
+    if tre.get('n_out_of_bounds', 0) > 0:
+        issues.append(f"TRE: {tre['n_out_of_bounds']} landmark(s) outside the DVF grid")
+    return issues
+
 def check_acceptance_criteria(metrics):
     """
     Check QC gates.
@@ -191,13 +135,8 @@ def check_acceptance_criteria(metrics):
     Returns:
         (passed: bool, issues: list)
     """
-    issues = []
-    
     # TRE
-    if metrics['tre']['median_mm'] > 2.5:
-        issues.append(f"TRE median {metrics['tre']['median_mm']:.2f}mm > 2.5mm")
-    if metrics['tre']['p95_mm'] > 5.0:
-        issues.append(f"TRE P95 {metrics['tre']['p95_mm']:.2f}mm > 5.0mm")
+    issues = tre_issues(metrics['tre'])
     
     # Jacobian
     jac = metrics['jacobian']
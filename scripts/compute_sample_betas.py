@@ -4,10 +4,12 @@ Shows how original DVFs project onto principal components in SD units
 """
 
 import numpy as np
-import ants
 import json
 from pathlib import Path
 
+from pca_model import load_pca_model
+from project_betas import project_betas
+
 def sample_betas_sd(X, mu, U, S):
     """
     Compute beta coefficients for samples in SD units.
@@ -45,63 +47,28 @@ def main():
     print("Computing Per-Sample Beta Coefficients")
     print("="*70)
     
-    # Load PCA metadata
-    pca_meta_path = Path("results/pca/pca_meta.json")
-    with open(pca_meta_path, 'r') as f:
-        pca_meta = json.load(f)
+    # Load PCA model (single memory-mapped file)
+    pca_dir = Path("results/pca")
+    mask_path = Path("data/preprocessed/popi_ants/phase50_lung_mask.nii.gz")
+    model = load_pca_model(pca_dir, mask_path, n_components=2)
     
-    singular_values = np.array(pca_meta['singular_values'])
-    variance_explained = np.array(pca_meta['variance_explained'])
+    singular_values = model['S']
+    variance_explained = model['var_ratio']
     
-    print(f"\n1. PCA Metadata:")
+    print(f"\n1. PCA Model:")
     print(f"   Singular values: {singular_values}")
-    print(f"   Variance explained: {variance_explained}%")
+    print(f"   Variance explained: {variance_explained}")
+    print(f"   Mask voxels: {model['idx'].size}")
     
-    # Load DVFs and mask
+    # Load DVFs, masked with the model's indices
     dvf_dir = Path("results/popi_ants_roi")
-    mask_path = Path("data/preprocessed/popi_ants/phase50_lung_mask.nii.gz")
+    dvf_names = ["dvf_70_to_50_FINAL.nii.gz",
+                 "dvf_30_to_50_FINAL.nii.gz",
+                 "dvf_00_to_50_FINAL.nii.gz"]
     
-    dvfs = []
-    for dvf_name in ["dvf_70_to_50_FINAL.nii.gz", 
-                      "dvf_30_to_50_FINAL.nii.gz", 
-                      "dvf_00_to_50_FINAL.nii.gz"]:
-        dvf = ants.image_read(str(dvf_dir / dvf_name))
-        dvfs.append(dvf)
-    
-    # Resample mask to DVF grid
-    mask_orig = ants.image_read(str(mask_path))
-    mask = ants.apply_transforms(
-        fixed=dvfs[0].split_channels()[0],
-        moving=mask_orig,
-        transformlist=[],
-        interpolator='nearestNeighbor'
-    ).numpy() > 0
-    
-    print(f"\n2. Loading DVFs:")
-    print(f"   Mask voxels: {mask.sum()}")
-    
-    # Pack DVFs into matrix
-    X_list = []
-    for i, dvf in enumerate(dvfs):
-        arr = dvf.numpy().astype(np.float32)  # (Z, Y, X, 3)
-        vec = arr[mask, :]  # (N_mask, 3)
-        vec_flat = vec.flatten()  # (N_mask * 3,)
-        X_list.append(vec_flat)
-        print(f"   DVF {i+1}: shape {arr.shape} -> {vec_flat.shape[0]} elements")
-    
-    X = np.column_stack(X_list)  # (P, 3) where P=N_mask*3
-    
-    # Load mean and PCs
-    mu = ants.image_read("results/pca/pc_mean.nii.gz").numpy()[mask, :].flatten()
-    
-    U_list = []
-    for k in range(2):  # PC1, PC2
-        pc = ants.image_read(f"results/pca/pc_{k+1}.nii.gz").numpy()[mask, :].flatten()
-        U_list.append(pc)
-    U = np.column_stack(U_list)  # (P, 2)
-    
-    # Compute betas
-    betas, scale = sample_betas_sd(X, mu, U, singular_values[:2])
+    print(f"\n2. Projecting DVFs:")
+    betas = project_betas(model, [dvf_dir / n for n in dvf_names])   # (2, 3)
+    scale = model['scale']
     
     print(f"\n3. Beta Coefficients (SD units):")
     print(f"   Per-mode SD: {scale}")
@@ -117,8 +84,8 @@ def main():
         "betas_rows_PCs_cols_samples": betas.tolist(),
         "per_mode_SD_mm": scale.tolist(),
         "interpretation": {
-            "pc1": "Primary breathing amplitude (82.2% variance)",
-            "pc2": "Breathing pattern variation (17.8% variance)"
+            "pc1": f"Primary breathing amplitude ({variance_explained[0]:.1%} variance)",
+            "pc2": f"Breathing pattern variation ({variance_explained[1]:.1%} variance)"
         },
         "notes": [
             "Betas are in standard deviation (SD) units",
@@ -0,0 +1,260 @@
+"""
+Native NumPy operations on displacement vector fields (DVFs)
+
+Fields are handled as dicts:
+    array: (X, Y, Z, 3) float32 view in ANTs axis order
+    flat:  (Z*Y*X, 3) C-contiguous view of the same voxels (x fastest)
+    shape: (X, Y, Z)
+    geom:  origin, spacing, direction (see image_bridge.geometry)
+
+Displacements are physical (mm) vectors, as in ITK/ANTs: a field u maps a
+point x of its grid to x + u(x). Volumes are processed in z-slabs on a
+thread pool; NumPy releases the GIL inside the gather and arithmetic
+kernels, so slabs run concurrently and temporary memory stays bounded by
+slab size.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import SimpleITK as sitk
+
+from image_bridge import geometry, read_geometry, to_numpy, to_sitk
+from parallel import available_cores
+
+def make_field(arr, geom, order="xyz"):
+    """
+    Wrap a displacement array and its grid geometry as a field dict.
+
+    Args:
+        arr: (X,Y,Z,3) array ("xyz") or (Z,Y,X,3) array ("zyx")
+        geom: geometry dict or image providing origin/spacing/direction
+    """
+    geom = dict(geometry(geom))
+    zyx = arr if order == "zyx" else arr.transpose(2, 1, 0, 3)
+    zyx = np.ascontiguousarray(zyx, dtype=np.float32)
+    geom['shape'] = zyx.shape[2::-1]
+    return {
+        'array': zyx.transpose(2, 1, 0, 3),
+        'flat': zyx.reshape(-1, zyx.shape[-1]),
+        'shape': np.array(geom['shape']),
+        'geom': geom
+    }
+
+def load_field(path):
+    """Read a DVF file into a field dict (single float32 copy)."""
+    img = sitk.ReadImage(str(path), sitk.sitkVectorFloat32)
+    return make_field(to_numpy(img, order="zyx", copy=True), geometry(img), order="zyx")
+
+def write_field(field_or_arr, path, like=None):
+    """Write a field (or (X,Y,Z,3) array on the grid of like) as float32 NIfTI."""
+    if isinstance(field_or_arr, dict):
+        arr, like = field_or_arr['array'], field_or_arr['geom']
+    else:
+        arr = field_or_arr
+    sitk.WriteImage(to_sitk(np.asarray(arr, dtype=np.float32), like=like, order="xyz"), str(path))
+
+def grid_slab_points(geom, z0, z1):
+    """
+    Physical coordinates of grid voxels in slab z0:z1.
+
+    Returns:
+        (n, 3) float64 points, x fastest then y then z
+    """
+    nx, ny = geom['shape'][0], geom['shape'][1]
+    zz, yy, xx = np.meshgrid(np.arange(z0, z1), np.arange(ny), np.arange(nx), indexing='ij')
+    idx = np.stack([xx.ravel(), yy.ravel(), zz.ravel()], axis=1).astype(np.float64)
+    return index_to_physical(idx, geom)
+
+def index_to_physical(idx, geom):
+    """Continuous (x,y,z) indices -> physical points: origin + D @ (spacing * idx)."""
+    return geom['origin'] + (idx * geom['spacing']) @ np.asarray(geom['direction']).T
+
+def physical_to_index(points, geom):
+    """Physical points -> continuous (x,y,z) indices using the full direction matrix."""
+    d_inv = np.linalg.inv(np.asarray(geom['direction']))
+    return ((points - geom['origin']) @ d_inv.T) / geom['spacing']
+
+def sample_trilinear(field, cidx, fill=0.0):
+    """
+    Trilinear interpolation of a field at continuous indices.
+
+    Points within half a voxel of the grid are interpolated with edge
+    clamping (as ITK does); points further out get fill.
+
+    Args:
+        field: field dict (or any dict with 'flat' (N,C) and 'shape')
+        cidx: (n, 3) continuous (x,y,z) indices
+
+    Returns:
+        (values (n, C) float32, inside (n,) bool)
+    """
+    shape = field['shape']
+    flat = field['flat']
+    inside = np.all((cidx >= -0.5) & (cidx <= shape - 0.5), axis=1)
+
+    i0 = np.floor(cidx)
+    frac = (cidx - i0).astype(np.float32)
+    i0 = i0.astype(np.int64)
+    lo = np.clip(i0, 0, shape - 1)
+    hi = np.clip(i0 + 1, 0, shape - 1)
+
+    sx, sy = 1, int(shape[0])
+    sz = int(shape[0]) * int(shape[1])
+    out = np.zeros((cidx.shape[0], flat.shape[1]), dtype=np.float32)
+    for cx in (0, 1):
+        ix = hi[:, 0] if cx else lo[:, 0]
+        wx = frac[:, 0] if cx else 1.0 - frac[:, 0]
+        for cy in (0, 1):
+            iy = hi[:, 1] if cy else lo[:, 1]
+            wy = frac[:, 1] if cy else 1.0 - frac[:, 1]
+            for cz in (0, 1):
+                iz = hi[:, 2] if cz else lo[:, 2]
+                wz = frac[:, 2] if cz else 1.0 - frac[:, 2]
+                w = wx * wy * wz
+                out += np.take(flat, ix * sx + iy * sy + iz * sz, axis=0) * w[:, None]
+
+    if fill is not None and not inside.all():
+        out[~inside] = fill
+    return out, inside
+
+def iter_slabs(n, slab):
+    """(start, stop) pairs covering range(n) in steps of slab."""
+    for z0 in range(0, n, slab):
+        yield z0, min(n, z0 + slab)
+
+def run_slabs(fn, n_z, slab=16, n_threads=None):
+    """
+    Call fn(z0, z1) for every slab on a thread pool.
+
+    Returns:
+        list of results in slab order
+    """
+    n_threads = n_threads or available_cores()
+    slabs = list(iter_slabs(n_z, slab))
+    if n_threads == 1 or len(slabs) == 1:
+        return [fn(z0, z1) for z0, z1 in slabs]
+    with ThreadPoolExecutor(max_workers=n_threads) as ex:
+        return list(ex.map(lambda s: fn(*s), slabs))
+
+def compose_fields(fields, reference=None, slab=16, n_threads=None):
+    """
+    Compose a chain of displacement fields.
+
+    fields[0] is applied first: with p_0 = x and p_k = p_{k-1} + u_k(p_{k-1}),
+    the result is u(x) = p_n - x, evaluated on the reference grid. Outside a
+    field's grid its displacement is zero (ITK DisplacementFieldTransform
+    convention).
+
+    Args:
+        fields: list of field dicts (any length >= 1)
+        reference: geometry of the output grid (default: grid of fields[0])
+        slab: z-slices per work item
+        n_threads: worker threads (default: all cores)
+
+    Returns:
+        field dict on the reference grid (float32)
+    """
+    if not fields:
+        raise ValueError("Need at least one field to compose")
+    ref = dict(geometry(reference)) if reference is not None else dict(fields[0]['geom'])
+    nx, ny, nz = ref['shape']
+    out = np.empty((nz, ny, nx, 3), dtype=np.float32)
+
+    def compose_slab(z0, z1):
+        x = grid_slab_points(ref, z0, z1)
+        p = x.copy()
+        for f in fields:
+            disp, _ = sample_trilinear(f, physical_to_index(p, f['geom']))
+            p += disp
+        out[z0:z1] = (p - x).reshape(z1 - z0, ny, nx, 3)
+
+    run_slabs(compose_slab, nz, slab=slab, n_threads=n_threads)
+    return make_field(out, ref, order="zyx")
+
+def compose_dvf_files(paths, out_path, reference=None, slab=16, n_threads=None):
+    """
+    Compose DVF files (paths[0] applied first) and write a float32 field.
+
+    Args:
+        reference: path or geometry of the output grid (default: paths[0])
+    """
+    fields = [load_field(p) for p in paths]
+    if reference is not None and not isinstance(reference, dict):
+        reference = read_geometry(reference)
+    total = compose_fields(fields, reference=reference, slab=slab, n_threads=n_threads)
+    write_field(total, out_path)
+    return total
+
+def invert_field(field, n_iter=30, tol_mm=0.01, slab=16, n_threads=None):
+    """
+    Fixed-point inversion of a displacement field on its own grid.
+
+    Iterates v(y) <- -u(y + v(y)) from v = -u. Each voxel's iteration only
+    reads u, so slabs are independent and stop as soon as their largest
+    residual |v(y) + u(y + v(y))| drops below tol_mm. Converges where the
+    map x -> x + u(x) is invertible (|grad u| < 1).
+
+    Returns:
+        (inverse field dict, residual magnitude (X,Y,Z) float32 array in mm)
+    """
+    geom = field['geom']
+    nx, ny, nz = geom['shape']
+    inv = np.empty((nz, ny, nx, 3), dtype=np.float32)
+    res = np.empty((nz, ny, nx), dtype=np.float32)
+    zyx = field['flat'].reshape(nz, ny, nx, 3)
+
+    def invert_slab(z0, z1):
+        y = grid_slab_points(geom, z0, z1)
+        v = -zyx[z0:z1].reshape(-1, 3).astype(np.float64)
+        for it in range(n_iter):
+            u_at, _ = sample_trilinear(field, physical_to_index(y + v, geom))
+            r = v + u_at
+            v = -u_at.astype(np.float64)
+            if np.sqrt((r * r).sum(axis=1)).max() < tol_mm:
+                break
+        u_at, _ = sample_trilinear(field, physical_to_index(y + v, geom))
+        inv[z0:z1] = v.reshape(z1 - z0, ny, nx, 3)
+        res[z0:z1] = np.linalg.norm(v + u_at, axis=1).reshape(z1 - z0, ny, nx)
+        return it + 1
+
+    iters = run_slabs(invert_slab, nz, slab=slab, n_threads=n_threads)
+    print(f"    Inversion: {max(iters)} iterations (max over slabs), "
+          f"residual median {np.median(res):.4f} mm, max {res.max():.4f} mm")
+    return make_field(inv, geom, order="zyx"), res.transpose(2, 1, 0)
+
+def invert_dvf_file(dvf_path, out_path, residual_path=None, n_iter=30, tol_mm=0.01,
+                    slab=16, n_threads=None):
+    """
+    Invert a DVF file and write the backward field (and its residual map).
+
+    Returns:
+        (inverse field dict, residual array)
+    """
+    field = load_field(dvf_path)
+    inv, res = invert_field(field, n_iter=n_iter, tol_mm=tol_mm, slab=slab, n_threads=n_threads)
+    write_field(inv, out_path)
+    if residual_path is not None:
+        sitk.WriteImage(to_sitk(res, like=inv['geom'], order="xyz"), str(residual_path))
+    return inv, res
+
+def inverse_consistency_field(fwd, bwd, slab=16, n_threads=None):
+    """
+    |u_f(x) + u_b(x + u_f(x))| on the forward field's grid.
+
+    Returns:
+        (X,Y,Z) float32 array in mm
+    """
+    geom = fwd['geom']
+    nx, ny, nz = geom['shape']
+    mag = np.empty((nz, ny, nx), dtype=np.float32)
+    zyx = fwd['flat'].reshape(nz, ny, nx, 3)
+
+    def ic_slab(z0, z1):
+        x = grid_slab_points(geom, z0, z1)
+        u = zyx[z0:z1].reshape(-1, 3)
+        b, _ = sample_trilinear(bwd, physical_to_index(x + u, bwd['geom']))
+        mag[z0:z1] = np.linalg.norm(u + b, axis=1).reshape(z1 - z0, ny, nx)
+
+    run_slabs(ic_slab, nz, slab=slab, n_threads=n_threads)
+    return mag.transpose(2, 1, 0)
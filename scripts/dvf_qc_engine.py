@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+"""
+Fused single-pass DVF QC
+
+Loads a DVF once and computes, in one pass over z-slabs:
+    - displacement magnitude
+    - Jacobian determinant det(I + grad u)
+    - inverse consistency |u_f(x) + u_b(x + u_f(x))| (if a backward field is given)
+    - curl magnitude and divergence of u
+plus TRE for any landmark sets (tre.field_tre, one interpolation call).
+
+Each slab is read with a one-slice halo above and below, so its central
+differences match the whole-volume gradient (jacobian.field_gradient, edge
+replication at the volume boundary). Each slab's values go into mergeable
+quantile sketches (quantile_sketch.QC_RANGES), so no per-voxel metric is
+kept across slabs, and the sketches of several DVFs can be merged into
+cohort statistics.
+
+Memory: the forward field (12 bytes/voxel) and, for inverse consistency,
+the backward field (12 bytes/voxel) are resident for the whole pass, plus
+the resampled mask (1 byte/voxel); the backward field is sampled at
+arbitrary warped points, so it cannot be streamed. On top of that, each
+slab in flight needs about 110 bytes per slab voxel (about 290 with a
+backward field) and ~2 MB of sketches. At most MAX_SLABS_IN_FLIGHT slabs
+run at once, so for a 512x512x150 field pair with slab=16 the peak is
+about 1 GB resident plus 4 x 1.2 GB in flight; lower slab or n_threads to
+trade speed for memory.
+
+The metrics dict uses the keys check_acceptance_criteria reads
+(tre, jacobian with pct_negative, dvf_magnitude).
+"""
+
+import json
+import threading
+from pathlib import Path
+
+import numpy as np
+
+from compute_final_qc_metrics import backward_dvf_path, backward_is_current, resample_mask_to_field
+from compute_phase70_qc import check_acceptance_criteria, load_popi_landmarks
+from dvf_ops import grid_slab_points, load_field, physical_to_index, run_slabs, sample_trilinear
+from jacobian import det3, field_gradient, jacobian_stats_from_sketch
+from quantile_sketch import QuantileSketch, merge_sketches
+from parallel import available_cores
+from tre import field_tre
+
+MAX_SLABS_IN_FLIGHT = 4
+
+def _slab_metrics(zyx, geom, z0, z1, mask_zyx=None, bwd=None):
+    """
+    Masked per-voxel metrics for slab z0:z1 of a (Z,Y,X,3) field.
+
+    Returns:
+        dict name -> (n,) float32: magnitude, jacobian, curl, divergence, [ic]
+    """
+    nz = zyx.shape[0]
+    h0, h1 = max(z0 - 1, 0), min(z1 + 1, nz)
+    sub = zyx[h0:h1]
+    G = field_gradient(sub.transpose(2, 1, 0, 3), geom['spacing'], geom['direction'])
+    G = G[:, :, z0 - h0:z1 - h0].transpose(2, 1, 0, 3, 4).reshape(-1, 3, 3)
+    u = zyx[z0:z1].reshape(-1, 3)
+    if mask_zyx is not None:
+        m = mask_zyx[z0:z1].reshape(-1)
+        G, u = G[m], u[m]
+
+    J = G.copy()
+    J[:, [0, 1, 2], [0, 1, 2]] += 1.0
+    curl = np.stack([G[:, 2, 1] - G[:, 1, 2],
+                     G[:, 0, 2] - G[:, 2, 0],
+                     G[:, 1, 0] - G[:, 0, 1]], axis=1)
+    out = {
+        'magnitude': np.sqrt((u * u).sum(axis=1)),
+        'jacobian': det3(J),
+        'curl': np.sqrt((curl * curl).sum(axis=1)),
+        'divergence': G[:, 0, 0] + G[:, 1, 1] + G[:, 2, 2]
+    }
+    if bwd is not None:
+        x = grid_slab_points(geom, z0, z1)
+        if mask_zyx is not None:
+            x = x[m]
+        b, _ = sample_trilinear(bwd, physical_to_index(x + u, bwd['geom']))
+        out['ic'] = np.linalg.norm(u + b, axis=1).astype(np.float32)
+    return {k: v.astype(np.float32, copy=False) for k, v in out.items()}
+
+def sketch_metrics(sketches):
+    """
+    Metrics dict from per-metric sketches (one DVF or merged over a cohort).
+
+    Args:
+        sketches: dict name -> QuantileSketch for magnitude, jacobian, curl,
+                  divergence and optionally ic
+
+    Returns:
+        dict: dvf_magnitude, jacobian, curl, divergence, n_voxels,
+        [inverse_consistency]
+    """
+    mag, jac = sketches['magnitude'], sketches['jacobian']
+    curl, div = sketches['curl'], sketches['divergence']
+    m50, m75, m95 = mag.percentile([50, 75, 95])
+    metrics = {
+        'dvf_magnitude': {
+            'median_mm': float(m50),
+            'p75_mm': float(m75),
+            'p95_mm': float(m95),
+            'mean_mm': float(mag.mean),
+            'max_mm': mag.max
+        },
+        'jacobian': jacobian_stats_from_sketch(jac),
+        'curl': {
+            'median': float(curl.percentile(50)),
+            'p95': float(curl.percentile(95)),
+            'max': curl.max
+        },
+        'divergence': dict(zip(('p01', 'p50', 'p99'), map(float, div.percentile([1, 50, 99])))),
+        'n_voxels': int(mag.count)
+    }
+    # check_acceptance_criteria name for the negative-Jacobian percentage
+    metrics['jacobian']['pct_negative'] = metrics['jacobian'].pop('neg_percent')
+    if 'ic' in sketches:
+        ic = sketches['ic']
+        metrics['inverse_consistency'] = {
+            'median_mm': float(ic.percentile(50)),
+            'p95_mm': float(ic.percentile(95)),
+            'mean_mm': float(ic.mean)
+        }
+    return metrics
+
+def qc_field(field, mask=None, bwd=None, landmark_sets=None, slab=16, n_threads=None,
+             sketches=None):
+    """
+    All QC metrics of one field in a single slab pass.
+
+    Args:
+        field: dvf_ops field dict
+        mask: optional (X,Y,Z) bool mask on the field grid (default: all voxels)
+        bwd: optional backward field dict for inverse consistency
+        landmark_sets: optional dict name -> (fixed, moving) in mm; the first
+                       set is reported as 'tre'
+        slab: z-slices per work item
+        n_threads: slab threads, i.e. slabs in flight
+                   (default: min(cores, MAX_SLABS_IN_FLIGHT))
+        sketches: optional dict name -> QuantileSketch that this field's
+                  values are also merged into (cohort statistics)
+
+    Returns:
+        metrics dict: dvf_magnitude, jacobian, curl, divergence,
+        [inverse_consistency], [tre, tre_sets]
+    """
+    geom = field['geom']
+    nx, ny, nz = geom['shape']
+    zyx = field['flat'].reshape(nz, ny, nx, 3)
+    mask_zyx = None if mask is None else np.ascontiguousarray(np.asarray(mask, dtype=bool).transpose(2, 1, 0))
+
+    names = ['magnitude', 'jacobian', 'curl', 'divergence'] + (['ic'] if bwd is not None else [])
+    totals = {k: QuantileSketch.for_metric(k) for k in names}
+    lock = threading.Lock()
+
+    def qc_slab(z0, z1):
+        vals = _slab_metrics(zyx, geom, z0, z1, mask_zyx, bwd)
+        local = {k: QuantileSketch.for_metric(k).add(v) for k, v in vals.items()}
+        with lock:
+            for k, sk in local.items():
+                totals[k].merge(sk)
+
+    n_threads = n_threads or min(available_cores(), MAX_SLABS_IN_FLIGHT)
+    run_slabs(qc_slab, nz, slab=slab, n_threads=n_threads)
+    if totals['magnitude'].count == 0:
+        raise ValueError("QC mask is empty on the DVF grid")
+    if sketches is not None:
+        for k, sk in totals.items():
+            if k in sketches:
+                sketches[k].merge(sk)
+            else:
+                sketches[k] = merge_sketches([sk])
+
+    metrics = sketch_metrics(totals)
+    if landmark_sets:
+        sets = field_tre(field, landmark_sets)
+        for res in sets.values():
+            res.pop('errors_mm')
+        metrics['tre_sets'] = sets
+        metrics['tre'] = sets[next(iter(landmark_sets))]
+    return metrics
+
+def qc_dvf_file(dvf_path, mask_path=None, bwd_path=None, landmark_sets=None, slab=16, n_threads=None,
+                sketches=None):
+    """
+    Load a DVF (and optional backward DVF) once, run qc_field and evaluate
+    the acceptance criteria when TRE is available.
+
+    Returns:
+        metrics dict (qc_field keys, plus 'passed' and 'issues' if TRE was computed)
+    """
+    field = load_field(dvf_path)
+    mask = resample_mask_to_field(mask_path, field) if mask_path is not None else None
+    bwd = load_field(bwd_path) if bwd_path is not None else None
+    metrics = qc_field(field, mask=mask, bwd=bwd, landmark_sets=landmark_sets,
+                       slab=slab, n_threads=n_threads, sketches=sketches)
+    metrics['dvf'] = str(dvf_path)
+    if 'tre' in metrics:
+        metrics['passed'], metrics['issues'] = check_acceptance_criteria(metrics)
+    return metrics
+
+def main():
+    print("="*70)
+    print("Fused DVF QC (single pass per DVF)")
+    print("="*70)
+
+    data_dir = Path("data/preprocessed/popi_ants")
+    dvf_dir = Path("results/popi_ants_roi")
+    mask_50 = data_dir / "phase50_lung_mask.nii.gz"
+    out_path = dvf_dir / "fused_qc_metrics.json"
+
+    results = {}
+    cohort = {}
+    for i, phase in enumerate(["70", "30", "00"], 1):
+        dvf_path = dvf_dir / f"dvf_{phase}_to_50_FINAL.nii.gz"
+        print(f"\n[{i}/3] Phase {phase}->50")
+        print("-"*70)
+        if not dvf_path.exists():
+            print(f"  Missing DVF: {dvf_path}")
+            continue
+
+        bwd_path = backward_dvf_path(dvf_path)
+        if not backward_is_current(dvf_path, bwd_path):
+            if bwd_path.exists():
+                print(f"  {bwd_path.name} is older than the forward DVF (IC skipped)")
+            bwd_path = None
+        try:
+            landmarks = {'popi': (load_popi_landmarks("50"), load_popi_landmarks(phase))}
+        except FileNotFoundError as e:
+            print(f"  {e} (TRE skipped)")
+            landmarks = None
+
+        m = qc_dvf_file(dvf_path, mask_50, bwd_path, landmarks, sketches=cohort)
+        print(f"  Magnitude: median {m['dvf_magnitude']['median_mm']:.2f} mm, "
+              f"P95 {m['dvf_magnitude']['p95_mm']:.2f} mm")
+        print(f"  Jacobian:  P01 {m['jacobian']['p01']:.3f}, P99 {m['jacobian']['p99']:.3f}, "
+              f"negative {m['jacobian']['pct_negative']:.2f}%")
+        print(f"  Curl:      median {m['curl']['median']:.4f}, "
+              f"divergence P01/P99 {m['divergence']['p01']:.4f}/{m['divergence']['p99']:.4f}")
+        if 'inverse_consistency' in m:
+            print(f"  IC:        median {m['inverse_consistency']['median_mm']:.3f} mm, "
+                  f"P95 {m['inverse_consistency']['p95_mm']:.3f} mm")
+        if 'tre' in m:
+            print(f"  TRE:       median {m['tre']['median_mm']:.2f} mm, P95 {m['tre']['p95_mm']:.2f} mm")
+            print(f"  {'[PASS]' if m['passed'] else '[FAIL] ' + '; '.join(m['issues'])}")
+        results[f"phase_{phase}"] = m
+
+    if cohort:
+        # Voxel-level statistics pooled over all phases, no raw values kept
+        if 'ic' in cohort and cohort['ic'].count != cohort['magnitude'].count:
+            del cohort['ic']    # backward fields exist for only some phases
+        results['cohort'] = sketch_metrics(cohort)
+        print(f"\nCohort ({len(results) - 1} DVFs): magnitude median "
+              f"{results['cohort']['dvf_magnitude']['median_mm']:.2f} mm, Jacobian P01/P99 "
+              f"{results['cohort']['jacobian']['p01']:.3f}/{results['cohort']['jacobian']['p99']:.3f}")
+
+    with open(out_path, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    print("\n" + "="*70)
+    print(f"Fused QC metrics saved to: {out_path}")
+    print("="*70)
+
+if __name__ == "__main__":
+    main()
@@ -1,54 +1,71 @@
 #!/usr/bin/env python3
 """
 Phase 2 Step 1 CORRECTED FINAL: Generate Synthetic Images
-Fix: Warp in DVF grid (use scalar component for resampling, pass DVF path to apply_transforms)
+Fix: Warp in DVF grid. Each DVF is warped once through a shared interpolation
+plan (warp_plan) for the phase image and its lung mask; phase50 is resampled to
+the DVF grid once per run.
 """
 import ants
+import numpy as np
 from pathlib import Path
 import json
 import sys
 
-def generate_in_fixed_grid(moving_img_path, fixed_img_path, dvf_path, out_path):
-    """
-    Generate synthetic by warping in DVF grid
-    
-    Key fixes:
-    1. Extract scalar component from DVF for resampling target
-    2. Resample fixed image to DVF grid
-    3. Pass DVF PATH (not object) to apply_transforms
-    """
-    print(f"  Loading fixed: {fixed_img_path.name}")
-    fixed_native = ants.image_read(str(fixed_img_path))
-    
-    print(f"  Loading DVF: {dvf_path.name}")
-    dvf = ants.image_read(str(dvf_path))
-    print(f"    DVF grid: {dvf.shape}, spacing={dvf.spacing}")
+from dvf_ops import load_field
+from hashing import params_digest
+from image_bridge import read_geometry, to_ants
+from warp_plan import build_warp_plan, warped_images
 
-    # Extract scalar component as resampling reference
-    print(f"  Extracting scalar reference from DVF...")
-    dvf_scalar = dvf.split_channels()[0]
+_REFERENCE_CACHE = {}
 
-    # Resample fixed image to DVF grid
-    print(f"  Resampling fixed to DVF grid...")
-    fixed_in_dvf_grid = ants.resample_image_to_target(fixed_native, dvf_scalar, interp_type=1)
-    print(f"    Resampled: {fixed_in_dvf_grid.shape}, spacing={fixed_in_dvf_grid.spacing}")
+def reference_in_dvf_grid(fixed_img_path, dvf_geom):
+    """
+    Resample the fixed image to a DVF grid, once per (image, grid) per run.
+    """
+    key = (str(fixed_img_path), params_digest(dvf_geom))
+    if key not in _REFERENCE_CACHE:
+        print(f"  Resampling {Path(fixed_img_path).name} to DVF grid...")
+        fixed_native = ants.image_read(str(fixed_img_path))
+        dvf_scalar = to_ants(np.zeros(tuple(dvf_geom['shape']), dtype=np.float32), like=dvf_geom)
+        _REFERENCE_CACHE[key] = ants.resample_image_to_target(fixed_native, dvf_scalar, interp_type=1)
+        print(f"    Resampled: {_REFERENCE_CACHE[key].shape}, spacing={_REFERENCE_CACHE[key].spacing}")
+    return _REFERENCE_CACHE[key]
 
-    print(f"  Loading moving: {moving_img_path.name}")
-    moving = ants.image_read(str(moving_img_path))
+def warp_volumes_through_dvf(dvf_path, volumes, out_dir):
+    """
+    Warp several volumes through one DVF with a shared interpolation plan.
+    
+    Args:
+        dvf_path: forward DVF (defines the output grid)
+        volumes: list of (input path, output name, 'linear'|'nearestNeighbor'),
+                 all on the same moving grid
+        out_dir: output directory
     
-    # Apply forward DVF using DVF PATH (not object)
-    print(f"  Applying transformation...")
-    warped = ants.apply_transforms(
-        fixed=fixed_in_dvf_grid,
-        moving=moving,
-        transformlist=[str(dvf_path)],  # CRITICAL: pass path string, not object
-        interpolator='linear'
-    )
+    Returns:
+        dict output name -> ANTs image
+    """
+    print(f"  Loading DVF: {Path(dvf_path).name}")
+    field = load_field(dvf_path)
+    print(f"    DVF grid: {field['geom']['shape']}, spacing={field['geom']['spacing'].tolist()}")
     
-    print(f"  Saving: {out_path.name}")
-    ants.image_write(warped, str(out_path))
-    print(f"  [DONE]")
-    return fixed_in_dvf_grid
+    images = {name: ants.image_read(str(path)) for path, name, _ in volumes}
+    print(f"  Building interpolation plan...")
+    plan = build_warp_plan(field, next(iter(images.values())))
+    
+    outputs = {}
+    for interp in ('linear', 'nearestNeighbor'):
+        names = [name for _, name, i in volumes if i == interp]
+        if not names:
+            continue
+        print(f"  Warping {len(names)} volume(s) ({interp})...")
+        warped = warped_images(plan, [images[n] for n in names], interpolator=interp)
+        for name, img in zip(names, warped):
+            if interp == 'nearestNeighbor':
+                img = img.clone('unsigned char')
+            ants.image_write(img, str(Path(out_dir) / name))
+            outputs[name] = img
+            print(f"    Saved: {name}")
+    return outputs
 
 def main():
     print("="*70)
@@ -78,18 +95,19 @@ def main():
             sys.exit(1)
         print(f"  [OK] {p.name}")
 
-    # Generate synthetics aligned to DVF grid (iso)
-    print("\n[1/3] Phase 70 to 50 (in DVF grid)")
-    print("-"*70)
-    fixed_iso = generate_in_fixed_grid(phase70, fixed50, dvf_70_50, out_dir/"phase70_in_50.nii.gz")
-    
-    print("\n[2/3] Phase 30 to 50 (in DVF grid)")
-    print("-"*70)
-    _ = generate_in_fixed_grid(phase30, fixed50, dvf_30_50, out_dir/"phase30_in_50.nii.gz")
+    # Reference grid: phase50 resampled once to the (shared) DVF grid
+    fixed_iso = reference_in_dvf_grid(fixed50, read_geometry(dvf_70_50))
     
-    print("\n[3/3] Phase 00 to 50 (in DVF grid)")
-    print("-"*70)
-    _ = generate_in_fixed_grid(phase00, fixed50, dvf_00_50, out_dir/"phase00_in_50.nii.gz")
+    # Generate synthetics aligned to DVF grid (iso); lung masks share the plan
+    pairs = [("70", phase70, dvf_70_50), ("30", phase30, dvf_30_50), ("00", phase00, dvf_00_50)]
+    for i, (ph, moving, dvf) in enumerate(pairs):
+        print(f"\n[{i+1}/3] Phase {ph} to 50 (in DVF grid)")
+        print("-"*70)
+        volumes = [(moving, f"phase{ph}_in_50.nii.gz", 'linear')]
+        mask = data_dir / f"phase{ph}_lung_mask.nii.gz"
+        if mask.exists():
+            volumes.append((mask, f"phase{ph}_lung_mask_in_50.nii.gz", 'nearestNeighbor'))
+        warp_volumes_through_dvf(dvf, volumes, out_dir)
 
     # Save the fixed image resampled to iso grid for fair comparison
     print("\nSaving phase50 in DVF grid for validation...")
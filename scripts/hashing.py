@@ -0,0 +1,52 @@
+"""
+Content hashing for cache keys
+"""
+
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+
+_CHUNK = 1 << 20
+_digest_memo = {}
+
+def file_digest(path):
+    """
+    SHA-256 of a file's bytes.
+
+    Memoized per process on (path, size, mtime) so repeated lookups of the
+    same input do not re-read it.
+    """
+    path = Path(path)
+    st = os.stat(path)
+    memo_key = (str(path.resolve()), st.st_size, st.st_mtime_ns)
+    if memo_key in _digest_memo:
+        return _digest_memo[memo_key]
+
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(_CHUNK), b''):
+            h.update(block)
+    digest = h.hexdigest()
+    _digest_memo[memo_key] = digest
+    return digest
+
+def _canonical(obj):
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, (np.floating, np.integer)):
+        return obj.item()
+    if isinstance(obj, Path):
+        return str(obj)
+    if isinstance(obj, (tuple, list)):
+        return [_canonical(v) for v in obj]
+    if isinstance(obj, dict):
+        return {str(k): _canonical(v) for k, v in obj.items()}
+    return obj
+
+def params_digest(obj):
+    """SHA-256 of a JSON-serializable parameter structure (key order independent)."""
+    text = json.dumps(_canonical(obj), sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
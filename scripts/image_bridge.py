@@ -0,0 +1,161 @@
+"""
+In-memory bridge between ANTs, SimpleITK and NumPy images
+Replaces the write-to-disk / read-back round-trips used to move images and
+displacement fields between libraries.
+
+Conventions:
+- "xyz" arrays follow ANTs indexing: (X, Y, Z) or (X, Y, Z, C)
+- "zyx" arrays follow SimpleITK/NumPy indexing: (Z, Y, X) or (Z, Y, X, C)
+- Geometry is a dict with origin, spacing, direction (3x3) and shape (X, Y, Z)
+
+ANTs and SimpleITK both store voxels with x fastest and components innermost,
+so the ordering change is a transpose of a view, not a copy.
+"""
+
+import ants
+import numpy as np
+import SimpleITK as sitk
+
+def geometry(img):
+    """
+    Physical grid description of an ANTs or SimpleITK image.
+
+    Returns:
+        dict with origin, spacing, direction (3x3 ndarray), shape (X,Y,Z)
+    """
+    if isinstance(img, dict):
+        return img
+    if isinstance(img, sitk.Image):
+        dim = img.GetDimension()
+        return {
+            'origin': np.array(img.GetOrigin(), dtype=np.float64),
+            'spacing': np.array(img.GetSpacing(), dtype=np.float64),
+            'direction': np.array(img.GetDirection(), dtype=np.float64).reshape(dim, dim),
+            'shape': tuple(img.GetSize())
+        }
+    return {
+        'origin': np.array(img.origin, dtype=np.float64),
+        'spacing': np.array(img.spacing, dtype=np.float64),
+        'direction': np.array(img.direction, dtype=np.float64),
+        'shape': tuple(img.shape)
+    }
+
+def read_geometry(path):
+    """Read grid geometry from an image header without loading voxels."""
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(str(path))
+    reader.ReadImageInformation()
+    dim = reader.GetDimension()
+    return {
+        'origin': np.array(reader.GetOrigin(), dtype=np.float64),
+        'spacing': np.array(reader.GetSpacing(), dtype=np.float64),
+        'direction': np.array(reader.GetDirection(), dtype=np.float64).reshape(dim, dim),
+        'shape': tuple(reader.GetSize())
+    }
+
+def _n_components(img):
+    if isinstance(img, sitk.Image):
+        return img.GetNumberOfComponentsPerPixel()
+    return img.components
+
+def to_numpy(img, order="xyz", copy=False):
+    """
+    Voxel array of an ANTs or SimpleITK image.
+
+    Args:
+        img: ants.ANTsImage or sitk.Image
+        order: "xyz" (ANTs) or "zyx" (SimpleITK) spatial axis order
+        copy: return an independent array instead of a view
+
+    Returns:
+        ndarray with components (if any) on the last axis. Without copy the
+        array is a view into the image buffer and must not outlive it.
+    """
+    if order not in ("xyz", "zyx"):
+        raise ValueError(f"Unknown axis order: {order}")
+    vector = _n_components(img) > 1
+
+    if isinstance(img, sitk.Image):
+        arr = sitk.GetArrayViewFromImage(img)  # (Z,Y,X[,C])
+        if order == "xyz":
+            arr = arr.transpose(2, 1, 0, 3) if vector else arr.T
+    else:
+        arr = img.view()  # (C,X,Y,Z) or (X,Y,Z), Fortran-contiguous
+        if order == "xyz":
+            arr = arr.transpose(1, 2, 3, 0) if vector else arr
+        else:
+            arr = arr.T  # (Z,Y,X[,C]), C-contiguous
+
+    return np.array(arr) if copy else arr
+
+def to_sitk(src, like=None, order="xyz"):
+    """
+    Build a SimpleITK image from an ANTs image or an array.
+
+    Args:
+        src: ants.ANTsImage, sitk.Image or ndarray (components on last axis)
+        like: image or geometry dict supplying origin/spacing/direction
+              (required for arrays)
+        order: axis order of an array src
+
+    Returns:
+        sitk.Image (vector image if src has components)
+    """
+    if isinstance(src, sitk.Image):
+        return src
+    if isinstance(src, np.ndarray):
+        if like is None:
+            raise ValueError("Array input needs a reference geometry (like=)")
+        geom = geometry(like)
+        arr = src
+        vector = arr.ndim == 4
+    else:
+        geom = geometry(src)
+        vector = src.components > 1
+        arr = to_numpy(src, order="zyx")
+        order = "zyx"
+
+    if order == "xyz":
+        arr = arr.transpose(2, 1, 0, 3) if vector else arr.T
+
+    out = sitk.GetImageFromArray(np.ascontiguousarray(arr), isVector=vector)
+    out.SetOrigin(tuple(float(v) for v in geom['origin']))
+    out.SetSpacing(tuple(float(v) for v in geom['spacing']))
+    out.SetDirection(tuple(float(v) for v in np.asarray(geom['direction']).ravel()))
+    return out
+
+def to_ants(src, like=None, order="xyz"):
+    """
+    Build an ANTs image from a SimpleITK image or an array.
+
+    Args:
+        src: sitk.Image, ants.ANTsImage or ndarray (components on last axis)
+        like: image or geometry dict supplying origin/spacing/direction
+              (required for arrays)
+        order: axis order of an array src
+
+    Returns:
+        ants.ANTsImage (multi-component if src has components)
+    """
+    if isinstance(src, ants.ANTsImage):
+        return src
+    if isinstance(src, sitk.Image):
+        geom = geometry(src)
+        arr = to_numpy(src, order="xyz")
+        vector = src.GetNumberOfComponentsPerPixel() > 1
+    else:
+        if like is None:
+            raise ValueError("Array input needs a reference geometry (like=)")
+        geom = geometry(like)
+        arr = src
+        vector = arr.ndim == 4
+        if order == "zyx":
+            arr = arr.transpose(2, 1, 0, 3) if vector else arr.T
+
+    return ants.from_numpy(
+        arr,
+        origin=tuple(float(v) for v in geom['origin']),
+        spacing=tuple(float(v) for v in geom['spacing']),
+        direction=np.asarray(geom['direction'], dtype=np.float64),
+        has_components=vector
+    )
@@ -0,0 +1,135 @@
+"""
+Grid-keyed cache of resampled masks and flat voxel indices
+
+A mask resampled to a target grid is computed once per
+(mask file content, target geometry, resampling rule) and kept in memory
+and on disk (CACHE_DIR). Every script that asks for the same mask on the
+same grid with the same rule gets the same voxels, without resampling.
+
+Rules:
+    'nearest': nearest-neighbour apply_transforms, > 0 (PCA model grid,
+               run_pca_dvf.py convention)
+    'linear':  linear resampling of the float mask, > 0.5 (QC metrics convention)
+
+A mask that comes out empty on the target grid raises ValueError and is
+never cached.
+
+Masks are (X,Y,Z) bool arrays; indices are flat (X,Y,Z) C-order indices
+(the run_pca_dvf / pca_model convention).
+"""
+
+import hashlib
+import os
+import threading
+from pathlib import Path
+
+import ants
+import numpy as np
+
+from hashing import file_digest
+from image_bridge import geometry, read_geometry, to_ants
+
+CACHE_DIR = Path("results/cache/masks")
+RULES = ('nearest', 'linear')
+CACHE_VERSION = 2   # v1 'linear' entries were resampled from uint8 (empty)
+
+_MEMORY = {}
+_LOCK = threading.Lock()
+
+def target_geometry(target):
+    """Geometry dict (with shape) of a path, image, field dict or geometry dict."""
+    if isinstance(target, (str, Path)):
+        return read_geometry(target)
+    if isinstance(target, dict) and 'geom' in target:
+        return target['geom']
+    return geometry(target)
+
+def grid_key(geom):
+    """Stable digest of a grid: shape, origin, spacing, direction (rounded to 1e-6)."""
+    parts = [np.asarray(geom['shape'], dtype=np.int64).tobytes()]
+    for k in ('origin', 'spacing', 'direction'):
+        # + 0.0 folds -0.0 (SimpleITK headers) into 0.0 (ANTs)
+        parts.append((np.round(np.asarray(geom[k], dtype=np.float64), 6) + 0.0).tobytes())
+    return hashlib.sha256(b''.join(parts)).hexdigest()[:16]
+
+def cache_key(mask_path, target, rule='nearest'):
+    """Cache key for a (mask content, target grid, rule) triple."""
+    if rule not in RULES:
+        raise ValueError(f"Unknown mask resampling rule: {rule} (expected one of {RULES})")
+    return f"{file_digest(mask_path)[:16]}_{grid_key(target_geometry(target))}_{rule}_v{CACHE_VERSION}"
+
+def _resample(mask_path, geom, rule):
+    ref = to_ants(np.zeros(tuple(geom['shape']), dtype=np.float32), like=geom)
+    mask = ants.image_read(str(mask_path))
+    if rule == 'nearest':
+        out = ants.apply_transforms(fixed=ref, moving=mask.clone('unsigned char'), transformlist=[],
+                                    interpolator='nearestNeighbor')
+        return out.numpy() > 0
+    # Linear resampling of a uint8 image returns all zeros in ANTsPy: use float
+    out = ants.resample_image_to_target(mask.clone('float'), ref, interp_type=1)
+    return out.numpy() > 0.5
+
+def _save_atomic(path, arr):
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, 'wb') as f:
+        np.save(f, arr)
+    os.replace(tmp, path)
+
+def _load(mask_path, target, rule, cache_dir):
+    key = cache_key(mask_path, target, rule)
+    with _LOCK:
+        entry = _MEMORY.get(key)
+    if entry is not None:
+        return entry
+
+    mask_file = cache_dir / f"{key}_mask.npy" if cache_dir is not None else None
+    idx_file = cache_dir / f"{key}_idx.npy" if cache_dir is not None else None
+    if mask_file is not None and mask_file.exists() and idx_file.exists():
+        mask = np.load(mask_file)
+        idx = np.load(idx_file, mmap_mode='r')
+    else:
+        mask = _resample(mask_path, target_geometry(target), rule)
+        idx = np.flatnonzero(mask.ravel())
+        if idx.size == 0:
+            raise ValueError(f"Mask {mask_path} is empty after '{rule}' resampling to the target grid")
+        if cache_dir is not None:
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            _save_atomic(mask_file, mask)
+            _save_atomic(idx_file, idx)
+    mask.flags.writeable = False
+    if not isinstance(idx, np.memmap):
+        idx.flags.writeable = False
+    entry = {'mask': mask, 'idx': idx}
+    with _LOCK:
+        _MEMORY[key] = entry
+    return entry
+
+def resampled_mask(mask_path, target, rule='nearest', cache_dir=CACHE_DIR):
+    """
+    Mask resampled to a target grid (cached).
+
+    Args:
+        mask_path: mask NIfTI
+        target: path, ANTs/SimpleITK image, field dict or geometry dict
+        rule: 'nearest' or 'linear' (see module docstring)
+        cache_dir: on-disk cache (None: memory only)
+
+    Returns:
+        (X,Y,Z) bool array (read-only)
+    """
+    return _load(mask_path, target, rule, None if cache_dir is None else Path(cache_dir))['mask']
+
+def mask_indices(mask_path, target, rule='nearest', cache_dir=CACHE_DIR):
+    """
+    Flat (X,Y,Z) C-order indices of the resampled mask (cached).
+
+    Returns:
+        (idx int64 array (read-only), vol_shape (X,Y,Z))
+    """
+    entry = _load(mask_path, target, rule, None if cache_dir is None else Path(cache_dir))
+    return entry['idx'], entry['mask'].shape
+
+def clear_memory():
+    """Drop the in-memory cache (the disk cache is kept)."""
+    with _LOCK:
+        _MEMORY.clear()
@@ -0,0 +1,64 @@
+"""
+Process-pool helpers with per-worker ITK thread budgets
+
+ITK (and therefore ANTs and SimpleITK) reads its default thread count once,
+when the library is first loaded. Workers are therefore started with the
+"spawn" method and the thread budget is placed in the environment before
+any imaging library is imported in the child.
+"""
+
+import os
+import sys
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+
+THREAD_ENV_VARS = (
+    "ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS",
+    "OMP_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "MKL_NUM_THREADS",
+)
+
+def available_cores():
+    """Number of cores this process may run on."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+def thread_budget(n_workers, n_cores=None):
+    """Split the available cores evenly across n_workers (at least 1 each)."""
+    n_cores = n_cores or available_cores()
+    return max(1, n_cores // max(1, n_workers))
+
+def set_thread_budget(n_threads):
+    """Pin ITK/BLAS thread pools of the current process to n_threads."""
+    for var in THREAD_ENV_VARS:
+        os.environ[var] = str(n_threads)
+    # Already-loaded SimpleITK does not re-read the environment
+    if "SimpleITK" in sys.modules:
+        sys.modules["SimpleITK"].ProcessObject.SetGlobalDefaultNumberOfThreads(n_threads)
+
+def _init_worker(n_threads, initializer, initargs):
+    set_thread_budget(n_threads)
+    if initializer is not None:
+        initializer(*initargs)
+
+def make_process_pool(n_workers, threads_per_worker=None, initializer=None, initargs=()):
+    """
+    ProcessPoolExecutor whose workers each get an ITK thread budget.
+
+    Args:
+        n_workers: number of worker processes
+        threads_per_worker: ITK/BLAS threads per worker
+                            (default: cores split evenly across workers)
+        initializer, initargs: extra per-worker setup, run after the budget is set
+    """
+    if threads_per_worker is None:
+        threads_per_worker = thread_budget(n_workers)
+    return ProcessPoolExecutor(
+        max_workers=n_workers,
+        mp_context=mp.get_context("spawn"),
+        initializer=_init_worker,
+        initargs=(threads_per_worker, initializer, initargs)
+    )
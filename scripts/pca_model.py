@@ -0,0 +1,233 @@
+"""
+PCA breathing-motion model: storage, loading and synthesis
+
+The model is stored by run_pca_dvf.py as one memory-mappable file
+(pca_model.bin); pc_mean / pc_k NIfTIs are written only for viewing.
+Loading maps the masked arrays straight from the page cache, so any
+breathing state can be synthesized without decompressing volumes:
+
+    u(beta) = mu + U @ (beta * scale),   scale_k = S_k / sqrt(N - 1)
+
+beta is in SD units (as in compute_sample_betas.py); missing trailing modes
+are zero.
+
+Model dict:
+    mu: (P,) float32, P = 3 * |mask|
+    U: (P, K) float32
+    S, scale, var_ratio: (K,)
+    idx: flat mask indices into the (X,Y,Z) C-order volume (run_pca_dvf convention)
+    vol_shape: (X, Y, Z)
+    geom: grid geometry (image_bridge.geometry)
+    n_samples: number of DVFs the model was built from
+    samples: names of those DVFs
+
+File layout (little endian):
+    8 bytes   magic b"DVFPCA01"
+    8 bytes   uint64 header length
+    header    UTF-8 JSON: sizes, S, variance ratios, geometry, samples and
+              per-array dtype/shape/offset
+    arrays    idx (int64), mu (P,) float32, Ut (K, P) float32, S, var_ratio
+              (float64), each starting on a 64-byte boundary
+"""
+
+import json
+import os
+from pathlib import Path
+
+import ants
+import numpy as np
+
+from dvf_ops import make_field
+from image_bridge import geometry
+from mask_cache import resampled_mask
+
+DEFAULT_PCA_DIR = Path("results/pca")
+DEFAULT_MASK = Path("data/preprocessed/popi_ants/phase50_lung_mask.nii.gz")
+MODEL_FILE = "pca_model.bin"
+MAGIC = b"DVFPCA01"
+_ALIGN = 64
+
+def _geom_json(geom):
+    return {
+        'origin': np.asarray(geom['origin'], dtype=np.float64).tolist(),
+        'spacing': np.asarray(geom['spacing'], dtype=np.float64).tolist(),
+        'direction': np.asarray(geom['direction'], dtype=np.float64).tolist(),
+        'shape': [int(v) for v in geom['shape']]
+    }
+
+def save_model_file(path, mu, U, S, var_ratio, n_samples, idx, vol_shape, geom, samples=None):
+    """
+    Write the single-file model (atomically, via a temporary file).
+
+    Args:
+        mu: (P,), U: (P, K), S / var_ratio: (K,) (longer inputs are cut to K)
+        idx: flat mask indices into the (X,Y,Z) C-order volume
+        geom: geometry of the model grid
+    """
+    K = U.shape[1]
+    arrays = {
+        'idx': np.ascontiguousarray(idx, dtype=np.int64),
+        'mu': np.ascontiguousarray(mu, dtype=np.float32),
+        'Ut': np.ascontiguousarray(np.asarray(U, dtype=np.float32).T),
+        'S': np.asarray(S[:K], dtype=np.float64),
+        'var_ratio': np.asarray(var_ratio[:K], dtype=np.float64)
+    }
+    header = {
+        'version': 1,
+        'n_samples': int(n_samples),
+        'n_components': int(K),
+        'P': int(arrays['mu'].size),
+        'vol_shape': [int(v) for v in vol_shape],
+        'geometry': _geom_json(geom),
+        'singular_values': arrays['S'].tolist(),
+        'variance_explained': arrays['var_ratio'].tolist(),
+        'samples': list(samples or []),
+        'arrays': {}
+    }
+
+    # Offsets depend on the header length: grow the reserve until it fits
+    reserve = 4096
+    while True:
+        offset = reserve
+        for name, a in arrays.items():
+            header['arrays'][name] = {'dtype': a.dtype.str, 'shape': list(a.shape), 'offset': offset}
+            offset += -(-a.nbytes // _ALIGN) * _ALIGN
+        blob = json.dumps(header).encode()
+        if 16 + len(blob) <= reserve:
+            break
+        reserve = -(-(16 + len(blob)) // _ALIGN) * _ALIGN
+
+    path = Path(path)
+    tmp = path.with_name(f".{path.name}.tmp")
+    with open(tmp, 'wb') as f:
+        f.write(MAGIC)
+        f.write(np.uint64(len(blob)).tobytes())
+        f.write(blob)
+        for name, a in arrays.items():
+            f.seek(header['arrays'][name]['offset'])
+            f.write(a.tobytes())
+        f.truncate(offset)
+    os.replace(tmp, path)
+
+def read_model_header(path):
+    """JSON header of a model file."""
+    with open(path, 'rb') as f:
+        if f.read(8) != MAGIC:
+            raise ValueError(f"Not a PCA model file: {path}")
+        n = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+        return json.loads(f.read(n))
+
+def load_model_file(path, n_components=None, mmap=True):
+    """
+    Load the single-file model; arrays are read-only memory maps unless mmap=False.
+
+    Returns:
+        model dict (see module docstring)
+    """
+    header = read_model_header(path)
+    raw = np.memmap(path, dtype=np.uint8, mode='r') if mmap else np.fromfile(path, dtype=np.uint8)
+
+    def array(name):
+        spec = header['arrays'][name]
+        dt = np.dtype(spec['dtype'])
+        count = int(np.prod(spec['shape']))
+        a = raw[spec['offset']:spec['offset'] + count * dt.itemsize].view(dt)
+        return a.reshape(spec['shape'])
+
+    K = header['n_components'] if n_components is None else min(n_components, header['n_components'])
+    S = np.array(array('S')[:K])
+    n_samples = header['n_samples']
+    geom = header['geometry']
+    return {
+        'mu': array('mu'),
+        'U': array('Ut')[:K].T,
+        'S': S,
+        'scale': (S / np.sqrt(max(1, n_samples - 1))).astype(np.float32),
+        'var_ratio': np.array(array('var_ratio')[:K]),
+        'idx': array('idx'),
+        'vol_shape': tuple(header['vol_shape']),
+        'geom': {'origin': np.array(geom['origin']), 'spacing': np.array(geom['spacing']),
+                 'direction': np.array(geom['direction']), 'shape': tuple(geom['shape'])},
+        'n_samples': n_samples,
+        'samples': header['samples']
+    }
+
+def model_mask(mask_path, like_img):
+    """Lung mask resampled (nearest) to the model grid, as in run_pca_dvf.py (cached)."""
+    return resampled_mask(mask_path, like_img, rule='nearest')
+
+def load_pca_model(pca_dir=DEFAULT_PCA_DIR, mask_path=DEFAULT_MASK, n_components=None):
+    """
+    Load the model from pca_dir: the single-file model when present,
+    otherwise the NIfTI export (models saved before the file format).
+
+    Args:
+        pca_dir: directory written by run_pca_dvf.py
+        mask_path: lung mask used to build the model (NIfTI fallback only)
+        n_components: keep only the first K modes (default: all)
+
+    Returns:
+        model dict (see module docstring)
+    """
+    model_file = Path(pca_dir) / MODEL_FILE
+    if model_file.exists():
+        return load_model_file(model_file, n_components=n_components)
+    return load_pca_model_nifti(pca_dir, mask_path, n_components=n_components)
+
+def load_pca_model_nifti(pca_dir=DEFAULT_PCA_DIR, mask_path=DEFAULT_MASK, n_components=None):
+    """Mean field and principal components from pc_mean / pc_k NIfTIs and pca_meta.json."""
+    pca_dir = Path(pca_dir)
+    with open(pca_dir / "pca_meta.json") as f:
+        meta = json.load(f)
+    K = meta['n_components'] if n_components is None else min(n_components, meta['n_components'])
+
+    mean_img = ants.image_read(str(pca_dir / "pc_mean.nii.gz"))
+    mask = model_mask(mask_path, mean_img)
+    idx = np.flatnonzero(mask.ravel())
+
+    def masked(img):
+        return img.numpy().astype(np.float32).reshape(-1, 3)[idx].reshape(-1)
+
+    mu = masked(mean_img)
+    U = np.empty((mu.size, K), dtype=np.float32)
+    for k in range(K):
+        U[:, k] = masked(ants.image_read(str(pca_dir / f"pc_{k+1}.nii.gz")))
+
+    S = np.array(meta['singular_values'][:K], dtype=np.float64)
+    n_samples = int(meta['n_samples'])
+    return {
+        'mu': mu,
+        'U': U,
+        'S': S,
+        'scale': (S / np.sqrt(max(1, n_samples - 1))).astype(np.float32),
+        'var_ratio': np.array(meta['variance_explained'][:K]),
+        'idx': idx,
+        'vol_shape': tuple(mask.shape),
+        'geom': dict(geometry(mean_img)),
+        'n_samples': n_samples,
+        'samples': meta.get('samples', [])
+    }
+
+def synthesize(model, beta):
+    """
+    Masked displacement vector for a beta vector (SD units).
+
+    Returns:
+        (P,) float32
+    """
+    beta = np.atleast_1d(np.asarray(beta, dtype=np.float32))
+    K = model['U'].shape[1]
+    if beta.size > K:
+        raise ValueError(f"beta has {beta.size} modes, model has {K}")
+    k = beta.size
+    return model['mu'] + model['U'][:, :k] @ (beta * model['scale'][:k])
+
+def unpack_field(model, vec):
+    """Masked (P,) vector -> (X,Y,Z,3) float32 array, zero outside the mask."""
+    out = np.zeros((int(np.prod(model['vol_shape'])), 3), dtype=np.float32)
+    out[model['idx']] = np.asarray(vec, dtype=np.float32).reshape(-1, 3)
+    return out.reshape(*model['vol_shape'], 3)
+
+def synthesize_field(model, beta):
+    """Synthesized DVF as a dvf_ops field dict on the model grid."""
+    return make_field(unpack_field(model, synthesize(model, beta)), model['geom'])
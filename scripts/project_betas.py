@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""
+Phase 3: Batched Beta Projection
+Places any number of DVFs in the PCA motion space:
+
+    beta = U^T (x - mu) / scale      (SD units, scale_k = S_k / sqrt(N-1))
+
+Inputs are a list or stream of DVF paths and/or (X,Y,Z,3) arrays. Paths are
+decoded and masked by a process pool (only the masked vector travels back),
+and projections are accumulated in chunks of samples, so memory stays at
+chunk * P floats however many fields are projected.
+"""
+
+import csv
+import os
+import tempfile
+from collections import deque
+from pathlib import Path
+
+import numpy as np
+import SimpleITK as sitk
+
+from image_bridge import read_geometry, to_numpy
+from parallel import available_cores, make_process_pool
+from pca_model import load_pca_model
+
+_IDX_CACHE = {}
+
+def zyx_indices(idx, vol_shape):
+    """
+    Model mask indices ((X,Y,Z) C-order) as flat indices into the (Z,Y,X)
+    buffer of a SimpleITK image, so masking gathers straight from the
+    reader's buffer without reordering the volume.
+    """
+    x, y, z = np.unravel_index(idx, vol_shape)
+    return np.ravel_multi_index((z, y, x), tuple(vol_shape[::-1]))
+
+def masked_vector(item, idx, vol_shape):
+    """(X,Y,Z,3) array -> masked (P,) float32 vector in model order."""
+    arr = np.asarray(item)
+    if arr.shape[:3] != tuple(vol_shape):
+        raise ValueError(f"DVF grid {arr.shape[:3]} does not match model grid {tuple(vol_shape)}")
+    return arr.reshape(-1, 3)[idx].reshape(-1).astype(np.float32, copy=False)
+
+def check_grid(geom, model_geom, name="DVF"):
+    """
+    Raise ValueError unless a grid matches the model grid (size exactly;
+    spacing, origin and direction to 1e-4), so mask indices gather the
+    voxels the model was built from.
+    """
+    if tuple(geom['shape']) != tuple(model_geom['shape']):
+        raise ValueError(f"{name} grid size {tuple(geom['shape'])} does not match "
+                         f"model grid {tuple(model_geom['shape'])}")
+    for k in ('spacing', 'origin', 'direction'):
+        a = np.asarray(geom[k], dtype=np.float64)
+        b = np.asarray(model_geom[k], dtype=np.float64)
+        if not np.allclose(a, b, rtol=0.0, atol=1e-4):
+            raise ValueError(f"{name} grid {k} {a.ravel().tolist()} does not match "
+                             f"model grid {k} {b.ravel().tolist()}")
+
+def _decode_path(path, idx_file, model_geom):
+    """Worker: read a DVF file on the model grid and return its masked (P,) vector."""
+    check_grid(read_geometry(path), model_geom, name=f"DVF {path}")
+    if idx_file not in _IDX_CACHE:
+        _IDX_CACHE[idx_file] = np.load(idx_file, mmap_mode='r')
+    idx_zyx = _IDX_CACHE[idx_file]
+    img = sitk.ReadImage(str(path), sitk.sitkVectorFloat32)
+    if img.GetNumberOfComponentsPerPixel() != 3:
+        raise ValueError(f"DVF {path} has {img.GetNumberOfComponentsPerPixel()} components, expected 3")
+    flat = to_numpy(img, order="zyx").reshape(-1, 3)
+    return np.ascontiguousarray(flat[idx_zyx]).reshape(-1)
+
+def iter_masked(model, items, n_workers=None, prefetch=2):
+    """
+    Yield masked (P,) vectors for items in order.
+
+    Args:
+        items: iterable of DVF paths or (X,Y,Z,3) arrays on the model grid
+        n_workers: decoding processes (default: all cores; 1 = in-process)
+        prefetch: in-flight decodes per worker
+    """
+    n_workers = n_workers or available_cores()
+    vol_shape = model['vol_shape']
+    with tempfile.TemporaryDirectory() as tmp:
+        idx_file = os.path.join(tmp, "idx_zyx.npy")
+        np.save(idx_file, zyx_indices(model['idx'], vol_shape))
+
+        if n_workers == 1:
+            for item in items:
+                if isinstance(item, (str, Path)):
+                    yield _decode_path(item, idx_file, model['geom'])
+                else:
+                    yield masked_vector(item, model['idx'], vol_shape)
+            _IDX_CACHE.pop(idx_file, None)
+            return
+
+        # Bounded window of futures keeps output order and caps memory
+        with make_process_pool(n_workers, threads_per_worker=1) as pool:
+            pending = deque()
+            for item in items:
+                if isinstance(item, (str, Path)):
+                    pending.append(pool.submit(_decode_path, str(item), idx_file, model['geom']))
+                else:
+                    pending.append(masked_vector(item, model['idx'], vol_shape))
+                if len(pending) >= n_workers * prefetch:
+                    head = pending.popleft()
+                    yield head if isinstance(head, np.ndarray) else head.result()
+            while pending:
+                head = pending.popleft()
+                yield head if isinstance(head, np.ndarray) else head.result()
+
+def iter_beta_chunks(model, items, chunk=32, n_workers=None, sd_units=True):
+    """
+    Yield (K, c) beta blocks, one per chunk of c <= chunk samples.
+    """
+    mu = np.asarray(model['mu'])
+    Ut = np.ascontiguousarray(np.asarray(model['U']).T)  # (K, P)
+    scale = np.asarray(model['scale'], dtype=np.float64)
+    block = np.empty((mu.size, chunk), dtype=np.float32)
+    n = 0
+    for x in iter_masked(model, items, n_workers=n_workers):
+        np.subtract(x, mu, out=block[:, n])
+        n += 1
+        if n == chunk:
+            alphas = (Ut @ block).astype(np.float64)
+            yield alphas / (scale[:, None] + 1e-8) if sd_units else alphas
+            n = 0
+    if n:
+        alphas = (Ut @ block[:, :n]).astype(np.float64)
+        yield alphas / (scale[:, None] + 1e-8) if sd_units else alphas
+
+def project_betas(model, items, chunk=32, n_workers=None, sd_units=True):
+    """
+    Betas for a list or stream of DVFs.
+
+    Args:
+        model: PCA model (pca_model.load_pca_model)
+        items: DVF paths and/or (X,Y,Z,3) arrays on the model grid
+        chunk: samples per projection GEMM
+        n_workers: decoding processes
+        sd_units: divide by the per-mode SD (False: raw coefficients in mm)
+
+    Returns:
+        betas: (K, N) float64
+    """
+    blocks = list(iter_beta_chunks(model, items, chunk=chunk, n_workers=n_workers, sd_units=sd_units))
+    K = model['U'].shape[1]
+    return np.concatenate(blocks, axis=1) if blocks else np.zeros((K, 0))
+
+def main():
+    print("="*70)
+    print("Phase 3: Batched Beta Projection")
+    print("="*70)
+
+    pca_dir = Path("results/pca")
+    dvf_dir = Path("results/popi_ants_roi")
+
+    print("\n1. Loading PCA model...")
+    model = load_pca_model(pca_dir)
+    K = model['U'].shape[1]
+    print(f"   Modes: {K}, mask voxels: {model['idx'].size}")
+
+    dvfs = sorted(dvf_dir.glob("dvf_*_to_50_FINAL.nii.gz"))
+    print(f"\n2. Projecting {len(dvfs)} DVF(s)...")
+    betas = project_betas(model, dvfs)
+
+    out_csv = pca_dir / "projected_betas.csv"
+    with open(out_csv, 'w', newline='') as f:
+        w = csv.writer(f)
+        w.writerow(["dvf"] + [f"beta_pc{k+1}_sd" for k in range(K)])
+        for i, p in enumerate(dvfs):
+            w.writerow([p.name] + [f"{b:.6f}" for b in betas[:, i]])
+            print(f"   {p.name:32s} " + "  ".join(f"{b:7.3f}" for b in betas[:, i]))
+
+    print(f"\n[OK] Saved: {out_csv}")
+    print("="*70)
+
+if __name__ == "__main__":
+    main()
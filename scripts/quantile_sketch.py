@@ -0,0 +1,207 @@
+"""
+Mergeable fixed-bin quantile sketch for streaming QC statistics
+
+A sketch is a histogram over [lo, hi) with n_bins equal bins. Underflow
+and overflow counts are kept separately, together with the exact count,
+sum, min and max. Values are added slab by slab; sketches with the same
+binning merge by adding counts, so slab, worker, DVF and cohort
+statistics all come from the same object without keeping raw voxels.
+
+Error bound: count, mean, min and max are exact. quantile(q) returns a
+value inside the bin that holds the value of rank q (N - 1), so its rank
+error is at most that bin's count. This is not a bound on the value: where
+the data are dense the result is within about one bin width of
+np.percentile, but on sparse data np.percentile interpolates between
+far-apart samples, and the two can differ by much more. Quantiles that fall
+in the under/overflow tails are only bounded by [min, lo] or [hi, max], so
+ranges are chosen to cover the data (QC_RANGES).
+
+Counts below the metric's pivots (QC_PIVOTS, e.g. det < 0 for the
+Jacobian) are kept exactly, from the values as given, so fraction_below at
+a pivot is exact rather than a histogram estimate.
+"""
+
+import numpy as np
+
+# (lo, hi, n_bins) per QC metric: resolution 0.001 mm / 0.0005 or better
+QC_RANGES = {
+    'magnitude': (0.0, 100.0, 100000),
+    'jacobian': (-2.0, 4.0, 12000),
+    'ic': (0.0, 50.0, 50000),
+    'curl': (0.0, 4.0, 8000),
+    'divergence': (-4.0, 4.0, 16000),
+}
+
+# Thresholds with an exact "values < pivot" count per QC metric
+QC_PIVOTS = {
+    'jacobian': (0.0,),
+}
+
+class QuantileSketch:
+    """Fixed-bin histogram sketch with exact count/sum/min/max and pivot counts."""
+
+    def __init__(self, lo, hi, n_bins=10000, pivots=()):
+        if not hi > lo or n_bins < 1:
+            raise ValueError(f"Invalid sketch range [{lo}, {hi}) with {n_bins} bins")
+        self.lo = float(lo)
+        self.hi = float(hi)
+        self.n_bins = int(n_bins)
+        self.counts = np.zeros(self.n_bins, dtype=np.int64)
+        self.pivots = tuple(float(p) for p in pivots)
+        self.below = np.zeros(len(self.pivots), dtype=np.int64)
+        self.under = 0
+        self.over = 0
+        self.count = 0
+        self.sum = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+
+    @classmethod
+    def for_metric(cls, name):
+        """Sketch with the standard QC_RANGES binning for a metric."""
+        return cls(*QC_RANGES[name], pivots=QC_PIVOTS.get(name, ()))
+
+    @property
+    def resolution(self):
+        """Bin width."""
+        return (self.hi - self.lo) / self.n_bins
+
+    def add(self, values):
+        """Add an array of values (NaNs are ignored). Returns self."""
+        v = np.asarray(values).reshape(-1)
+        v = v[np.isfinite(v)]
+        if v.size == 0:
+            return self
+        for i, p in enumerate(self.pivots):
+            self.below[i] += int(np.count_nonzero(v < p))
+        # float64 so values next to a bin edge (e.g. -1e-9 at 0) are not
+        # rounded onto it, as (v - lo) would be in float32
+        b = np.floor((v.astype(np.float64) - self.lo) * (self.n_bins / (self.hi - self.lo)))
+        under = b < 0
+        over = b >= self.n_bins
+        self.under += int(under.sum())
+        self.over += int(over.sum())
+        inside = ~(under | over)
+        self.counts += np.bincount(b[inside].astype(np.int64), minlength=self.n_bins)
+        self.count += int(v.size)
+        self.sum += float(v.sum(dtype=np.float64))
+        self.min = min(self.min, float(v.min()))
+        self.max = max(self.max, float(v.max()))
+        return self
+
+    def merge(self, other):
+        """Add another sketch with identical binning into this one. Returns self."""
+        if (self.lo, self.hi, self.n_bins, self.pivots) != (other.lo, other.hi, other.n_bins, other.pivots):
+            raise ValueError("Cannot merge sketches with different binning")
+        self.counts += other.counts
+        self.below += other.below
+        self.under += other.under
+        self.over += other.over
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else float('nan')
+
+    def quantile(self, q):
+        """
+        Approximate np.percentile(values, 100 q) (linear definition).
+
+        Args:
+            q: scalar or array in [0, 1]
+
+        Returns:
+            float or array of floats
+        """
+        if self.count == 0:
+            return np.full(np.shape(q), np.nan)[()]
+        q = np.asarray(q, dtype=np.float64)
+        rank = q * (self.count - 1)
+        # Cumulative counts over under | bins | over
+        cum = np.cumsum(np.concatenate([[self.under], self.counts, [self.over]]))
+        k = np.searchsorted(cum, rank, side='right')
+        before = np.where(k > 0, cum[np.maximum(k - 1, 0)], 0)
+        n_in = np.maximum(cum[np.minimum(k, cum.size - 1)] - before, 1)
+        frac = np.clip((rank - before + 0.5) / n_in, 0.0, 1.0)
+
+        w = self.resolution
+        lo_edge = np.where(k == 0, self.min, self.lo + (k - 1) * w)
+        hi_edge = np.where(k == 0, self.lo,
+                           np.where(k > self.n_bins, self.max, self.lo + k * w))
+        lo_edge = np.where(k > self.n_bins, self.hi, lo_edge)
+        out = np.clip(lo_edge + frac * (hi_edge - lo_edge), self.min, self.max)
+        return out[()] if out.ndim == 0 else out
+
+    def percentile(self, p):
+        """quantile(p / 100)."""
+        return self.quantile(np.asarray(p, dtype=np.float64) / 100.0)
+
+    def fraction_below(self, x):
+        """
+        Fraction of values < x. Exact when x is a pivot; otherwise, for
+        lo <= x <= hi, counted from the histogram with the partial bin
+        interpolated.
+        """
+        if self.count == 0:
+            return float('nan')
+        if float(x) in self.pivots:
+            return float(self.below[self.pivots.index(float(x))]) / self.count
+        if not self.lo <= x <= self.hi:
+            raise ValueError(f"{x} is outside the sketch range [{self.lo}, {self.hi}]")
+        k = (x - self.lo) * (self.n_bins / (self.hi - self.lo))
+        i = int(np.floor(k + 1e-9))
+        n = self.under + float(self.counts[:i].sum())
+        if k - i > 1e-9 and i < self.n_bins:
+            n += (k - i) * float(self.counts[i])
+        return n / self.count
+
+    def summary(self, percentiles=(1, 50, 75, 95, 99)):
+        """
+        One-pass summary.
+
+        Returns:
+            dict: p01, p50, ... (one key per percentile), mean, min, max, count
+        """
+        vals = np.atleast_1d(self.percentile(percentiles))
+        out = {f"p{int(p):02d}": float(v) for p, v in zip(percentiles, vals)}
+        out.update({'mean': float(self.mean), 'min': float(self.min),
+                    'max': float(self.max), 'count': int(self.count)})
+        return out
+
+    def to_dict(self):
+        """JSON-serializable state (sparse bin counts)."""
+        nz = np.flatnonzero(self.counts)
+        return {
+            'lo': self.lo, 'hi': self.hi, 'n_bins': self.n_bins,
+            'pivots': list(self.pivots), 'below': self.below.tolist(),
+            'bins': nz.tolist(), 'counts': self.counts[nz].tolist(),
+            'under': self.under, 'over': self.over, 'count': self.count,
+            'sum': self.sum, 'min': self.min, 'max': self.max
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        s = cls(d['lo'], d['hi'], d['n_bins'], pivots=d.get('pivots', ()))
+        s.below[:] = d.get('below', [])
+        s.counts[np.asarray(d['bins'], dtype=np.int64)] = np.asarray(d['counts'], dtype=np.int64)
+        s.under, s.over, s.count = d['under'], d['over'], d['count']
+        s.sum, s.min, s.max = d['sum'], d['min'], d['max']
+        return s
+
+def sketch_values(values, name=None, lo=None, hi=None, n_bins=10000):
+    """Sketch of an array, with QC_RANGES binning for a named metric."""
+    s = QuantileSketch.for_metric(name) if name is not None else QuantileSketch(lo, hi, n_bins)
+    return s.add(values)
+
+def merge_sketches(sketches):
+    """Merge an iterable of sketches into a new one (None if empty)."""
+    out = None
+    for s in sketches:
+        if out is None:
+            out = QuantileSketch(s.lo, s.hi, s.n_bins, pivots=s.pivots)
+        out.merge(s)
+    return out
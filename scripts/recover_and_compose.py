@@ -1,44 +1,44 @@
-"""Recover correct Forward Warps and compose cascade using SimpleITK"""
+"""Recover correct Forward Warps (from registration artifacts) and compose cascade natively"""
 import sys
 sys.path.insert(0, 'scripts')
 from compute_phase70_qc import load_popi_landmarks, compute_tre_ants
+from registration_artifacts import read_stage_file
+from dvf_ops import compose_dvf_files
 from pathlib import Path
-import os
-import glob
-import time
-import SimpleITK as sitk
-import numpy as np
+import shutil
 
-def find_forward_warp(timewindow_start, timewindow_end):
-    """Find *InverseWarp.nii.gz in TEMP within time window (Empirically correct)"""
-    temp_dir = os.environ['TEMP']
-    all_warps = glob.glob(os.path.join(temp_dir, '*InverseWarp.nii.gz'))
-    candidates = []
+def compose_cascade_transforms(dvf_30_50_path, dvf_00_30_path, output_path):
+    """
+    Compose u_00->30 and u_30->50 to get u_00->50 on the 30->50 grid.
     
-    print(f"Searching InverseWarps between {time.ctime(timewindow_start)} and {time.ctime(timewindow_end)}")
+    Returns:
+        composed field dict (see dvf_ops)
+    """
+    # These are Displacement Fields.
+    # u: 50->30 (reference grid), v: 30->00
+    print("\nComposing transforms (native, slab-parallel)...")
+    # Order matches the previous SimpleITK CompositeTransform([tx_u, tx_v]).
+    # ITK composite transforms apply the LAST transform in the list first,
+    # so that composite evaluated T_u(T_v(x)): v is applied first, then u.
+    dvf_total = compose_dvf_files(
+        [dvf_00_30_path, dvf_30_50_path], output_path, reference=dvf_30_50_path
+    )
+    print(f"Saved composed DVF to: {output_path}")
     
-    for f in all_warps:
-        mtime = os.path.getmtime(f)
-        if timewindow_start <= mtime <= timewindow_end:
-            candidates.append(f)
-            
-    if not candidates:
-        return None
-        
-    # Return latest in window
-    return max(candidates, key=os.path.getmtime)
+    return dvf_total
 
 def run():
     print("="*60)
-    print("RECOVER AND COMPOSE CASCADE (SimpleITK)")
+    print("RECOVER AND COMPOSE CASCADE")
     print("="*60)
     
-    now = time.time()
-    # 00->30 run finished recently
-    warp_00_30 = find_forward_warp(now - 1800, now) # Actually InverseWarp
-    
-    if not warp_00_30:
-        print("Error: Could not find 00->30 Inverse Warp!")
+    # 00->30 SyN inverse warp, recorded in the job's artifact sidecar
+    try:
+        warp_00_30 = read_stage_file(
+            "results/popi_ants_roi/dvf_00_to_30.nii.gz", 'syn', 'inverse_warp'
+        ) # Actually InverseWarp
+    except FileNotFoundError as e:
+        print(f"Error: Could not find 00->30 Inverse Warp! ({e})")
         return
         
     print(f"Found 00->30 Warp (v): {warp_00_30}")
@@ -47,41 +47,13 @@ def run():
     path_u = "results/popi_ants_roi/dvf_30_to_50_FINAL.nii.gz"
     print(f"Loading existing 30->50 DVF (u): {path_u}")
     
-    # Load with SITK
-    print("\nLoading transforms...")
-    # These are Displacement Fields.
-    u_img = sitk.ReadImage(path_u) # 50->30
-    v_img = sitk.ReadImage(warp_00_30) # 30->00
-    
-    # Create Transforms
-    # Note: SITK DisplacementFieldTransform expects Double vectors.
-    tx_u = sitk.DisplacementFieldTransform(sitk.Cast(u_img, sitk.sitkVectorFloat64))
-    tx_v = sitk.DisplacementFieldTransform(sitk.Cast(v_img, sitk.sitkVectorFloat64))
-    
-    # Compose: T_total(x) = T_v( T_u(x) )
-    # Input x (in 50) -> T_u(x) maps to 30 -> T_v(...) maps to 00.
-    # Result is 50->00.
-    print("Composing transforms...")
-    composite_tx = sitk.CompositeTransform([tx_u, tx_v]) # Apply u then v? 
-    # SITK internal order: T(x) = T0(T1(x))? Or T1(T0(x))?
-    # Documentation says: "Points are transformed by the first transform in the list, then the next..."
-    # So [tx_u, tx_v] -> tx_v(tx_u(x)). This is correct.
-    
-    # To get the Displacement Field of the composite:
-    # We need to resample the composite transform onto the grid of 'u' (Phase 50).
-    print("Resampling composite to DVF...")
-    converter = sitk.TransformToDisplacementFieldFilter()
-    converter.SetReferenceImage(u_img)
-    dvf_total = converter.Execute(composite_tx)
-    
-    # Save 00->50
+    # Compose 00->30 (v) with 30->50 (u) on the phase 50 grid
     final_path = "results/popi_ants_roi/dvf_00_to_50_FINAL.nii.gz"
-    sitk.WriteImage(dvf_total, final_path)
-    print(f"Saved composed DVF to: {final_path}")
+    compose_cascade_transforms(path_u, warp_00_30, final_path)
     
     # Also save the Corrected 30->50 (if we found a better warp)
     fixed_30_path = "results/popi_ants_roi/dvf_30_to_50_CORRECTED.nii.gz"
-    sitk.WriteImage(u_img, fixed_30_path)
+    shutil.copyfile(path_u, fixed_30_path)
     print(f"Saved Corrected 30->50 DVF: {fixed_30_path}")
     
     # Compute QC
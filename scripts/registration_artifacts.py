@@ -0,0 +1,116 @@
+"""
+Per-job artifact directory with a JSON sidecar for checkpoint/resume
+
+Every finished registration stage copies its outputs into the job's artifact
+directory and is recorded in stages.json. A rerun with the same parameters
+resumes after the last completed stage; changed parameters start fresh.
+
+Stages (in order):
+    affine   - affine.mat, ROI paste indices
+    syn      - syn_fwd_warp.nii.gz, syn_inverse_warp.nii.gz
+    full_dvf - full-space DVF
+"""
+
+import json
+import os
+import shutil
+import time
+from pathlib import Path
+
+from hashing import params_digest
+
+STAGES = ('affine', 'syn', 'full_dvf')
+SIDECAR = "stages.json"
+
+def artifact_dir_for(out_dvf_path):
+    """Artifact directory next to the output DVF: <stem>_artifacts/."""
+    out_dvf_path = Path(out_dvf_path)
+    stem = out_dvf_path.name
+    for ext in ('.nii.gz', '.nii'):
+        if stem.endswith(ext):
+            stem = stem[:-len(ext)]
+            break
+    return out_dvf_path.parent / f"{stem}_artifacts"
+
+def _write_sidecar(art_dir, state):
+    tmp = Path(art_dir) / f".{SIDECAR}.tmp"
+    with open(tmp, 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp, Path(art_dir) / SIDECAR)
+
+def load_state(art_dir, job_params):
+    """
+    Sidecar state for a job. Completed stages are dropped when the job
+    parameters changed or a recorded file is missing.
+
+    Returns:
+        dict with 'job', 'params_digest', 'stages'
+    """
+    art_dir = Path(art_dir)
+    art_dir.mkdir(parents=True, exist_ok=True)
+    digest = params_digest(job_params)
+    fresh = {'job': job_params, 'params_digest': digest, 'stages': {}}
+
+    sidecar = art_dir / SIDECAR
+    if not sidecar.exists():
+        return fresh
+    with open(sidecar) as f:
+        state = json.load(f)
+    if state.get('params_digest') != digest:
+        print(f"  Parameters changed - discarding checkpoints in {art_dir}")
+        return fresh
+
+    # Keep the completed prefix whose files are all present
+    stages = {}
+    for stage in STAGES:
+        rec = state['stages'].get(stage)
+        if rec is None or not all((art_dir / f).exists() for f in rec['files'].values()):
+            break
+        stages[stage] = rec
+    state['stages'] = stages
+    return state
+
+def record_stage(art_dir, state, stage, files, info=None):
+    """
+    Copy a stage's output files into the artifact directory and mark it done.
+
+    Args:
+        files: dict name -> (source path, artifact file name)
+        info: extra JSON-serializable data needed to resume
+    """
+    art_dir = Path(art_dir)
+    stored = {}
+    for name, (src, dst_name) in files.items():
+        dst = art_dir / dst_name
+        if Path(src).resolve() != dst.resolve():
+            shutil.copyfile(src, dst)
+        stored[name] = dst_name
+    state['stages'][stage] = {
+        'completed': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'files': stored,
+        'info': info or {}
+    }
+    _write_sidecar(art_dir, state)
+    return state
+
+def stage_done(state, stage):
+    return stage in state['stages']
+
+def stage_file(art_dir, state, stage, name):
+    """Absolute path of a file recorded for a completed stage."""
+    return str(Path(art_dir) / state['stages'][stage]['files'][name])
+
+def read_stage_file(out_dvf_path, stage, name):
+    """
+    Path of a recorded artifact for the job that writes out_dvf_path,
+    without validating parameters (for downstream consumers).
+    """
+    art_dir = artifact_dir_for(out_dvf_path)
+    sidecar = art_dir / SIDECAR
+    if not sidecar.exists():
+        raise FileNotFoundError(f"No artifact sidecar: {sidecar}")
+    with open(sidecar) as f:
+        state = json.load(f)
+    if stage not in state['stages']:
+        raise FileNotFoundError(f"Stage '{stage}' not completed in {sidecar}")
+    return stage_file(art_dir, state, stage, name)
@@ -0,0 +1,86 @@
+"""
+Content-addressed cache for registration preprocessing and affine pre-alignment
+
+An entry holds everything register_phase_roi computes before the deformable
+stage: the dilated, ROI-cropped, isotropically resampled images and masks,
+the ROI paste indices and the masked affine transform. The key is a hash of
+the input files' contents and every preprocessing parameter, so changing only
+SyN settings (grad_step, CC radius, pyramid) reuses the entry.
+
+Layout: <cache_dir>/<key>/{fix_iso,mov_iso,fix_mask_iso,mov_mask_iso}.nii,
+        affine.mat, meta.json
+"""
+
+import json
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+import ants
+import numpy as np
+
+from hashing import file_digest, params_digest
+
+IMAGE_KEYS = ('fix_iso', 'mov_iso', 'fix_mask_iso', 'mov_mask_iso')
+
+def preprocessing_key(fix_path, mov_path, fix_mask_path, mov_mask_path, params):
+    """Cache key from input file contents and preprocessing parameters."""
+    return params_digest({
+        'inputs': [file_digest(p) for p in (fix_path, mov_path, fix_mask_path, mov_mask_path)],
+        'params': params
+    })
+
+def load_prepared(cache_dir, key):
+    """
+    Load a cached preprocessing entry.
+
+    Returns:
+        dict with the four iso images, 'affine' (path to transform),
+        'lo_fix', 'hi_fix' (Z,Y,X indices) and 'meta'; None if not cached
+    """
+    entry = Path(cache_dir) / key
+    meta_path = entry / "meta.json"
+    if not meta_path.exists():
+        return None
+
+    with open(meta_path) as f:
+        meta = json.load(f)
+    prepared = {k: ants.image_read(str(entry / f"{k}.nii")) for k in IMAGE_KEYS}
+    prepared['affine'] = str(entry / "affine.mat")
+    prepared['lo_fix'] = np.array(meta['lo_fix'])
+    prepared['hi_fix'] = np.array(meta['hi_fix'])
+    prepared['meta'] = meta
+    return prepared
+
+def save_prepared(cache_dir, key, prepared, params):
+    """
+    Store a preprocessing entry. Written to a temporary directory first and
+    renamed into place, so concurrent jobs never see a partial entry.
+
+    Returns:
+        path of the cached affine transform
+    """
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    entry = cache_dir / key
+    tmp = Path(tempfile.mkdtemp(prefix=f".{key[:12]}_", dir=cache_dir))
+
+    for k in IMAGE_KEYS:
+        ants.image_write(prepared[k], str(tmp / f"{k}.nii"))
+    shutil.copyfile(prepared['affine'], tmp / "affine.mat")
+    meta = {
+        'params': params,
+        'lo_fix': [int(v) for v in prepared['lo_fix']],
+        'hi_fix': [int(v) for v in prepared['hi_fix']],
+        'iso_shape': list(prepared['fix_iso'].shape),
+    }
+    with open(tmp / "meta.json", 'w') as f:
+        json.dump(meta, f, indent=2)
+
+    try:
+        os.rename(tmp, entry)
+    except OSError:
+        # Another job stored the same entry first
+        shutil.rmtree(tmp, ignore_errors=True)
+    return str(entry / "affine.mat")
@@ -0,0 +1,209 @@
+"""
+Phase 1: Parallel Multi-Pair Registration Scheduler
+Runs independent register_phase_roi jobs in a process pool and starts
+dependent cascade steps (00->30->50 composition) once the jobs that produce
+their inputs have finished in this run.
+
+Each job is a dict:
+    name:   unique job name
+    kind:   "register" (register_phase_roi) or "compose" (cascade composition)
+    params: keyword arguments for the job function
+    inputs: files the job reads. An input produced by another job is ready
+            only once that job has finished in this run (an output left over
+            from a previous run is stale); any other input must exist.
+    output: file produced by the job
+"""
+
+import time
+from concurrent.futures import wait, FIRST_COMPLETED
+from pathlib import Path
+
+from parallel import available_cores, make_process_pool, thread_budget
+
+def register_job(name, fix_phase, mov_phase, data_dir, out_dir, **params):
+    """Job spec for one ROI registration (mov_phase -> fix_phase)."""
+    data_dir, out_dir = Path(data_dir), Path(out_dir)
+    kwargs = {
+        'fix_path': data_dir / f"phase{fix_phase}.nii.gz",
+        'mov_path': data_dir / f"phase{mov_phase}.nii.gz",
+        'fix_mask_path': data_dir / f"phase{fix_phase}_lung_mask.nii.gz",
+        'mov_mask_path': data_dir / f"phase{mov_phase}_lung_mask.nii.gz",
+        'out_dvf_path': out_dir / f"dvf_{mov_phase}_to_{fix_phase}.nii.gz",
+    }
+    kwargs.update(params)
+    return {
+        'name': name,
+        'kind': 'register',
+        'params': kwargs,
+        'inputs': [kwargs['fix_path'], kwargs['mov_path'],
+                   kwargs['fix_mask_path'], kwargs['mov_mask_path']],
+        'output': kwargs['out_dvf_path']
+    }
+
+def compose_job(name, dvf_second_path, dvf_first_path, out_path):
+    """Job spec for a two-step cascade composition (first, then second)."""
+    return {
+        'name': name,
+        'kind': 'compose',
+        'params': {
+            'dvf_30_50_path': dvf_second_path,
+            'dvf_00_30_path': dvf_first_path,
+            'output_path': out_path
+        },
+        'inputs': [dvf_second_path, dvf_first_path],
+        'output': out_path
+    }
+
+def cascade_jobs(data_dir="data/preprocessed/popi_ants", out_dir="results/popi_ants_roi"):
+    """
+    Default POPI job list: 70->50, 30->50, 00->30 and the 00->30->50 cascade.
+    Parameters follow the per-pair configuration in the Phase 1 documentation.
+    """
+    out_dir = Path(out_dir)
+    jobs = [
+        register_job("70_to_50", "50", "70", data_dir, out_dir,
+                     margin_mm=(15, 15, 15), grad_step=0.025, mask_dilation=3),
+        register_job("30_to_50", "50", "30", data_dir, out_dir,
+                     margin_mm=(15, 15, 15), grad_step=0.025, mask_dilation=3),
+        register_job("00_to_30", "30", "00", data_dir, out_dir,
+                     margin_mm=(18, 18, 18), grad_step=0.03, mask_dilation=3),
+    ]
+    jobs.append(compose_job(
+        "00_to_50",
+        dvf_second_path=out_dir / "dvf_30_to_50.nii.gz",
+        dvf_first_path=out_dir / "dvf_00_to_30.nii.gz",
+        out_path=out_dir / "dvf_00_to_50.nii.gz"
+    ))
+    return jobs
+
+def _run_job(job):
+    """Worker entry point. Imaging libraries are imported here, after the
+    pool initializer has set the thread budget."""
+    t0 = time.time()
+    if job['kind'] == 'register':
+        from run_ants_syn_roi import register_phase_roi
+        register_phase_roi(**job['params'])
+    elif job['kind'] == 'compose':
+        from recover_and_compose import compose_cascade_transforms
+        compose_cascade_transforms(**job['params'])
+    else:
+        raise ValueError(f"Unknown job kind: {job['kind']}")
+    return time.time() - t0
+
+def _producers(jobs):
+    """
+    Map each job output to the name of the job that produces it, after
+    checking that every input exists already or is produced by another job.
+    """
+    names = [job['name'] for job in jobs]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Duplicate job names: {names}")
+    producer = {}
+    for job in jobs:
+        out = str(job['output'])
+        if out in producer:
+            raise ValueError(f"Jobs {producer[out]} and {job['name']} both produce {out}")
+        producer[out] = job['name']
+    for job in jobs:
+        for p in job['inputs']:
+            if str(p) not in producer and not Path(p).exists():
+                raise FileNotFoundError(f"{job['name']}: input {p} missing and not produced by any job")
+            if producer.get(str(p)) == job['name']:
+                raise ValueError(f"{job['name']}: reads its own output {p}")
+    return producer
+
+def run_jobs(jobs, n_workers=None, threads_per_worker=None):
+    """
+    Run registration jobs with dependency-aware scheduling.
+
+    Args:
+        jobs: list of job dicts (see module docstring)
+        n_workers: worker processes (default: number of jobs, capped by cores)
+        threads_per_worker: ITK threads per worker (default: cores / workers)
+
+    Returns:
+        dict job name -> {'status': 'done'|'failed'|'skipped', 'wall_s', 'error'}
+    """
+    producer = _producers(jobs)
+    n_cores = available_cores()
+    if n_workers is None:
+        n_workers = max(1, min(len(jobs), n_cores))
+    if threads_per_worker is None:
+        threads_per_worker = thread_budget(n_workers, n_cores)
+
+    print(f"  Scheduling {len(jobs)} jobs on {n_workers} workers x {threads_per_worker} ITK threads")
+
+    pending = list(jobs)
+    running = {}
+    failed_outputs = set()
+    status = {}
+
+    def ready(path):
+        # Produced inputs wait for their job, never for a stale file on disk
+        name = producer.get(str(path))
+        if name is None:
+            return Path(path).exists()
+        return status.get(name, {}).get('status') == 'done'
+
+    with make_process_pool(n_workers, threads_per_worker) as pool:
+        while pending or running:
+            # Drop jobs that depend on a failed job
+            for job in list(pending):
+                if any(str(p) in failed_outputs for p in job['inputs']):
+                    pending.remove(job)
+                    failed_outputs.add(str(job['output']))
+                    status[job['name']] = {'status': 'skipped', 'wall_s': 0.0,
+                                           'error': 'upstream job failed'}
+                    print(f"  [SKIP] {job['name']} (upstream failure)")
+
+            # Start every job whose inputs are ready
+            for job in list(pending):
+                if len(running) >= n_workers:
+                    break
+                if all(ready(p) for p in job['inputs']):
+                    pending.remove(job)
+                    running[pool.submit(_run_job, job)] = job
+                    print(f"  [START] {job['name']}")
+
+            if not running:
+                if pending:
+                    names = [job['name'] for job in pending]
+                    raise RuntimeError(f"Jobs can never start (inputs missing or cyclic): {names}")
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for fut in done:
+                job = running.pop(fut)
+                try:
+                    wall = fut.result()
+                    status[job['name']] = {'status': 'done', 'wall_s': wall, 'error': None}
+                    print(f"  [DONE] {job['name']} ({wall/60:.1f} min)")
+                except Exception as e:
+                    failed_outputs.add(str(job['output']))
+                    status[job['name']] = {'status': 'failed', 'wall_s': None, 'error': str(e)}
+                    print(f"  [FAIL] {job['name']}: {e}")
+
+    return status
+
+def main():
+    print("\n" + "="*70)
+    print("Phase 1: Parallel ROI Registration (70->50, 30->50, 00->30->50)")
+    print("="*70 + "\n")
+
+    out_dir = Path("results/popi_ants_roi")
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    t0 = time.time()
+    status = run_jobs(cascade_jobs(out_dir=out_dir))
+
+    print("\n" + "="*70)
+    print(f"Scheduler finished in {(time.time() - t0)/60:.1f} min")
+    print("="*70)
+    for name, st in status.items():
+        wall = f"{st['wall_s']/60:.1f} min" if st['wall_s'] else "-"
+        print(f"  {name:10s} {st['status']:8s} {wall}")
+
+    return status
+
+if __name__ == "__main__":
+    main()
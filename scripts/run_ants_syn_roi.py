@@ -11,6 +11,14 @@ import ants
 import numpy as np
 from pathlib import Path
 import json
+import shutil
+
+from hashing import file_digest
+from image_bridge import read_geometry, to_ants, to_numpy
+from registration_cache import preprocessing_key, load_prepared, save_prepared
+from registration_artifacts import (
+    artifact_dir_for, load_state, record_stage, stage_done, stage_file
+)
 
 def crop_to_mask_bbox(img, mask, margin_mm=(25, 25, 25)):
     """
@@ -21,15 +29,8 @@ def crop_to_mask_bbox(img, mask, margin_mm=(25, 25, 25)):
         
     Note: Indices are in SimpleITK/numpy array order (Z,Y,X)
     """
-    import SimpleITK as sitk
-    
-    # Convert to SimpleITK to get consistent indexing
-    temp_mask = Path("results/popi_ants_roi/temp_mask.nii.gz")
-    ants.image_write(mask, str(temp_mask))
-    mask_sitk = sitk.ReadImage(str(temp_mask))
-    
-    # Get mask array (Z,Y,X)
-    mask_arr = sitk.GetArrayFromImage(mask_sitk)
+    # Mask array in SimpleITK/numpy order (Z,Y,X), no copy
+    mask_arr = to_numpy(mask, order="zyx")
     nz = np.nonzero(mask_arr)
     
     if len(nz[0]) == 0:
@@ -40,7 +41,7 @@ def crop_to_mask_bbox(img, mask, margin_mm=(25, 25, 25)):
     hi_vox = np.array([nz[0].max(), nz[1].max(), nz[2].max()])
     
     # Convert margin from mm to voxels
-    spacing = np.array(mask_sitk.GetSpacing())[::-1]  # Reverse to (Z,Y,X)
+    spacing = np.array(mask.spacing)[::-1]  # Reverse to (Z,Y,X)
     margin_vox = np.maximum(np.round(np.array(margin_mm) / spacing).astype(int), 2)
     
     # Expand with margin, clamp to image bounds
@@ -56,9 +57,6 @@ def crop_to_mask_bbox(img, mask, margin_mm=(25, 25, 25)):
     roi_img = ants.crop_indices(img, lo_ants.tolist(), crop_size.tolist())
     roi_mask = ants.crop_indices(mask, lo_ants.tolist(), crop_size.tolist())
     
-    # Cleanup
-    temp_mask.unlink()
-    
     # Return indices in SimpleITK/numpy order (Z,Y,X)
     return roi_img, roi_mask, lo, hi
 
@@ -75,32 +73,16 @@ def safe_pyramid_for_mask(mask_img):
     # 4-level pyramid, heavy fine-level work
     return (8, 4, 2, 1), (4, 2, 1, 0), (100, 100, 100, 120)
 
-def syn_roi_masked(fix_img, mov_img, fix_mask, mov_mask, grad_step=0.03, cc_radius=4):
-    """
-    ANTs SyN registration with isotropic resampling and larger CC radius.
-    
-    Last-mile optimization:
-    - Resample ROI to isotropic 1.25mm for better local CC
-    - Increase CC neighborhood radius from 2 to 4
-    - Expected: 0.3-0.5mm TRE improvement
-    """
-    print(f"  Resampling ROI to isotropic 1.25mm...")
-    
-    # Resample to isotropic spacing
-    fix_iso = resample_iso(fix_img)
-    mov_iso = resample_iso(mov_img)
+def resample_roi_iso(fix_img, mov_img, fix_mask, mov_mask, iso=2.0):
+    """Resample ROI images and masks to isotropic spacing."""
+    fix_iso = resample_iso(fix_img, iso=iso)
+    mov_iso = resample_iso(mov_img, iso=iso)
     fix_mask_iso = resample_iso(fix_mask.clone('unsigned char'), iso=fix_iso.spacing[0]).clone('unsigned char')
     mov_mask_iso = resample_iso(mov_mask.clone('unsigned char'), iso=mov_iso.spacing[0]).clone('unsigned char')
-    
-    print(f"    Original spacing: {fix_img.spacing}")
-    print(f"    Isotropic spacing: {fix_iso.spacing}")
-    print(f"    Isotropic ROI shape: {fix_iso.shape}")
-    
-    # Get pyramid parameters
-    shrinks, sigmas, iters = safe_pyramid_for_mask(fix_mask_iso)
-    n_levels = len(shrinks)
-    
-    # Affine prealignment with masks
+    return fix_iso, mov_iso, fix_mask_iso, mov_mask_iso
+
+def affine_prealign(fix_iso, mov_iso, fix_mask_iso, mov_mask_iso):
+    """Masked affine pre-alignment. Returns path to the affine transform."""
     print(f"    [1/2] Affine (masked, 800x400x200 iters)")
     aff = ants.registration(
         fixed=fix_iso, moving=mov_iso,
@@ -111,6 +93,24 @@ def syn_roi_masked(fix_img, mov_img, fix_mask, mov_mask, grad_step=0.03, cc_radi
         aff_metric='mattes',
         aff_sampling=20
     )
+    return aff['fwdtransforms'][0]
+
+def syn_transforms(fix_iso, mov_iso, fix_mask_iso, mov_mask_iso, affine,
+                   grad_step=0.03, cc_radius=4, pyramid=None):
+    """
+    Masked SyN stage on isotropic ROI images, initialized with an affine.
+    
+    Args:
+        pyramid: (shrinks, sigmas, iters); default safe_pyramid_for_mask
+    
+    Returns:
+        (forward warp path, inverse warp path) as written by ANTs
+    """
+    # Get pyramid parameters
+    if pyramid is None:
+        pyramid = safe_pyramid_for_mask(fix_mask_iso)
+    shrinks, sigmas, iters = pyramid
+    n_levels = len(shrinks)
     
     # SyN with larger CC radius
     print(f"    [2/2] SyN (masked, {n_levels}-level pyramid)")
@@ -125,7 +125,7 @@ def syn_roi_masked(fix_img, mov_img, fix_mask, mov_mask, grad_step=0.03, cc_radi
         type_of_transform='SyN',
         mask=fix_mask_iso,
         moving_mask=mov_mask_iso,
-        initial_transform=aff['fwdtransforms'][0],
+        initial_transform=affine,
         reg_iterations=iters,
         smoothing_sigmas=sigmas,
         shrink_factors=shrinks,
@@ -134,39 +134,67 @@ def syn_roi_masked(fix_img, mov_img, fix_mask, mov_mask, grad_step=0.03, cc_radi
         grad_step=grad_step
     )
     
+    inverse_warp = [t for t in syn['invtransforms'] if str(t).endswith('InverseWarp.nii.gz')][0]
+    return syn['fwdtransforms'][0], inverse_warp
+
+def syn_deformable(fix_iso, mov_iso, fix_mask_iso, mov_mask_iso, affine,
+                   grad_step=0.03, cc_radius=4, pyramid=None):
+    """
+    Masked SyN stage on isotropic ROI images, initialized with an affine.
+    
+    Returns:
+        isotropic ROI DVF (ANTs vector image)
+    """
+    fwd_warp, _ = syn_transforms(fix_iso, mov_iso, fix_mask_iso, mov_mask_iso, affine,
+                                 grad_step=grad_step, cc_radius=cc_radius, pyramid=pyramid)
+    
     # Export DVF: save isotropic warp directly (safer than resampling)
     print(f"  Exporting isotropic DVF...")
-    dvf_iso = ants.image_read(str(syn['fwdtransforms'][0]))  # Read the warp file directly
+    dvf_iso = ants.image_read(str(fwd_warp))  # Read the warp file directly
     
     # Return isotropic DVF (will be saved directly to results)
     # Note: TRE computation works correctly on isotropic DVF
     return dvf_iso
 
-def paste_dvf_to_full_space(dvf_roi, full_ref_img, lo_indices, hi_indices):
+def syn_roi_masked(fix_img, mov_img, fix_mask, mov_mask, grad_step=0.03, cc_radius=4, iso=2.0,
+                   pyramid=None):
     """
-    Paste ROI DVF into full-size zero field using SimpleITK.
+    ANTs SyN registration with isotropic resampling and larger CC radius.
     
-    Note: Use actual ROI shape, not computed hi-lo indices
+    Last-mile optimization:
+    - Resample ROI to isotropic 1.25mm for better local CC
+    - Increase CC neighborhood radius from 2 to 4
+    - Expected: 0.3-0.5mm TRE improvement
     """
-    import SimpleITK as sitk
+    print(f"  Resampling ROI to isotropic 1.25mm...")
     
-    # Convert ANTs to SimpleITK for easier manipulation
-    temp_roi = Path("results/popi_ants_roi/temp_dvf_roi.nii.gz")
-    temp_full = Path("results/popi_ants_roi/temp_dvf_full.nii.gz")
+    # Resample to isotropic spacing
+    fix_iso, mov_iso, fix_mask_iso, mov_mask_iso = resample_roi_iso(
+        fix_img, mov_img, fix_mask, mov_mask, iso=iso
+    )
+    
+    print(f"    Original spacing: {fix_img.spacing}")
+    print(f"    Isotropic spacing: {fix_iso.spacing}")
+    print(f"    Isotropic ROI shape: {fix_iso.shape}")
     
-    ants.image_write(dvf_roi, str(temp_roi))
-    dvf_roi_sitk = sitk.ReadImage(str(temp_roi))
+    # Affine prealignment with masks
+    affine = affine_prealign(fix_iso, mov_iso, fix_mask_iso, mov_mask_iso)
     
-    # Create zero DVF in full space
-    ref_sitk = sitk.ReadImage(str(full_ref_img))
+    return syn_deformable(fix_iso, mov_iso, fix_mask_iso, mov_mask_iso, affine,
+                          grad_step=grad_step, cc_radius=cc_radius, pyramid=pyramid)
+
+def paste_dvf_to_full_space(dvf_roi, full_ref_img, lo_indices, hi_indices):
+    """
+    Paste ROI DVF into full-size zero field.
     
-    # Create zero displacement field
-    dvf_full_sitk = sitk.Image(ref_sitk.GetSize(), sitk.sitkVectorFloat32, 3)
-    dvf_full_sitk.CopyInformation(ref_sitk)
+    Note: Use actual ROI shape, not computed hi-lo indices
+    """
+    # Full-space geometry from the reference header only
+    ref_geom = read_geometry(full_ref_img)
     
-    # Get arrays - SimpleITK uses (Z,Y,X,3) ordering
-    dvf_roi_arr = sitk.GetArrayFromImage(dvf_roi_sitk)  # (Z_roi, Y_roi, X_roi, 3)
-    dvf_full_arr = sitk.GetArrayFromImage(dvf_full_sitk)  # (Z_full, Y_full, X_full, 3)
+    # Arrays in SimpleITK/numpy (Z,Y,X,3) ordering
+    dvf_roi_arr = to_numpy(dvf_roi, order="zyx")  # (Z_roi, Y_roi, X_roi, 3)
+    dvf_full_arr = np.zeros(ref_geom['shape'][::-1] + (3,), dtype=np.float32)  # (Z_full, Y_full, X_full, 3)
     
     print(f"    DVF ROI array shape: {dvf_roi_arr.shape}")
     print(f"    DVF full array shape: {dvf_full_arr.shape}")
@@ -185,30 +213,27 @@ def paste_dvf_to_full_space(dvf_roi, full_ref_img, lo_indices, hi_indices):
     # Paste ROI into full space
     dvf_full_arr[z0:z1+1, y0:y1+1, x0:x1+1, :] = dvf_roi_arr
     
-    # Create new image from array
-    dvf_full_sitk = sitk.GetImageFromArray(dvf_full_arr, isVector=True)
-    dvf_full_sitk.CopyInformation(ref_sitk)
-    
-    # Save and reload as ANTs
-    sitk.WriteImage(dvf_full_sitk, str(temp_full))
-    dvf_full_ants = ants.image_read(str(temp_full))
-    
-    # Cleanup
-    temp_roi.unlink()
-    temp_full.unlink()
+    # Wrap as ANTs vector image on the reference grid
+    dvf_full_ants = to_ants(dvf_full_arr, like=ref_geom, order="zyx")
     
     return dvf_full_ants
 
-def register_phase_roi(
+def prepare_roi_inputs(
     fix_path, mov_path,
     fix_mask_path, mov_mask_path,
-    out_dvf_path,
     margin_mm=(25, 25, 25),
-    grad_step=0.04,
-    mask_dilation=2
+    mask_dilation=2,
+    iso=2.0,
+    affine=None
 ):
     """
-    Complete ROI-cropped registration pipeline.
+    Everything before the deformable stage: mask dilation, ROI cropping,
+    isotropic resampling and masked affine pre-alignment (skipped when an
+    existing affine transform is given).
+    
+    Returns:
+        dict with fix_iso, mov_iso, fix_mask_iso, mov_mask_iso, affine,
+        lo_fix, hi_fix
     """
     print(f"  Loading images...")
     fix_full = ants.image_read(str(fix_path))
@@ -229,16 +254,148 @@ def register_phase_roi(
     print(f"    Fixed ROI shape: {fix_roi.shape}")
     print(f"    Moving ROI shape: {mov_roi.shape}")
     
-    # Register in ROI with isotropic resampling
-    print(f"  Registering in ROI (isotropic)...")
-    dvf_roi = syn_roi_masked(fix_roi, mov_roi, fix_mask_roi, mov_mask_roi, grad_step)
+    # Resample ROI to isotropic spacing
+    print(f"  Resampling ROI to isotropic {iso}mm...")
+    fix_iso, mov_iso, fix_mask_iso, mov_mask_iso = resample_roi_iso(
+        fix_roi, mov_roi, fix_mask_roi, mov_mask_roi, iso=iso
+    )
+    print(f"    Isotropic ROI shape: {fix_iso.shape}")
+    
+    # Affine prealignment with masks
+    if affine is None:
+        affine = affine_prealign(fix_iso, mov_iso, fix_mask_iso, mov_mask_iso)
+    
+    return {
+        'fix_iso': fix_iso, 'mov_iso': mov_iso,
+        'fix_mask_iso': fix_mask_iso, 'mov_mask_iso': mov_mask_iso,
+        'affine': affine,
+        'lo_fix': lo_fix, 'hi_fix': hi_fix
+    }
+
+def load_or_prepare_roi_inputs(
+    fix_path, mov_path,
+    fix_mask_path, mov_mask_path,
+    margin_mm=(25, 25, 25),
+    mask_dilation=2,
+    iso=2.0,
+    cache_dir="results/cache/registration",
+    affine=None
+):
+    """
+    prepare_roi_inputs through the preprocessing cache.
+    
+    Reused from cache_dir when the input images, masks and preprocessing
+    parameters are unchanged (cache_dir=None disables the cache).
+    """
+    prep_params = {
+        'margin_mm': list(margin_mm),
+        'mask_dilation': mask_dilation,
+        'iso': iso,
+        'affine': {'reg_iterations': [800, 400, 200], 'aff_metric': 'mattes', 'aff_sampling': 20}
+    }
+    
+    prepared = None
+    if cache_dir is not None:
+        key = preprocessing_key(fix_path, mov_path, fix_mask_path, mov_mask_path, prep_params)
+        prepared = load_prepared(cache_dir, key)
+        if prepared is not None:
+            print(f"  Preprocessing + affine from cache ({key[:12]})")
+    
+    if prepared is None:
+        prepared = prepare_roi_inputs(
+            fix_path, mov_path, fix_mask_path, mov_mask_path,
+            margin_mm=margin_mm, mask_dilation=mask_dilation, iso=iso,
+            affine=affine
+        )
+        if cache_dir is not None:
+            prepared['affine'] = save_prepared(cache_dir, key, prepared, prep_params)
+    elif affine is not None:
+        prepared['affine'] = affine
+    
+    return prepared
+
+def register_phase_roi(
+    fix_path, mov_path,
+    fix_mask_path, mov_mask_path,
+    out_dvf_path,
+    margin_mm=(25, 25, 25),
+    grad_step=0.04,
+    mask_dilation=2,
+    cc_radius=4,
+    iso=2.0,
+    cache_dir="results/cache/registration",
+    artifact_dir=None
+):
+    """
+    Complete ROI-cropped registration pipeline.
+    
+    Preprocessing and the affine go through the cache in cache_dir
+    (see load_or_prepare_roi_inputs). Each finished stage (affine, SyN
+    warps, full-space DVF) is checkpointed to artifact_dir (default:
+    <out_dvf stem>_artifacts/) and a rerun resumes after the last one.
+    """
+    art_dir = Path(artifact_dir) if artifact_dir else artifact_dir_for(out_dvf_path)
+    job_params = {
+        'inputs': {name: {'path': str(p), 'sha256': file_digest(p)} for name, p in (
+            ('fix', fix_path), ('mov', mov_path),
+            ('fix_mask', fix_mask_path), ('mov_mask', mov_mask_path))},
+        'margin_mm': list(margin_mm),
+        'grad_step': grad_step,
+        'mask_dilation': mask_dilation,
+        'cc_radius': cc_radius,
+        'iso': iso
+    }
+    state = load_state(art_dir, job_params)
+    
+    if stage_done(state, 'full_dvf'):
+        print(f"  Resuming: all stages complete in {art_dir}")
+        shutil.copyfile(stage_file(art_dir, state, 'full_dvf', 'dvf'), out_dvf_path)
+        print(f"  [DONE] {Path(out_dvf_path).name}")
+        return ants.image_read(str(out_dvf_path))
+    
+    if stage_done(state, 'syn'):
+        print(f"  Resuming after SyN stage ({art_dir})")
+    else:
+        affine = None
+        if stage_done(state, 'affine'):
+            print(f"  Resuming after affine stage ({art_dir})")
+            affine = stage_file(art_dir, state, 'affine', 'affine')
+        
+        prepared = load_or_prepare_roi_inputs(
+            fix_path, mov_path, fix_mask_path, mov_mask_path,
+            margin_mm=margin_mm, mask_dilation=mask_dilation, iso=iso,
+            cache_dir=cache_dir, affine=affine
+        )
+        if not stage_done(state, 'affine'):
+            record_stage(art_dir, state, 'affine',
+                         {'affine': (prepared['affine'], "affine.mat")},
+                         info={'lo_fix': [int(v) for v in prepared['lo_fix']],
+                               'hi_fix': [int(v) for v in prepared['hi_fix']]})
+        
+        # Register in ROI (deformable stage only)
+        print(f"  Registering in ROI (isotropic)...")
+        fwd_warp, inv_warp = syn_transforms(
+            prepared['fix_iso'], prepared['mov_iso'],
+            prepared['fix_mask_iso'], prepared['mov_mask_iso'],
+            stage_file(art_dir, state, 'affine', 'affine'),
+            grad_step=grad_step, cc_radius=cc_radius
+        )
+        record_stage(art_dir, state, 'syn', {
+            'fwd_warp': (fwd_warp, "syn_fwd_warp.nii.gz"),
+            'inverse_warp': (inv_warp, "syn_inverse_warp.nii.gz")
+        })
     
     # Paste back to full space
     print(f"  Pasting DVF to full space...")
-    dvf_full = paste_dvf_to_full_space(dvf_roi, fix_path, lo_fix, hi_fix)
+    info = state['stages']['affine']['info']
+    dvf_roi = ants.image_read(stage_file(art_dir, state, 'syn', 'fwd_warp'))
+    dvf_full = paste_dvf_to_full_space(dvf_roi, fix_path, info['lo_fix'], info['hi_fix'])
     
     # Save
-    ants.image_write(dvf_full, str(out_dvf_path))
+    full_path = art_dir / "full_dvf.nii.gz"
+    ants.image_write(dvf_full, str(full_path))
+    record_stage(art_dir, state, 'full_dvf', {'dvf': (full_path, full_path.name)})
+    shutil.copyfile(full_path, out_dvf_path)
     print(f"  [DONE] {Path(out_dvf_path).name}")
     
     return dvf_full
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+"""
+Batch QC Runner
+Scores any number of DVFs with the fused QC engine (dvf_qc_engine.qc_field)
+on a process pool: one worker per core, each pinned to one ITK/BLAS thread.
+
+Inputs are glob patterns or a CSV manifest with columns
+    dvf [, mask, bwd, fixed_landmarks, moving_landmarks]
+(landmarks as .pts files; empty cells fall back to the defaults).
+
+Results go to one columnar table, one row per field: metrics, gate
+pass/fail and timings. The table is Parquet when pyarrow is installed and
+CSV otherwise. Each row carries the SHA-256 of the DVF, the mask, the
+backward DVF and the landmark files (hashing.file_digest). A field is
+skipped when that whole key has already been scored, so re-running over a
+growing cohort only scores new or changed files, and a field scored before
+its backward DVF or landmarks were supplied is scored again with them.
+
+Usage:
+    python scripts/run_batch_qc.py                      # default globs
+    python scripts/run_batch_qc.py "results/**/dvf_*.nii.gz" more/*.nii.gz
+    python scripts/run_batch_qc.py manifest.csv
+"""
+
+import csv
+import glob
+import sys
+import time
+from concurrent.futures import as_completed
+from pathlib import Path
+
+from parallel import available_cores, make_process_pool
+
+DEFAULT_GLOBS = [
+    "results/popi_ants_roi/dvf_*_to_50_FINAL.nii.gz",
+    "results/pca/pc*_*sd.nii.gz",
+]
+DEFAULT_MASK = "data/preprocessed/popi_ants/phase50_lung_mask.nii.gz"
+STORE_STEM = Path("results/qc/batch_qc")
+FLUSH_EVERY = 50
+
+COLUMNS = [
+    'dvf', 'content_hash', 'mask', 'mask_hash', 'bwd', 'bwd_hash', 'landmarks_hash',
+    'status', 'passed', 'issues',
+    'n_voxels', 'mag_median_mm', 'mag_p95_mm', 'mag_max_mm',
+    'jac_p01', 'jac_p50', 'jac_p99', 'jac_min', 'jac_max', 'jac_pct_negative',
+    'curl_median', 'curl_p95', 'div_p01', 'div_p99',
+    'ic_median_mm', 'ic_p95_mm', 'tre_median_mm', 'tre_p95_mm', 'tre_n_out_of_bounds',
+    'load_s', 'qc_s', 'total_s', 'scored_at', 'error'
+]
+
+def have_parquet():
+    try:
+        import pyarrow  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+def store_path(stem=STORE_STEM):
+    """Parquet store if pyarrow is available, CSV otherwise."""
+    return Path(stem).with_suffix(".parquet" if have_parquet() else ".csv")
+
+def read_store(path):
+    """Existing rows of a result store (empty list if missing)."""
+    path = Path(path)
+    if not path.exists():
+        return []
+    if path.suffix == ".parquet":
+        import pyarrow.parquet as pq
+        return pq.read_table(path).to_pylist()
+    with open(path, newline='') as f:
+        return list(csv.DictReader(f))
+
+def write_store(rows, path):
+    """Rewrite the store with all rows (atomic replace)."""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(path.name + ".tmp")
+    if path.suffix == ".parquet":
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        table = pa.Table.from_pylist([{c: r.get(c) for c in COLUMNS} for r in rows])
+        pq.write_table(table, tmp)
+    else:
+        with open(tmp, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=COLUMNS, extrasaction='ignore')
+            writer.writeheader()
+            writer.writerows(rows)
+    tmp.replace(path)
+
+def collect_inputs(args, mask=DEFAULT_MASK):
+    """
+    Task dicts from glob patterns and/or CSV manifests.
+
+    Returns:
+        list of dicts: dvf, mask, bwd, fixed_landmarks, moving_landmarks
+    """
+    items = []
+    for arg in args:
+        if arg.endswith(".csv"):
+            with open(arg, newline='') as f:
+                for rec in csv.DictReader(f):
+                    items.append({
+                        'dvf': rec['dvf'],
+                        'mask': rec.get('mask') or mask,
+                        'bwd': rec.get('bwd') or None,
+                        'fixed_landmarks': rec.get('fixed_landmarks') or None,
+                        'moving_landmarks': rec.get('moving_landmarks') or None
+                    })
+        else:
+            for p in sorted(glob.glob(arg, recursive=True)):
+                items.append({'dvf': p, 'mask': mask, 'bwd': None,
+                              'fixed_landmarks': None, 'moving_landmarks': None})
+    seen = set()
+    return [t for t in items if not (t['dvf'] in seen or seen.add(t['dvf']))]
+
+def gate(metrics):
+    """Acceptance criteria with TRE; the Jacobian safety gate alone without."""
+    from compute_phase70_qc import check_acceptance_criteria
+    from jacobian import passes_gate
+
+    if 'tre' in metrics:
+        return check_acceptance_criteria(metrics)
+    jac = metrics['jacobian']
+    ok = passes_gate({'neg_percent': jac['pct_negative'], 'p01': jac['p01'], 'p99': jac['p99']})
+    issues = [] if ok else [f"Jacobian gate: neg {jac['pct_negative']:.2f}%, "
+                            f"P01 {jac['p01']:.3f}, P99 {jac['p99']:.3f}"]
+    return ok, issues
+
+def _score(task):
+    """Worker: fused QC of one DVF -> flat result row."""
+    from compute_final_qc_metrics import resample_mask_to_field
+    from dvf_ops import load_field
+    from dvf_qc_engine import qc_field
+    from tre import load_pts_landmarks
+
+    t0 = time.time()
+    field = load_field(task['dvf'])
+    bwd = load_field(task['bwd']) if task['bwd'] else None
+    mask = resample_mask_to_field(task['mask'], field) if task['mask'] else None
+    landmarks = None
+    if task['fixed_landmarks'] and task['moving_landmarks']:
+        landmarks = {'tre': (load_pts_landmarks(task['fixed_landmarks']),
+                             load_pts_landmarks(task['moving_landmarks']))}
+    t1 = time.time()
+    m = qc_field(field, mask=mask, bwd=bwd, landmark_sets=landmarks, n_threads=1)
+    t2 = time.time()
+    passed, issues = gate(m)
+
+    row = {
+        'status': 'done', 'passed': bool(passed), 'issues': "; ".join(issues),
+        'n_voxels': m['n_voxels'],
+        'mag_median_mm': m['dvf_magnitude']['median_mm'],
+        'mag_p95_mm': m['dvf_magnitude']['p95_mm'],
+        'mag_max_mm': m['dvf_magnitude']['max_mm'],
+        'jac_p01': m['jacobian']['p01'], 'jac_p50': m['jacobian']['p50'],
+        'jac_p99': m['jacobian']['p99'], 'jac_min': m['jacobian']['min'],
+        'jac_max': m['jacobian']['max'], 'jac_pct_negative': m['jacobian']['pct_negative'],
+        'curl_median': m['curl']['median'], 'curl_p95': m['curl']['p95'],
+        'div_p01': m['divergence']['p01'], 'div_p99': m['divergence']['p99'],
+        'load_s': t1 - t0, 'qc_s': t2 - t1, 'total_s': t2 - t0
+    }
+    if 'inverse_consistency' in m:
+        row['ic_median_mm'] = m['inverse_consistency']['median_mm']
+        row['ic_p95_mm'] = m['inverse_consistency']['p95_mm']
+    if 'tre' in m:
+        row['tre_median_mm'] = m['tre']['median_mm']
+        row['tre_p95_mm'] = m['tre']['p95_mm']
+        row['tre_n_out_of_bounds'] = m['tre']['n_out_of_bounds']
+    return row
+
+def _hashes(task):
+    """Content digests of every input a task's metrics depend on."""
+    from hashing import file_digest, params_digest
+
+    lm = ""
+    if task['fixed_landmarks'] and task['moving_landmarks']:
+        lm = params_digest([file_digest(task['fixed_landmarks']),
+                            file_digest(task['moving_landmarks'])])
+    return {
+        'content_hash': file_digest(task['dvf']),
+        'mask_hash': file_digest(task['mask']) if task['mask'] else "",
+        'bwd_hash': file_digest(task['bwd']) if task['bwd'] else "",
+        'landmarks_hash': lm
+    }
+
+def _skip_key(row):
+    # Rows from older stores lack the bwd/landmark columns: treat as absent
+    return tuple(row.get(k) or "" for k in ('content_hash', 'mask_hash', 'bwd_hash', 'landmarks_hash'))
+
+def run_batch_qc(tasks, out_path=None, n_workers=None):
+    """
+    Score tasks on a process pool, skipping already-scored content.
+
+    Args:
+        tasks: collect_inputs output
+        out_path: result store (default: store_path())
+        n_workers: worker processes (default: one per core)
+
+    Returns:
+        (all rows in the store, number of newly scored fields)
+    """
+    out_path = Path(out_path) if out_path is not None else store_path()
+    rows = read_store(out_path)
+    scored = {_skip_key(r) for r in rows if r.get('status') == 'done'}
+    rows = [r for r in rows if r.get('status') == 'done']   # failures are retried
+
+    todo = []
+    for t in tasks:
+        t = dict(t, **_hashes(t))
+        key = _skip_key(t)
+        if key in scored:
+            continue
+        scored.add(key)
+        todo.append(t)
+    print(f"  {len(tasks)} field(s), {len(tasks) - len(todo)} already scored, {len(todo)} to score")
+    if not todo:
+        return rows, 0
+
+    n_workers = n_workers or min(len(todo), available_cores())
+    print(f"  {n_workers} worker(s) x 1 ITK thread -> {out_path}")
+
+    n_new = 0
+    with make_process_pool(n_workers, threads_per_worker=1) as pool:
+        futures = {pool.submit(_score, t): t for t in todo}
+        for fut in as_completed(futures):
+            t = futures[fut]
+            row = {c: t.get(c) for c in ('dvf', 'content_hash', 'mask', 'mask_hash',
+                                         'bwd', 'bwd_hash', 'landmarks_hash')}
+            row['scored_at'] = time.strftime("%Y-%m-%dT%H:%M:%S")
+            try:
+                row.update(fut.result())
+                print(f"    {Path(t['dvf']).name:36s} {'[PASS]' if row['passed'] else '[FAIL]'} "
+                      f"Jac P01 {row['jac_p01']:.3f} P99 {row['jac_p99']:.3f} ({row['total_s']:.1f} s)")
+            except Exception as e:
+                row.update({'status': 'failed', 'error': str(e)})
+                print(f"    {Path(t['dvf']).name:36s} FAILED: {e}")
+            if row['status'] == 'done':
+                # A rescored field supersedes its earlier row
+                rows = [r for r in rows if r['dvf'] != row['dvf']]
+            rows.append(row)
+            n_new += 1
+            if n_new % FLUSH_EVERY == 0:
+                write_store(rows, out_path)
+    write_store(rows, out_path)
+    return rows, n_new
+
+def main():
+    print("\n" + "="*70)
+    print("Batch DVF QC")
+    print("="*70 + "\n")
+
+    args = sys.argv[1:] or DEFAULT_GLOBS
+    tasks = collect_inputs(args)
+    if not tasks:
+        print(f"  No DVFs matched: {args}")
+        return
+
+    t0 = time.time()
+    rows, n_new = run_batch_qc(tasks)
+    done = [r for r in rows if r.get('status') == 'done']
+    n_pass = sum(str(r['passed']) == 'True' for r in done)
+
+    print("\n" + "="*70)
+    print(f"Scored {n_new} new field(s) in {time.time() - t0:.1f} s; "
+          f"store holds {len(done)} ({n_pass} passing)")
+    print(f"Results: {store_path()}")
+    print("="*70)
+
+if __name__ == "__main__":
+    main()
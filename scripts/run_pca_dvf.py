@@ -5,9 +5,20 @@ Extract principal breathing motion modes from validated Phase 1 DVFs
 """
 import ants
 import numpy as np
+import scipy.linalg
 import json
+import sys
 from pathlib import Path
 
+import mask_cache
+from image_bridge import geometry, to_ants
+from pca_model import MODEL_FILE, load_pca_model, save_model_file
+from sample_dvfs import iter_samples, write_sample_nifti
+
+MEMORY_BUDGET = 2 << 30   # bytes; larger design matrices use the out-of-core path
+PCA_METHOD = 'exact'      # 'randomized' for cohorts of hundreds of fields
+N_COMPONENTS = None       # keep all modes (required for 'randomized'; also caps incremental updates)
+
 def load_vector_field(path):
     """Load DVF and return ANTs image and numpy array"""
     v = ants.image_read(str(path))
@@ -27,25 +38,108 @@ def pack_fields_to_matrix(dvf_list, mask_img):
     N = number of DVFs
     """
     idx, vol_shape = mask_indices(mask_img)
+    X = pack_fields(dvf_list, idx)
+    return X, idx, vol_shape
+
+def pack_fields(dvf_list, idx):
+    """Stack masked vector voxels (flat mask indices idx) into X (P, N)"""
     N = len(dvf_list)
-    X = []
+    X = np.empty((3 * len(idx), N), dtype=np.float32)   # filled in place, no stacking copy
     
     print(f"  Packing {N} DVFs into matrix...")
     for i, dvf_path in enumerate(dvf_list):
         _, arr = load_vector_field(dvf_path)
         # Flatten xyz to one vector per component inside mask
-        v = arr.reshape(-1, 3)[idx, :]           # (|mask|, 3)
-        X.append(v.reshape(-1))                  # (3*|mask|,)
-        print(f"    DVF {i+1}/{N}: {len(v.reshape(-1))} elements")
+        X[:, i] = arr.reshape(-1, 3)[idx, :].reshape(-1)   # (3*|mask|,)
+        print(f"    DVF {i+1}/{N}: {X.shape[0]} elements")
     
-    X = np.stack(X, axis=1).astype(np.float32)   # (P, N)
     print(f"  Design matrix X: {X.shape} (P={X.shape[0]}, N={X.shape[1]})")
-    return X, idx, vol_shape
+    return X
+
+def pack_fields_memmap(dvf_list, idx, path):
+    """Stream masked DVFs into a float32 .npy memmap, one row per sample
+    
+    Rows (not columns) keep each sample's write contiguous on disk.
+    
+    Returns:
+        Xt: (N, P) memmap (transpose of X)
+    """
+    N = len(dvf_list)
+    Xt = np.lib.format.open_memmap(str(path), mode='w+', dtype=np.float32, shape=(N, 3 * len(idx)))
+    
+    print(f"  Streaming {N} DVFs into {path}...")
+    for i, dvf_path in enumerate(dvf_list):
+        _, arr = load_vector_field(dvf_path)
+        Xt[i] = arr.reshape(-1, 3)[idx, :].reshape(-1)
+        del arr
+        print(f"    DVF {i+1}/{N}")
+    Xt.flush()
+    print(f"  Design matrix X^T: {Xt.shape} on disk ({Xt.nbytes / 1e9:.2f} GB)")
+    return Xt
 
-def pca_smallN(X):
+def _column_block(N, P, memory_budget, bytes_per_entry=12):
+    """Largest P-block whose (N x block) working set fits the budget"""
+    return int(max(1, min(P, memory_budget // max(1, N * bytes_per_entry))))
+
+def pca_out_of_core(Xt, memory_budget=2 << 30, n_components=None):
+    """PCA of a memory-mapped (N, P) design matrix within a fixed memory budget
+    
+    Same result as pca_smallN, computed in P-blocks: the mean is removed in
+    place (Xt is modified), the N x N Gram matrix is accumulated block by
+    block in float64 and U = Xc V / S is formed one row block at a time.
+    
+    Args:
+        Xt: (N, P) float32 memmap from pack_fields_memmap (centered in place)
+        memory_budget: bytes for the per-block working set
+        n_components: keep the first K modes (default: all with S > 1e-8)
+    
+    Returns:
+        mu: (P,), U: (P,K), S: (N,), var_ratio (list)
+    """
+    N, P = Xt.shape
+    blk = _column_block(N, P, memory_budget)
+    print(f"\n  Computing out-of-core PCA (N={N}, P={P}, block={blk} columns)...")
+    
+    mu = np.empty(P, dtype=np.float32)
+    G = np.zeros((N, N), dtype=np.float64)
+    for p0 in range(0, P, blk):
+        p1 = min(P, p0 + blk)
+        b = Xt[:, p0:p1]
+        mu[p0:p1] = b.mean(axis=0)
+        b -= mu[p0:p1]                               # center in place
+        b64 = b.astype(np.float64)
+        G += b64 @ b64.T
+    if hasattr(Xt, 'flush'):
+        Xt.flush()
+    print(f"    Centered in place, Gram matrix {G.shape} accumulated")
+    
+    evals, V = np.linalg.eigh(G)
+    order = np.argsort(evals)[::-1]
+    evals, V = evals[order], V[:, order]
+    S = np.sqrt(np.maximum(evals, 0.0))
+    
+    K = int((S > 1e-8).sum())
+    if n_components is not None:
+        K = min(K, n_components)
+    W = (V[:, :K] / S[:K]).astype(np.float32)       # (N, K)
+    U = np.empty((P, K), dtype=np.float32)
+    for p0 in range(0, P, blk):
+        p1 = min(P, p0 + blk)
+        U[p0:p1] = Xt[:, p0:p1].T @ W
+    for k in range(K):
+        print(f"    PC {k+1}: singular value = {S[k]:.2f}")
+    
+    var = (S**2)
+    var_ratio = (var / (var.sum() + 1e-8)).tolist()
+    print(f"    Total PCs extracted: {K}")
+    print(f"    Variance explained: {[f'{v:.1%}' for v in var_ratio[:K]]}")
+    return mu, U, S, var_ratio
+
+def pca_smallN(X, n_components=None):
     """PCA via eigen-decomposition of covariance in sample space
     
     For small N (<< P), compute eigendecomposition of X^T X (N x N) instead of X X^T (P x P)
+    n_components keeps only the first K modes in U.
     """
     N = X.shape[1]
     print(f"\n  Computing PCA (N={N})...")
@@ -63,15 +157,13 @@ def pca_smallN(X):
     evals, V = evals[order], V[:, order]
     S = np.sqrt(np.maximum(evals, 0.0))         # singular values (length N)
     
-    # PCs (eigenfields) in voxel space: U_k = (Xc @ v_k) / S_k
-    U = []
-    for k in range(len(S)):
-        if S[k] > 1e-8:
-            Uk = (Xc @ V[:, k]) / S[k]
-            U.append(Uk)
-            print(f"    PC {k+1}: singular value = {S[k]:.2f}")
-    
-    U = np.stack(U, axis=1) if len(U) else np.zeros_like(Xc)
+    # PCs (eigenfields) in voxel space: U_k = (Xc @ v_k) / S_k, all K in one GEMM
+    K = int((S > 1e-8).sum())
+    if n_components is not None:
+        K = min(K, n_components)
+    U = Xc @ (V[:, :K] / S[:K]).astype(Xc.dtype)
+    for k in range(K):
+        print(f"    PC {k+1}: singular value = {S[k]:.2f}")
     
     # Variance explained
     var = (S**2)
@@ -82,6 +174,197 @@ def pca_smallN(X):
     
     return mu.squeeze(), U, S, var_ratio  # mu: (P,), U: (P,K), S: (K,)
 
+def _randomized_range(Xc_dot, XcT_dot, N, n_components, n_oversamples, n_power_iter, seed, dtype):
+    """Randomized range finder + small SVD given products with the centered matrix.
+    
+    Returns:
+        U: (P,K) float32, S: (K,)
+    """
+    l = min(N, n_components + n_oversamples)
+    rng = np.random.default_rng(seed)
+    Q = Xc_dot(rng.standard_normal((N, l)).astype(dtype))
+    for _ in range(n_power_iter):
+        Q = scipy.linalg.lu(Q, permute_l=True)[0]
+        Q = scipy.linalg.lu(XcT_dot(Q), permute_l=True)[0]
+        Q = Xc_dot(Q)
+    Q, _ = np.linalg.qr(Q)
+    
+    B = XcT_dot(Q).T                              # (l, N) = Q^T Xc
+    Ub, S, _ = np.linalg.svd(B.astype(np.float64), full_matrices=False)
+    K = min(n_components, int((S > 1e-8).sum()))
+    U = (Q @ Ub[:, :K].astype(Q.dtype)).astype(np.float32)
+    S = S[:K]
+    for k in range(K):
+        print(f"    PC {k+1}: singular value = {S[k]:.2f}")
+    return U, S
+
+def pca_randomized(X, n_components, n_oversamples=10, n_power_iter=4, seed=0):
+    """Top-K PCA by randomized range finding (Halko, Martinsson & Tropp 2011)
+    
+    The centered matrix is never formed: products with Xc = X - mu 1^T are
+    applied implicitly. A Gaussian sketch of width K + n_oversamples is
+    refined by n_power_iter LU-normalized power iterations (one final QR),
+    then the small projected matrix is decomposed exactly. Cost O(P N (K+p) q) instead of
+    the O(P N^2) Gram matrix of the exact path.
+    
+    Args:
+        X: (P, N) stacked samples
+        n_components: number of modes K to return
+    
+    Returns:
+        mu: (P,), U: (P,K), S: (K,), var_ratio (list, fraction of total variance)
+    """
+    P, N = X.shape
+    l = min(N, n_components + n_oversamples)
+    print(f"\n  Computing randomized PCA (N={N}, K={n_components}, sketch={l}, power iters={n_power_iter})...")
+    
+    mu = X.mean(axis=1)                          # (P,)
+    def Xc_dot(M):                               # Xc @ M, M: (N, l)
+        return X @ M - np.outer(mu, M.sum(axis=0))
+    def XcT_dot(Q):                              # Xc^T @ Q, Q: (P, l)
+        return X.T @ Q - (mu @ Q)[None, :]
+    
+    U, S = _randomized_range(Xc_dot, XcT_dot, N, n_components, n_oversamples, n_power_iter,
+                             seed, X.dtype)
+    
+    # ||Xc||_F^2 without forming Xc
+    col_sq = np.einsum('ij,ij->j', X, X).astype(np.float64)
+    total = float(col_sq.sum() - N * np.dot(mu.astype(np.float64), mu))
+    var_ratio = (S**2 / (total + 1e-8)).tolist()
+    print(f"    Variance explained: {[f'{v:.1%}' for v in var_ratio]}")
+    return mu.astype(np.float32), U, S, var_ratio
+
+def pca_randomized_out_of_core(Xt, n_components, memory_budget=2 << 30, n_oversamples=10,
+                               n_power_iter=4, seed=0):
+    """pca_randomized on a memory-mapped (N, P) design matrix, in P-blocks
+    
+    Every product with the (implicitly centered) matrix streams Xt block by
+    block within memory_budget; only the (P, K+p) sketch is held in RAM. Xt
+    is not modified.
+    
+    Returns:
+        mu: (P,), U: (P,K), S: (K,), var_ratio (list)
+    """
+    N, P = Xt.shape
+    blk = _column_block(N, P, memory_budget)
+    l = min(N, n_components + n_oversamples)
+    print(f"\n  Computing out-of-core randomized PCA (N={N}, P={P}, K={n_components}, "
+          f"sketch={l}, block={blk} columns)...")
+    blocks = [(p0, min(P, p0 + blk)) for p0 in range(0, P, blk)]
+    
+    mu = np.empty(P, dtype=np.float32)
+    total = 0.0
+    for p0, p1 in blocks:
+        b = np.asarray(Xt[:, p0:p1], dtype=np.float64)
+        mu[p0:p1] = b.mean(axis=0)
+        total += float(((b - b.mean(axis=0))**2).sum())
+    
+    def Xc_dot(M):                               # (P, l)
+        out = np.empty((P, M.shape[1]), dtype=np.float32)
+        msum = M.sum(axis=0)
+        for p0, p1 in blocks:
+            out[p0:p1] = Xt[:, p0:p1].T @ M - np.outer(mu[p0:p1], msum)
+        return out
+    def XcT_dot(Q):                              # (N, l)
+        out = np.zeros((N, Q.shape[1]), dtype=np.float64)
+        for p0, p1 in blocks:
+            out += Xt[:, p0:p1] @ Q[p0:p1] - (mu[p0:p1] @ Q[p0:p1])[None, :]
+        return out.astype(np.float32)
+    
+    U, S = _randomized_range(Xc_dot, XcT_dot, N, n_components, n_oversamples, n_power_iter,
+                             seed, np.float32)
+    var_ratio = (S**2 / (total + 1e-8)).tolist()
+    print(f"    Variance explained: {[f'{v:.1%}' for v in var_ratio]}")
+    return mu, U, S, var_ratio
+
+def pca(X, n_components=None, method='exact', **kwargs):
+    """PCA stage: method 'exact' (pca_smallN) or 'randomized' (needs n_components)
+    
+    Returns:
+        mu: (P,), U: (P,K), S, var_ratio
+    """
+    if method == 'exact':
+        return pca_smallN(X, n_components=n_components)
+    if method == 'randomized':
+        if n_components is None:
+            raise ValueError("method='randomized' needs n_components")
+        return pca_randomized(X, n_components, **kwargs)
+    raise ValueError(f"Unknown PCA method: {method}")
+
+def pca_memmap(Xt, n_components=None, method='exact', memory_budget=2 << 30, **kwargs):
+    """Out-of-core PCA stage: the pca() methods on a memory-mapped (N, P) matrix
+    
+    'exact' is pca_out_of_core (centers Xt in place), 'randomized' is
+    pca_randomized_out_of_core (needs n_components, Xt untouched).
+    """
+    if method == 'exact':
+        return pca_out_of_core(Xt, memory_budget, n_components=n_components)
+    if method == 'randomized':
+        if n_components is None:
+            raise ValueError("method='randomized' needs n_components")
+        return pca_randomized_out_of_core(Xt, n_components, memory_budget=memory_budget, **kwargs)
+    raise ValueError(f"Unknown PCA method: {method}")
+
+def pca_update(mu, U, S, n_samples, X_new, rel_tol=1e-6, max_rank=None):
+    """Incremental PCA: fold new samples into an existing model
+    
+    Sequential Karhunen-Loeve update with mean correction (Ross et al. 2008):
+    the new centered block plus one mean-shift column is split into its part
+    inside span(U) and an orthonormal residual Q, and the small
+    (K+m+1)-square core [[diag(S), U^T B], [0, R]] is re-diagonalized.
+    Cost is O(P (K+m)^2) for m new samples. The rank K grows by up to m
+    per update (up to n_samples - 1) unless max_rank truncates it; only with
+    max_rank set is the cost bounded independently of n_samples. Truncation
+    drops the energy of the discarded modes, so the model is then the best
+    rank-max_rank approximation of what it kept, not the exact batch PCA.
+    
+    Args:
+        mu: (P,) current mean
+        U: (P, K) current PCs
+        S: (K,) current singular values of the centered data
+        n_samples: number of samples in the current model
+        X_new: (P, m) new samples
+        rel_tol: drop modes with S_k < rel_tol * S_1
+        max_rank: keep at most this many modes (default: no cap)
+    
+    Returns:
+        mu: (P,), U: (P, K'), S: (K',), var_ratio (list), n_samples (int)
+    """
+    m = X_new.shape[1]
+    n_total = n_samples + m
+    print(f"\n  Updating PCA (N={n_samples} + {m})...")
+    
+    mu_new = X_new.mean(axis=1)
+    B = np.concatenate([
+        X_new - mu_new[:, None],
+        (np.sqrt(n_samples * m / n_total) * (mu_new - mu))[:, None]
+    ], axis=1).astype(np.float32)                # (P, m+1)
+    
+    K = len(S)
+    proj = U.T @ B                               # (K, m+1)
+    R = B - U @ proj
+    Q, R_q = np.linalg.qr(R)                     # (P, m+1), (m+1, m+1)
+    
+    core = np.zeros((K + m + 1, K + m + 1))
+    core[:K, :K] = np.diag(S)
+    core[:K, K:] = proj
+    core[K:, K:] = R_q
+    U_c, S_c, _ = np.linalg.svd(core)
+    
+    keep = S_c > rel_tol * max(S_c[0], 1e-12)
+    if max_rank is not None:
+        keep[max_rank:] = False
+    U_out = (np.concatenate([U, Q], axis=1) @ U_c[:, keep].astype(np.float32)).astype(np.float32)
+    S_out = S_c[keep]
+    mu_out = ((n_samples * mu + m * mu_new) / n_total).astype(np.float32)
+    
+    # Fractions of the variance before truncation (dropped modes included)
+    var_ratio = (S_out**2 / ((S_c**2).sum() + 1e-8)).tolist()
+    for k in range(len(S_out)):
+        print(f"    PC {k+1}: singular value = {S_out[k]:.2f}")
+    print(f"    Variance explained: {[f'{v:.1%}' for v in var_ratio]}")
+    return mu_out, U_out, S_out, var_ratio, n_total
+
 def unpack_to_vector_image(vec, idx, vol_shape, like_img):
     """Unpack masked vector back to (X,Y,Z,3) ANTs vector image"""
     out = np.zeros((np.prod(vol_shape), 3), dtype=np.float32)
@@ -118,14 +401,9 @@ def main():
     ref_iso = ants.image_read(str(synth_base/"phase50_iso_like_dvf.nii.gz"))
     print(f"   Reference: {ref_iso.shape}, {ref_iso.spacing}")
     
-    mask50 = ants.image_read("data/preprocessed/popi_ants/phase50_lung_mask.nii.gz").clone('unsigned char')
-    mask50 = ants.apply_transforms(
-        fixed=ref_iso,
-        moving=mask50,
-        transformlist=[],
-        interpolator='nearestNeighbor'
-    ).clone('unsigned char')
-    print(f"   Mask voxels: {(mask50.numpy() > 0).sum()}")
+    idx, vol_shape = mask_cache.mask_indices(
+        "data/preprocessed/popi_ants/phase50_lung_mask.nii.gz", ref_iso, rule='nearest')
+    print(f"   Mask voxels: {idx.size}")
 
     # DVFs to analyze
     print("\n2. Collecting DVFs...")
@@ -142,53 +420,130 @@ def main():
 
     # Stack and PCA
     print("\n3. Packing DVFs and computing PCA...")
-    X, idx, vol_shape = pack_fields_to_matrix(dvfs, mask50)
-    mu, U, S, var_ratio = pca_smallN(X)   # mu: (P,), U: (P,K), S: (K,)
+    matrix_bytes = 3 * len(idx) * len(dvfs) * 4
+    if 3 * matrix_bytes <= MEMORY_BUDGET:   # X, Xc and temporaries in RAM
+        X = pack_fields(dvfs, idx)
+        mu, U, S, var_ratio = pca(X, n_components=N_COMPONENTS, method=PCA_METHOD)   # mu: (P,), U: (P,K)
+    else:
+        print(f"   Design matrix {matrix_bytes / 1e9:.2f} GB exceeds budget - out-of-core path")
+        Xt = pack_fields_memmap(dvfs, idx, out_dir/"design_matrix.npy")
+        mu, U, S, var_ratio = pca_memmap(Xt, n_components=N_COMPONENTS, method=PCA_METHOD,
+                                         memory_budget=MEMORY_BUDGET)
+        del Xt
+        (out_dir/"design_matrix.npy").unlink()
     K = U.shape[1]
 
     # Save mean and PCs as vector images
     print("\n4. Saving mean field and principal components...")
-    mean_img = unpack_to_vector_image(mu, idx, vol_shape, ref_iso)
+    save_model(out_dir, mu, U, S, var_ratio, len(dvfs), idx, vol_shape, ref_iso,
+               sample_names=[p.name for p in dvfs])
+
+    # Synthesis: ±1 SD and ±2 SD for first two modes
+    print("\n5. Synthesizing DVFs at ±1 SD and ±2 SD...")
+    write_sd_samples(out_dir, mu, U, S, len(dvfs), idx, vol_shape, ref_iso)
+
+    print("\n" + "="*70)
+    print("Phase 3 PCA COMPLETE")
+    print("="*70)
+    print(f"Output directory: {out_dir}")
+    print(f"Principal components: {K}")
+    print(f"Cumulative variance explained: {np.cumsum(var_ratio[:K]).tolist()}")
+    print("="*70)
+
+def save_model(out_dir, mu, U, S, var_ratio, n_samples, idx, vol_shape, ref_img, sample_names=None):
+    """Write the model file (pca_model.bin) plus pc_mean, pc_k and pca_meta.json for viewing
+    
+    Stale pc_k beyond K are removed.
+    """
+    K = U.shape[1]
+    save_model_file(out_dir/MODEL_FILE, mu, U, S, var_ratio, n_samples, idx, vol_shape,
+                    geometry(ref_img), samples=sample_names)
+    print(f"   Saved: {MODEL_FILE} ({(out_dir/MODEL_FILE).stat().st_size / 1e6:.1f} MB)")
+    
+    mean_img = unpack_to_vector_image(mu, idx, vol_shape, ref_img)
     ants.image_write(mean_img, str(out_dir/"pc_mean.nii.gz"))
     print(f"   Saved: pc_mean.nii.gz")
     
     pcs_meta = {
-        "n_samples": len(dvfs),
+        "n_samples": n_samples,
         "n_components": K,
         "singular_values": S[:K].tolist(),
         "variance_explained": var_ratio[:K],
-        "cumulative_variance": np.cumsum(var_ratio[:K]).tolist()
+        "cumulative_variance": np.cumsum(var_ratio[:K]).tolist(),
+        "samples": list(sample_names or [])
     }
     
     for k in range(K):
-        pc_k_img = unpack_to_vector_image(U[:,k], idx, vol_shape, ref_iso)
+        pc_k_img = unpack_to_vector_image(U[:,k], idx, vol_shape, ref_img)
         ants.image_write(pc_k_img, str(out_dir/f"pc_{k+1}.nii.gz"))
         print(f"   Saved: pc_{k+1}.nii.gz (variance explained: {var_ratio[k]:.1%})")
+    k = K + 1
+    while (out_dir/f"pc_{k}.nii.gz").exists():
+        (out_dir/f"pc_{k}.nii.gz").unlink()
+        print(f"   Removed stale: pc_{k}.nii.gz")
+        k += 1
     
     with open(out_dir/"pca_meta.json","w") as f:
         json.dump(pcs_meta, f, indent=2)
     print(f"   Saved: pca_meta.json")
 
-    # Synthesis: ±1 SD and ±2 SD for first two modes
-    print("\n5. Synthesizing DVFs at ±1 SD and ±2 SD...")
-    scale = (S / np.sqrt(max(1, X.shape[1]-1))).astype(np.float32)  # per-mode SD
+def write_sd_samples(out_dir, mu, U, S, n_samples, idx, vol_shape, ref_img):
+    """Synthesize ±1 SD and ±2 SD DVFs along the first two modes (one chunked GEMM)"""
+    K = U.shape[1]
+    scale = (S[:K] / np.sqrt(max(1, n_samples-1))).astype(np.float32)  # per-mode SD
+    model = {'mu': mu, 'U': U, 'scale': scale, 'idx': idx, 'vol_shape': tuple(vol_shape),
+             'geom': geometry(ref_img)}
+    
+    specs = [(k, s) for k in range(min(2, K)) for s in [-2.0, -1.0, 1.0, 2.0]]
+    B = np.zeros((K, len(specs)))
+    for j, (k, s) in enumerate(specs):
+        B[k, j] = s
     
-    for k in range(min(2, K)):
-        print(f"   PC {k+1} (SD = {scale[k]:.3f}):")
-        for s in [-2.0, -1.0, 1.0, 2.0]:
-            u_syn = mu + U[:,k] * (s * scale[k])
-            u_img = unpack_to_vector_image(u_syn, idx, vol_shape, ref_iso)
-            fname = f"pc{k+1}_{'m' if s<0 else 'p'}{int(abs(s))}sd.nii.gz"
-            ants.image_write(u_img, str(out_dir/fname))
-            print(f"      {fname}")
+    for (k, s), u_syn in zip(specs, iter_samples(model, B)):
+        if s == -2.0:
+            print(f"   PC {k+1} (SD = {scale[k]:.3f}):")
+        fname = f"pc{k+1}_{'m' if s<0 else 'p'}{int(abs(s))}sd.nii.gz"
+        write_sample_nifti(model, u_syn, out_dir/fname)
+        print(f"      {fname}")
 
-    print("\n" + "="*70)
-    print("Phase 3 PCA COMPLETE")
+def update_pca(new_dvfs, out_dir=Path("results/pca"),
+               mask_path=Path("data/preprocessed/popi_ants/phase50_lung_mask.nii.gz")):
+    """Add new DVFs to the saved model without repacking the existing ones"""
     print("="*70)
-    print(f"Output directory: {out_dir}")
-    print(f"Principal components: {K}")
-    print(f"Cumulative variance explained: {np.cumsum(var_ratio[:K]).tolist()}")
+    print("Phase 3: Incremental PCA Update")
+    print("="*70)
+    
+    out_dir = Path(out_dir)
+    new_dvfs = [Path(p) for p in new_dvfs]
+    for p in new_dvfs:
+        if not p.exists():
+            raise FileNotFoundError(p)
+    
+    print("\n1. Loading saved model...")
+    model = load_pca_model(out_dir, mask_path)
+    ref_img = to_ants(np.zeros(model['vol_shape'], dtype=np.float32), like=model['geom'])
+    print(f"   N={model['n_samples']}, K={model['U'].shape[1]}, mask voxels: {model['idx'].size}")
+    
+    print(f"\n2. Packing {len(new_dvfs)} new DVF(s) and updating...")
+    X_new = pack_fields(new_dvfs, model['idx'])
+    mu, U, S, var_ratio, n_samples = pca_update(
+        model['mu'], model['U'], model['S'], model['n_samples'], X_new, max_rank=N_COMPONENTS)
+    
+    print("\n3. Saving updated model...")
+    save_model(out_dir, mu, U, S, var_ratio, n_samples, model['idx'], model['vol_shape'], ref_img,
+               sample_names=list(model['samples']) + [p.name for p in new_dvfs])
+    
+    print("\n4. Re-synthesizing ±1 SD and ±2 SD DVFs...")
+    write_sd_samples(out_dir, mu, U, S, n_samples, model['idx'], model['vol_shape'], ref_img)
+    
+    print("\n" + "="*70)
+    print(f"PCA updated: N={n_samples}, K={U.shape[1]}")
+    print(f"Cumulative variance explained: {np.cumsum(var_ratio).tolist()}")
     print("="*70)
 
 if __name__ == "__main__":
-    main()
+    # python run_pca_dvf.py --add new_dvf1.nii.gz [new_dvf2.nii.gz ...]
+    if len(sys.argv) > 2 and sys.argv[1] == "--add":
+        update_pca(sys.argv[2:])
+    else:
+        main()
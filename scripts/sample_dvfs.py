@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""
+Phase 3: Ensemble Sampling of Synthetic DVFs
+Generates large ensembles u_j = mu + U @ (beta_j * scale) in the masked
+domain, one GEMM per column chunk of the beta matrix. Samples are yielded
+lazily; nothing is written unless requested, and then either as one masked
+(N, P) float32 .npy store or as individual DVF NIfTIs.
+
+Betas come from the model's Gaussian (beta ~ N(0, I) in SD units) or from a
+user-supplied (K, N) matrix. With a safety map (beta_safety_map.py), draws
+that fall in the map's failing region are rejected before synthesis.
+"""
+
+import json
+from pathlib import Path
+
+import numpy as np
+
+from beta_safety_map import DEFAULT_MAP, check_map_model, is_safe, load_safety_map
+from dvf_ops import write_field
+from pca_model import load_pca_model, unpack_field
+
+def filter_safe_betas(smap, betas):
+    """Keep the columns of a (K, N) beta matrix that the safety map accepts."""
+    B = np.atleast_2d(np.asarray(betas))
+    return B[:, is_safe(smap, B.T)]
+
+def gaussian_betas(K, n, seed=0, clip_sd=None, safety_map=None, max_rounds=100):
+    """
+    (K, n) betas drawn from the model prior N(0, I) in SD units.
+
+    Args:
+        clip_sd: optionally clip to [-clip_sd, clip_sd]
+        safety_map: optional beta_safety_map map covering all K modes;
+                    unsafe draws are rejected and redrawn
+        max_rounds: give up after this many rejection rounds
+    """
+    if safety_map is not None and safety_map['d'] < K:
+        raise ValueError(f"Safety map covers {safety_map['d']} modes, sampling {K}: "
+                         f"every draw would be rejected")
+    rng = np.random.default_rng(seed)
+    kept, n_kept = [], 0
+    for _ in range(max_rounds):
+        B = rng.standard_normal((K, n))
+        if clip_sd is not None:
+            B = np.clip(B, -clip_sd, clip_sd)
+        if safety_map is not None:
+            B = filter_safe_betas(safety_map, B)[:, :n - n_kept]
+        kept.append(B)
+        n_kept += B.shape[1]
+        if n_kept == n:
+            return np.concatenate(kept, axis=1)
+    raise RuntimeError(f"Only {n_kept}/{n} safe betas after {max_rounds} rounds")
+
+def iter_sample_chunks(model, betas, chunk=64, sd_units=True):
+    """
+    Yield (j0, block) with block = mu + U @ B[:, j0:j0+c] as a (P, c) float32 array.
+
+    Args:
+        model: dict with mu (P,), U (P,K) and scale (K,) (pca_model.load_pca_model)
+        betas: (k, N) beta matrix, k <= K (missing trailing modes are zero)
+        sd_units: betas in SD units (False: raw coefficients in mm)
+    """
+    B = np.atleast_2d(np.asarray(betas, dtype=np.float32))
+    k = B.shape[0]
+    if k > model['U'].shape[1]:
+        raise ValueError(f"betas have {k} modes, model has {model['U'].shape[1]}")
+    U = model['U'][:, :k]
+    if sd_units:
+        B = B * np.asarray(model['scale'][:k], dtype=np.float32)[:, None]
+    mu = np.asarray(model['mu'], dtype=np.float32)[:, None]
+    for j0 in range(0, B.shape[1], chunk):
+        block = U @ B[:, j0:j0 + chunk]
+        block += mu
+        yield j0, block
+
+def iter_samples(model, betas, chunk=64, sd_units=True):
+    """Yield masked (P,) samples one at a time (views into the current chunk)."""
+    for _, block in iter_sample_chunks(model, betas, chunk=chunk, sd_units=sd_units):
+        for j in range(block.shape[1]):
+            yield block[:, j]
+
+def write_sample_store(model, betas, out_path, chunk=64, sd_units=True):
+    """
+    Write all samples as a masked (N, P) float32 .npy (memory-mapped while
+    writing) plus a JSON sidecar with the betas.
+
+    Returns:
+        out_path
+    """
+    B = np.atleast_2d(np.asarray(betas, dtype=np.float64))
+    out_path = Path(out_path)
+    store = np.lib.format.open_memmap(out_path, mode='w+', dtype=np.float32,
+                                      shape=(B.shape[1], model['mu'].size))
+    for j0, block in iter_sample_chunks(model, B, chunk=chunk, sd_units=sd_units):
+        store[j0:j0 + block.shape[1]] = block.T
+    store.flush()
+    del store
+    with open(out_path.with_suffix(".json"), 'w') as f:
+        json.dump({'betas': B.tolist(), 'sd_units': sd_units, 'layout': "(N, P) masked, model order"},
+                  f, indent=2)
+    return out_path
+
+def write_sample_nifti(model, vec, out_path):
+    """One masked sample -> full-grid DVF NIfTI on the model grid."""
+    write_field(unpack_field(model, vec), out_path, like=model['geom'])
+
+def main():
+    print("="*70)
+    print("Phase 3: Synthetic DVF Ensemble")
+    print("="*70)
+
+    pca_dir = Path("results/pca")
+    out_dir = Path("results/pca/ensemble")
+    out_dir.mkdir(parents=True, exist_ok=True)
+    n_samples = 1000
+
+    print("\n1. Loading PCA model...")
+    model = load_pca_model(pca_dir)
+    K = model['U'].shape[1]
+    print(f"   Modes: {K}, P = {model['mu'].size}")
+
+    smap = None
+    if DEFAULT_MAP.exists():
+        smap = load_safety_map(DEFAULT_MAP)
+        check_map_model(smap, K)
+        print(f"   Safety map: {DEFAULT_MAP} ({smap['passed'].size} points, {smap['d']} modes)")
+        if smap['d'] < K:
+            print(f"   Map covers {smap['d']} of {K} modes: not applied (rebuild with d = {K})")
+            smap = None
+
+    print(f"\n2. Drawing {n_samples} Gaussian beta samples (clipped to +/-3 SD)...")
+    betas = gaussian_betas(K, n_samples, seed=0, clip_sd=3.0, safety_map=smap)
+
+    print("\n3. Synthesizing in column chunks...")
+    out_path = write_sample_store(model, betas, out_dir / "ensemble_masked.npy")
+    print(f"   Saved: {out_path} ({n_samples} x {model['mu'].size} float32)")
+
+    print("\n" + "="*70)
+    print(f"Ensemble written to: {out_dir}")
+    print("="*70)
+
+if __name__ == "__main__":
+    main()
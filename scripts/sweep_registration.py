@@ -0,0 +1,308 @@
+"""
+Phase 1: Parallel Registration Hyperparameter Sweep with TRE Pruning
+Grid or random search over syn_roi_masked settings (grad_step, cc_radius,
+iso spacing, pyramid), scored by TRE against the POPI landmarks.
+
+Three stages, each spread over a process pool:
+0. Preprocessing + affine once per distinct iso spacing (registration cache)
+1. Coarse run of every configuration (first pyramid levels only) -> coarse TRE
+2. Full runs in order of coarse TRE. A configuration is pruned when a full
+   run that passes the TRE gate (compute_phase70_qc.tre_issues: median and
+   P95) dominates it at the coarse stage: coarse TRE better by more than
+   prune_margin_mm and coarse wall time no longer. A pruned configuration
+   can then be neither the most accurate nor the fastest passing setting.
+
+Full runs start from the affine, not from the coarse warp, so their TRE is
+that of a standalone registration. The coarse stage is therefore extra cost
+on top of the full runs: it is reported, and each configuration's
+total_wall_s includes its coarse run.
+
+Output: ranked table (CSV + JSON) with TRE and wall time per configuration.
+"""
+
+import csv
+import itertools
+import json
+import time
+from concurrent.futures import wait, FIRST_COMPLETED
+from pathlib import Path
+
+import numpy as np
+
+from parallel import available_cores, make_process_pool, thread_budget
+
+# Named pyramids: (shrink factors, smoothing sigmas, iterations)
+PYRAMIDS = {
+    'safe4': ((8, 4, 2, 1), (4, 2, 1, 0), (100, 100, 100, 120)),
+    'fine4': ((8, 4, 2, 1), (4, 2, 1, 0), (100, 100, 100, 200)),
+    'fast3': ((4, 2, 1), (2, 1, 0), (100, 70, 50)),
+    'deep5': ((16, 8, 4, 2, 1), (6, 4, 2, 1, 0), (100, 100, 100, 100, 120)),
+}
+
+DEFAULT_SPACE = {
+    'grad_step': [0.02, 0.025, 0.03, 0.04],
+    'cc_radius': [2, 3, 4],
+    'iso': [1.75, 2.0],
+    'pyramid': ['safe4', 'fast3'],
+}
+
+def grid_configs(space):
+    """All combinations of the parameter space (dict name -> list)."""
+    names = sorted(space)
+    return [dict(zip(names, values)) for values in itertools.product(*(space[n] for n in names))]
+
+def random_configs(space, n, seed=0):
+    """n distinct random draws from the parameter space."""
+    rng = np.random.default_rng(seed)
+    names = sorted(space)
+    seen, configs = set(), []
+    n_total = int(np.prod([len(space[k]) for k in names]))
+    while len(configs) < min(n, n_total):
+        cfg = {k: space[k][rng.integers(len(space[k]))] for k in names}
+        key = json.dumps(cfg, sort_keys=True)
+        if key not in seen:
+            seen.add(key)
+            configs.append(cfg)
+    return configs
+
+def coarse_pyramid(pyramid, n_levels):
+    """First n_levels of a pyramid (coarsest first)."""
+    shrinks, sigmas, iters = pyramid
+    return shrinks[:n_levels], sigmas[:n_levels], iters[:n_levels]
+
+def _prepare(task):
+    """Worker: preprocessing + affine for one iso spacing (fills the cache)."""
+    from run_ants_syn_roi import load_or_prepare_roi_inputs
+    t0 = time.time()
+    load_or_prepare_roi_inputs(**task['inputs'], iso=task['iso'], **task['prep'])
+    return time.time() - t0
+
+def _run_config(task):
+    """Worker: SyN for one configuration at coarse or full depth, scored by TRE."""
+    import ants
+    from run_ants_syn_roi import load_or_prepare_roi_inputs, syn_deformable
+    from compute_phase70_qc import compute_tre_ants
+
+    cfg = task['config']
+    prepared = load_or_prepare_roi_inputs(**task['inputs'], iso=cfg['iso'], **task['prep'])
+
+    pyramid = PYRAMIDS[cfg['pyramid']]
+    if task['stage'] == 'coarse':
+        pyramid = coarse_pyramid(pyramid, task['coarse_levels'])
+
+    t0 = time.time()
+    dvf = syn_deformable(
+        prepared['fix_iso'], prepared['mov_iso'],
+        prepared['fix_mask_iso'], prepared['mov_mask_iso'],
+        prepared['affine'], grad_step=cfg['grad_step'], cc_radius=cfg['cc_radius'],
+        pyramid=pyramid
+    )
+    wall = time.time() - t0
+
+    ants.image_write(dvf, task['dvf_path'])
+    tre = compute_tre_ants(task['dvf_path'], task['fixed_landmarks'], task['moving_landmarks'])
+    return {'tre': tre, 'wall_s': wall}
+
+def run_sweep(configs, inputs, fixed_landmarks, moving_landmarks, out_dir,
+              prep=None, coarse_levels=2, prune_margin_mm=0.5,
+              n_workers=None, threads_per_worker=None):
+    """
+    Run a pruned hyperparameter sweep.
+
+    Args:
+        configs: list of dicts with grad_step, cc_radius, iso, pyramid (PYRAMIDS key)
+        inputs: fix_path, mov_path, fix_mask_path, mov_mask_path
+        fixed_landmarks, moving_landmarks: Nx3 arrays in mm
+        out_dir: directory for DVFs and result tables
+        prep: margin_mm, mask_dilation, cache_dir for preprocessing
+        coarse_levels: pyramid levels in the coarse stage
+        prune_margin_mm: coarse-TRE margin over a dominating passing run
+
+    Returns:
+        list of result rows sorted by rank
+    """
+    from compute_phase70_qc import tre_issues
+
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    prep = dict(prep or {})
+    prep.setdefault('cache_dir', "results/cache/registration")
+    inputs = {k: str(v) for k, v in inputs.items()}
+
+    n_cores = available_cores()
+    if n_workers is None:
+        n_workers = max(1, min(len(configs), n_cores // 4))
+    if threads_per_worker is None:
+        threads_per_worker = thread_budget(n_workers, n_cores)
+
+    rows = [{'id': i, **cfg, 'status': 'pending'} for i, cfg in enumerate(configs)]
+
+    def task(i, stage):
+        return {
+            'config': configs[i], 'stage': stage, 'coarse_levels': coarse_levels,
+            'inputs': inputs, 'prep': prep,
+            'fixed_landmarks': fixed_landmarks, 'moving_landmarks': moving_landmarks,
+            'dvf_path': str(out_dir / f"cfg{i:03d}_{stage}.nii.gz")
+        }
+
+    print(f"  {len(configs)} configurations, {n_workers} workers x {threads_per_worker} ITK threads")
+
+    with make_process_pool(n_workers, threads_per_worker) as pool:
+        # Stage 0: preprocessing per iso spacing
+        isos = sorted({cfg['iso'] for cfg in configs})
+        print(f"\n  [0/2] Preprocessing + affine for iso {isos}")
+        for fut in [pool.submit(_prepare, {'inputs': inputs, 'prep': prep, 'iso': iso}) for iso in isos]:
+            fut.result()
+
+        # Stage 1: coarse runs
+        print(f"\n  [1/2] Coarse runs ({coarse_levels} levels)")
+        futures = {pool.submit(_run_config, task(i, 'coarse')): i for i in range(len(configs))}
+        for fut in futures:
+            i = futures[fut]
+            try:
+                res = fut.result()
+                rows[i]['coarse_tre_median_mm'] = res['tre']['median_mm']
+                rows[i]['coarse_wall_s'] = res['wall_s']
+                print(f"    cfg{i:03d} coarse TRE {res['tre']['median_mm']:.2f} mm ({res['wall_s']:.0f} s)")
+            except Exception as e:
+                rows[i]['status'] = 'failed'
+                rows[i]['error'] = str(e)
+                print(f"    cfg{i:03d} FAILED: {e}")
+
+        # Stage 2: full runs, most promising first, with pruning
+        print(f"\n  [2/2] Full runs (prune margin {prune_margin_mm} mm)")
+        queue = sorted((r for r in rows if r['status'] == 'pending'),
+                       key=lambda r: r['coarse_tre_median_mm'])
+        running = {}
+        passing = []  # full runs that pass the TRE gate
+
+        def dominated(row):
+            return any(row['coarse_tre_median_mm'] > p['coarse_tre_median_mm'] + prune_margin_mm
+                       and p['coarse_wall_s'] <= row['coarse_wall_s'] for p in passing)
+
+        while queue or running:
+            while queue and len(running) < n_workers:
+                row = queue.pop(0)
+                if dominated(row):
+                    row['status'] = 'pruned'
+                    row['total_wall_s'] = row['coarse_wall_s']
+                    print(f"    cfg{row['id']:03d} pruned (coarse {row['coarse_tre_median_mm']:.2f} mm)")
+                    continue
+                running[pool.submit(_run_config, task(row['id'], 'full'))] = row
+
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for fut in done:
+                row = running.pop(fut)
+                try:
+                    res = fut.result()
+                    issues = tre_issues(res['tre'])
+                    row.update({
+                        'status': 'done',
+                        'tre_median_mm': res['tre']['median_mm'],
+                        'tre_p95_mm': res['tre']['p95_mm'],
+                        'wall_s': res['wall_s'],
+                        'total_wall_s': row['coarse_wall_s'] + res['wall_s'],
+                        'passes_gate': not issues,
+                        'gate_issues': "; ".join(issues)
+                    })
+                    print(f"    cfg{row['id']:03d} TRE {row['tre_median_mm']:.2f} mm, "
+                          f"P95 {row['tre_p95_mm']:.2f} mm ({row['wall_s']:.0f} s)")
+                    if not issues:
+                        passing.append(row)
+                except Exception as e:
+                    row['status'] = 'failed'
+                    row['error'] = str(e)
+                    print(f"    cfg{row['id']:03d} FAILED: {e}")
+
+    coarse_s = sum(r.get('coarse_wall_s', 0.0) for r in rows)
+    full_s = sum(r.get('wall_s', 0.0) for r in rows)
+    print(f"\n  Worker time: coarse {coarse_s:.0f} s + full {full_s:.0f} s "
+          f"(coarse stage adds {100 * coarse_s / max(full_s, 1e-9):.0f}% to the full runs)")
+
+    ranked = rank_results(rows)
+    write_results(ranked, out_dir)
+    return ranked
+
+def rank_results(rows):
+    """Completed runs by full TRE, then pruned runs by coarse TRE, then failures."""
+    def key(r):
+        if r['status'] == 'done':
+            return (0, r['tre_median_mm'])
+        if r['status'] == 'pruned':
+            return (1, r['coarse_tre_median_mm'])
+        return (2, 0.0)
+    ranked = sorted(rows, key=key)
+    for rank, r in enumerate(ranked, 1):
+        r['rank'] = rank
+    return ranked
+
+def write_results(ranked, out_dir):
+    """Write sweep_results.csv and sweep_results.json."""
+    out_dir = Path(out_dir)
+    columns = ['rank', 'id', 'status', 'grad_step', 'cc_radius', 'iso', 'pyramid',
+               'coarse_tre_median_mm', 'coarse_wall_s', 'tre_median_mm', 'tre_p95_mm',
+               'wall_s', 'total_wall_s', 'passes_gate', 'gate_issues']
+    with open(out_dir / "sweep_results.csv", 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=columns, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(ranked)
+    with open(out_dir / "sweep_results.json", 'w') as f:
+        json.dump(ranked, f, indent=2)
+
+def main():
+    print("\n" + "="*70)
+    print("Phase 1: Registration Hyperparameter Sweep (70 -> 50)")
+    print("="*70 + "\n")
+
+    from compute_phase70_qc import TRE_MEDIAN_MAX_MM, TRE_P95_MAX_MM, load_popi_landmarks
+
+    data_dir = Path("data/preprocessed/popi_ants")
+    out_dir = Path("results/sweep/70_to_50")
+
+    inputs = {
+        'fix_path': data_dir / "phase50.nii.gz",
+        'mov_path': data_dir / "phase70.nii.gz",
+        'fix_mask_path': data_dir / "phase50_lung_mask.nii.gz",
+        'mov_mask_path': data_dir / "phase70_lung_mask.nii.gz",
+    }
+    configs = grid_configs(DEFAULT_SPACE)
+
+    t0 = time.time()
+    ranked = run_sweep(
+        configs, inputs,
+        fixed_landmarks=load_popi_landmarks("50"),
+        moving_landmarks=load_popi_landmarks("70"),
+        out_dir=out_dir,
+        prep={'margin_mm': (15, 15, 15), 'mask_dilation': 3}
+    )
+
+    print("\n" + "="*70)
+    print(f"Sweep finished in {(time.time() - t0)/60:.1f} min")
+    print("="*70)
+    print(f"  {'rank':>4s} {'cfg':>6s} {'status':8s} {'grad':>6s} {'cc':>3s} {'iso':>5s} {'pyramid':8s} "
+          f"{'TRE':>6s} {'P95':>6s} {'wall':>7s} {'total':>7s}")
+    for r in ranked:
+        done = r['status'] == 'done'
+        tre = f"{r['tre_median_mm']:.2f}" if done else "-"
+        p95 = f"{r['tre_p95_mm']:.2f}" if done else "-"
+        wall = f"{r['wall_s']:.0f}s" if done else "-"
+        total = f"{r['total_wall_s']:.0f}s" if 'total_wall_s' in r else "-"
+        print(f"  {r['rank']:4d} cfg{r['id']:03d} {r['status']:8s} {r['grad_step']:6.3f} "
+              f"{r['cc_radius']:3d} {r['iso']:5.2f} {r['pyramid']:8s} {tre:>6s} {p95:>6s} {wall:>7s} {total:>7s}")
+
+    gate = f"TRE median <= {TRE_MEDIAN_MAX_MM} mm, P95 <= {TRE_P95_MAX_MM} mm"
+    passing = [r for r in ranked if r.get('passes_gate')]
+    if passing:
+        fastest = min(passing, key=lambda r: r['total_wall_s'])
+        print(f"\nFastest config passing {gate}: cfg{fastest['id']:03d} "
+              f"({fastest['total_wall_s']:.0f} s incl. coarse run, TRE {fastest['tre_median_mm']:.2f} mm)")
+    else:
+        print(f"\nNo configuration passed {gate}")
+    print(f"Results: {out_dir / 'sweep_results.csv'}")
+
+    return ranked
+
+if __name__ == "__main__":
+    main()
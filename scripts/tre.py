@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""
+Target registration error (TRE) for batches of DVFs and landmark sets
+
+Landmarks are mapped to continuous grid indices in one pass with the full
+direction matrix (dvf_ops.physical_to_index), and the displacement at every
+landmark is interpolated by a single vectorized dvf_ops.sample_trilinear
+call. All landmark sets scored against a DVF are stacked into that one call.
+
+Convention (as compute_tre_ants has always used): the DVF is sampled at the
+moving landmarks, and the error is |moving + u(moving) - fixed|.
+
+Landmarks outside the DVF grid have no defined displacement. Their error is
+NaN, they are excluded from the summary statistics, and the summary reports
+how many there were.
+"""
+
+import json
+from pathlib import Path
+
+import numpy as np
+
+from dvf_ops import load_field, physical_to_index, index_to_physical, sample_trilinear
+
+def load_pts_landmarks(path):
+    """
+    Landmarks from a POPI-style .pts file ("x y z" in mm per line, # comments).
+
+    Returns:
+        (N, 3) float64 physical coordinates
+    """
+    landmarks = []
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                coords = line.split()
+                if len(coords) >= 3:
+                    landmarks.append([float(c) for c in coords[:3]])
+    return np.array(landmarks, dtype=np.float64).reshape(-1, 3)
+
+def load_dirlab_landmarks(path, geom):
+    """
+    Landmarks from a DIR-Lab *_xyz.txt file (1-based voxel indices "x y z",
+    300 points per phase for the extreme-phase sets).
+
+    Args:
+        geom: geometry of the image the indices refer to
+
+    Returns:
+        (N, 3) float64 physical coordinates
+    """
+    idx = np.loadtxt(path, dtype=np.float64, ndmin=2)[:, :3]
+    return index_to_physical(idx - 1.0, geom)
+
+def warp_landmarks(field, points):
+    """
+    Displace points by a field.
+
+    Args:
+        field: dvf_ops field dict
+        points: (N, 3) physical coordinates
+
+    Returns:
+        (warped (N, 3) float64 with NaN rows out of bounds, inside (N,) bool)
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+    disp, inside = sample_trilinear(field, physical_to_index(points, field['geom']), fill=np.nan)
+    return points + disp, inside
+
+def tre_summary(errors):
+    """TRE statistics over the in-bounds landmarks (compute_tre_ants keys)."""
+    errors = np.asarray(errors, dtype=np.float64)
+    valid = errors[np.isfinite(errors)]
+    n_oob = int(errors.size - valid.size)
+    if valid.size == 0:
+        nan = float('nan')
+        return {'median_mm': nan, 'p95_mm': nan, 'max_mm': nan, 'mean_mm': nan,
+                'n_landmarks': 0, 'n_out_of_bounds': n_oob}
+    return {
+        'median_mm': float(np.median(valid)),
+        'p95_mm': float(np.percentile(valid, 95)),
+        'max_mm': float(valid.max()),
+        'mean_mm': float(valid.mean()),
+        'n_landmarks': int(valid.size),
+        'n_out_of_bounds': n_oob
+    }
+
+def field_tre(field, landmark_sets):
+    """
+    TRE of one field against several landmark sets with one interpolation call.
+
+    Args:
+        field: dvf_ops field dict
+        landmark_sets: dict name -> (fixed (N,3), moving (N,3)) in mm
+
+    Returns:
+        dict name -> summary (tre_summary keys) plus 'errors_mm' (N,) with NaN
+        for out-of-bounds landmarks
+    """
+    names = list(landmark_sets)
+    fixed = [np.asarray(landmark_sets[n][0], dtype=np.float64).reshape(-1, 3) for n in names]
+    moving = [np.asarray(landmark_sets[n][1], dtype=np.float64).reshape(-1, 3) for n in names]
+    for n, f, m in zip(names, fixed, moving):
+        if f.shape != m.shape:
+            raise ValueError(f"Landmark set {n}: {len(f)} fixed vs {len(m)} moving points")
+
+    if not names:
+        return {}
+    warped, _ = warp_landmarks(field, np.concatenate(moving))
+    errors = np.linalg.norm(warped - np.concatenate(fixed), axis=1)
+
+    out, i0 = {}, 0
+    for n, f in zip(names, fixed):
+        e = errors[i0:i0 + len(f)]
+        out[n] = dict(tre_summary(e), errors_mm=e)
+        i0 += len(f)
+    return out
+
+def batch_tre(dvfs, landmark_sets):
+    """
+    TRE of many DVFs against many landmark sets.
+
+    Args:
+        dvfs: dict name -> DVF path or field dict (or a list of paths)
+        landmark_sets: dict name -> (fixed, moving) in mm
+
+    Returns:
+        dict dvf name -> field_tre result
+    """
+    if not isinstance(dvfs, dict):
+        dvfs = {Path(p).name: p for p in dvfs}
+    return {name: field_tre(dvf if isinstance(dvf, dict) else load_field(dvf), landmark_sets)
+            for name, dvf in dvfs.items()}
+
+def main():
+    print("="*70)
+    print("Batch TRE: POPI DVFs vs Landmarks")
+    print("="*70)
+
+    lm_dir = Path("data/raw/popi_4dct")
+    dvf_dir = Path("results/popi_ants_roi")
+    out_path = dvf_dir / "tre_batch.json"
+
+    print("\n1. Loading landmarks...")
+    lm_50 = load_pts_landmarks(lm_dir / "50-Landmarks.pts")
+    print(f"   Fixed (50): {len(lm_50)} landmarks")
+
+    results = {}
+    print("\n2. Scoring DVFs...")
+    for phase in ["70", "30", "00"]:
+        dvf_path = dvf_dir / f"dvf_{phase}_to_50_FINAL.nii.gz"
+        lm_path = lm_dir / f"{phase}-Landmarks.pts"
+        if not dvf_path.exists() or not lm_path.exists():
+            print(f"   {phase} -> 50: missing DVF or landmarks, skipped")
+            continue
+        res = field_tre(load_field(dvf_path), {'popi': (lm_50, load_pts_landmarks(lm_path))})['popi']
+        print(f"   {phase} -> 50: median {res['median_mm']:.2f} mm, P95 {res['p95_mm']:.2f} mm, "
+              f"max {res['max_mm']:.2f} mm, out of bounds {res['n_out_of_bounds']}")
+        res['errors_mm'] = [None if not np.isfinite(e) else round(float(e), 4) for e in res['errors_mm']]
+        results[f"{phase}_to_50"] = res
+
+    with open(out_path, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    print("\n" + "="*70)
+    print(f"Results saved to: {out_path}")
+    print("="*70)
+
+if __name__ == "__main__":
+    main()
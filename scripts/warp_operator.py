@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+"""
+Phase 2: Sparse Resampling Operators for Repeated Warps
+Turns a DVF into a stored CSR matrix A (|ROI| x N_moving) so that warping a
+volume on the moving grid is a single sparse mat-vec: y_roi = A @ vec(moving).
+
+Each row holds the 8 trilinear weights (linear) or a single 1 (nearest) of
+one ROI voxel of the DVF grid. Operators are saved as raw .npy arrays and
+loaded with mmap, so many processes can share one copy from the page cache.
+
+Layout: <op_dir>/{data,indices,indptr,rows}.npy, meta.json
+"""
+
+import json
+from pathlib import Path
+
+import numpy as np
+import scipy.sparse as sp
+
+from dvf_ops import load_field
+from image_bridge import read_geometry, to_ants, to_numpy
+from warp_plan import build_warp_plan, roi_rows
+
+def build_warp_operator(plan, roi=None, interpolator='linear'):
+    """
+    CSR resampling operator from a warp plan.
+
+    Args:
+        plan: from warp_plan.build_warp_plan (full grid or ROI rows)
+        roi: optional (X,Y,Z) bool mask on the DVF grid restricting the rows
+             further (must lie within the plan rows)
+        interpolator: 'linear' (8 nnz/row) or 'nearestNeighbor' (1 nnz/row)
+
+    Returns:
+        (A csr_matrix float32, rows (n_rows,) flat x-fastest indices on the DVF grid)
+    """
+    n_moving = int(np.prod(plan['moving_geom']['shape']))
+    n_plan = plan['inside'].shape[0]
+    plan_rows = plan['rows'] if plan.get('rows') is not None else np.arange(n_plan)
+    if roi is None:
+        rows, sel = plan_rows, np.arange(n_plan)
+    else:
+        rows = roi_rows(roi)
+        sel = np.searchsorted(plan_rows, rows)
+        if np.any(sel >= n_plan) or not np.array_equal(plan_rows[sel], rows):
+            raise ValueError("ROI voxels outside the plan rows")
+    inside = plan['inside'][sel]
+
+    if interpolator == 'linear':
+        indices = plan['corners'][sel]
+        data = plan['weights'][sel] * inside[:, None]
+        nnz_per_row = 8
+    elif interpolator == 'nearestNeighbor':
+        indices = plan['nearest'][sel][:, None]
+        data = inside[:, None].astype(np.float32)
+        nnz_per_row = 1
+    else:
+        raise ValueError(f"Unsupported interpolator: {interpolator}")
+
+    itype = np.int32 if n_moving < 2**31 and rows.size * nnz_per_row < 2**31 else np.int64
+    indptr = np.arange(0, rows.size * nnz_per_row + 1, nnz_per_row, dtype=itype)
+    A = sp.csr_matrix(
+        (data.ravel().astype(np.float32), indices.ravel().astype(itype), indptr),
+        shape=(rows.size, n_moving)
+    )
+    return A, rows
+
+def save_warp_operator(op_dir, A, rows, out_geom, moving_geom, info=None):
+    """Write operator arrays (.npy) and geometry (meta.json)."""
+    op_dir = Path(op_dir)
+    op_dir.mkdir(parents=True, exist_ok=True)
+    np.save(op_dir / "data.npy", A.data)
+    np.save(op_dir / "indices.npy", A.indices)
+    np.save(op_dir / "indptr.npy", A.indptr)
+    np.save(op_dir / "rows.npy", rows)
+
+    def geom_json(g):
+        return {'origin': np.asarray(g['origin']).tolist(), 'spacing': np.asarray(g['spacing']).tolist(),
+                'direction': np.asarray(g['direction']).tolist(), 'shape': [int(v) for v in g['shape']]}
+
+    meta = {
+        'shape': list(A.shape),
+        'nnz': int(A.nnz),
+        'out_geom': geom_json(out_geom),
+        'moving_geom': geom_json(moving_geom),
+        'info': info or {}
+    }
+    with open(op_dir / "meta.json", 'w') as f:
+        json.dump(meta, f, indent=2)
+
+def load_warp_operator(op_dir, mmap=True):
+    """
+    Load a stored operator.
+
+    Returns:
+        dict with A (csr_matrix backed by the memory-mapped arrays), rows,
+        out_geom, moving_geom
+    """
+    op_dir = Path(op_dir)
+    with open(op_dir / "meta.json") as f:
+        meta = json.load(f)
+    mode = 'r' if mmap else None
+    arrays = {k: np.load(op_dir / f"{k}.npy", mmap_mode=mode) for k in ('data', 'indices', 'indptr', 'rows')}
+    A = sp.csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']),
+                      shape=tuple(meta['shape']), copy=False)
+
+    def geom(g):
+        return {'origin': np.array(g['origin']), 'spacing': np.array(g['spacing']),
+                'direction': np.array(g['direction']), 'shape': tuple(g['shape'])}
+
+    return {'A': A, 'rows': arrays['rows'], 'out_geom': geom(meta['out_geom']),
+            'moving_geom': geom(meta['moving_geom']), 'info': meta['info']}
+
+def apply_warp_operator(op, volumes, fill=0.0):
+    """
+    Warp volumes with a stored operator.
+
+    Args:
+        op: from load_warp_operator
+        volumes: (X,Y,Z) array / image, or a list of them, on the moving grid
+        fill: value outside the ROI rows
+
+    Returns:
+        (X,Y,Z) float32 array (or list) on the DVF grid
+    """
+    single = not isinstance(volumes, (list, tuple))
+    vols = [volumes] if single else list(volumes)
+    cols = []
+    for v in vols:
+        if isinstance(v, np.ndarray):
+            cols.append(np.ascontiguousarray(v.T).ravel())
+        else:
+            cols.append(to_numpy(v, order="zyx").ravel())
+    V = np.stack(cols, axis=1).astype(np.float32, copy=False)   # (N_moving, K)
+    Y = op['A'] @ V                                               # (|ROI|, K)
+
+    nx, ny, nz = op['out_geom']['shape']
+    outs = []
+    for k in range(V.shape[1]):
+        out = np.full(nx * ny * nz, fill, dtype=np.float32)
+        out[op['rows']] = Y[:, k]
+        outs.append(out.reshape(nz, ny, nx).T)
+    return outs[0] if single else outs
+
+def export_warp_operator(dvf_path, moving_ref_path, op_dir, roi=None, interpolator='linear', field=None):
+    """
+    Build and store the operator of a DVF for volumes on moving_ref_path's grid.
+
+    Args:
+        roi: optional (X,Y,Z) bool mask on the DVF grid; the plan is built
+             for the ROI voxels only
+        field: the DVF already loaded by the caller (default: read dvf_path)
+    """
+    field = field if field is not None else load_field(dvf_path)
+    rows = roi_rows(roi) if roi is not None else None
+    plan = build_warp_plan(field, read_geometry(moving_ref_path), rows=rows)
+    A, rows = build_warp_operator(plan, interpolator=interpolator)
+    save_warp_operator(op_dir, A, rows, plan['out_geom'], plan['moving_geom'],
+                       info={'dvf': str(dvf_path), 'moving_ref': str(moving_ref_path),
+                             'interpolator': interpolator})
+    return A, rows
+
+def main():
+    import ants
+    from compute_final_qc_metrics import resample_mask_to_field
+
+    print("="*70)
+    print("Phase 2: Sparse Resampling Operators")
+    print("="*70)
+
+    data_dir = Path("data/preprocessed/popi_ants")
+    dvf_dir = Path("results/popi_ants_roi")
+    out_dir = Path("results/warp_operators")
+    mask_path = data_dir / "phase50_lung_mask.nii.gz"
+
+    for ph in ["70", "30", "00"]:
+        dvf_path = dvf_dir / f"dvf_{ph}_to_50_FINAL.nii.gz"
+        moving = data_dir / f"phase{ph}.nii.gz"
+        op_dir = out_dir / f"op_{ph}_to_50_lung"
+        print(f"\n[{ph}->50] {dvf_path.name}")
+
+        field = load_field(dvf_path)
+        roi = resample_mask_to_field(mask_path, field)
+        A, rows = export_warp_operator(dvf_path, moving, op_dir, roi=roi, field=field)
+        size_mb = (A.data.nbytes + A.indices.nbytes + A.indptr.nbytes) / 1e6
+        print(f"  Operator: {A.shape[0]} ROI rows x {A.shape[1]} moving voxels, "
+              f"nnz={A.nnz} ({size_mb:.0f} MB)")
+
+        # Check: operator warp of the moving image
+        op = load_warp_operator(op_dir)
+        warped = apply_warp_operator(op, ants.image_read(str(moving)))
+        ants.image_write(to_ants(warped, like=op['out_geom']),
+                         str(op_dir / f"phase{ph}_in_50_lung.nii.gz"))
+        print(f"  Saved: {op_dir}")
+
+    print("\n" + "="*70)
+    print(f"Operators saved under: {out_dir}")
+    print("="*70)
+
+if __name__ == "__main__":
+    main()
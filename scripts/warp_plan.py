@@ -0,0 +1,154 @@
+"""
+Batched warping through a DVF with a reusable interpolation plan
+
+A plan stores, for every voxel of the DVF grid, where x + u(x) falls in the
+moving image grid: the 8 trilinear corner indices and weights, and the
+nearest-neighbour index. A plan can also be built for a subset of DVF voxels
+(rows, e.g. a lung ROI), so its size and build time scale with the ROI
+rather than the grid. Building it costs one pass over the DVF; applying it
+to any number of volumes on the same moving grid is a gather + weighted sum
+with no further coordinate math. Results match ants.apply_transforms with
+the DVF as the only transform (default value 0 outside the moving image).
+"""
+
+import numpy as np
+
+from dvf_ops import index_to_physical, physical_to_index, run_slabs
+from image_bridge import geometry, to_ants, to_numpy
+
+def roi_rows(roi):
+    """Flat x-fastest DVF-grid indices of an (X,Y,Z) bool ROI (plan row order)."""
+    return np.flatnonzero(np.ascontiguousarray(np.asarray(roi, dtype=bool).T).ravel())
+
+def build_warp_plan(field, moving_geom, rows=None, slab=16, n_threads=None):
+    """
+    Precompute sample positions and weights for warping moving-grid volumes
+    into the DVF grid.
+
+    Args:
+        field: DVF field dict (dvf_ops.load_field)
+        moving_geom: geometry (or image) of the volumes to be warped
+        rows: optional sorted flat x-fastest DVF-grid indices (roi_rows) to
+              plan for; default all voxels
+
+    Returns:
+        plan dict: corners (n,8) int32/int64 flat indices, weights (n,8)
+        float32, nearest (n,) flat indices, inside (n,) bool, rows (None for
+        the full grid), out_geom, moving_geom
+    """
+    out_geom = field['geom']
+    moving_geom = dict(geometry(moving_geom))
+    mshape = np.array(moving_geom['shape'])
+    nx, ny, nz = out_geom['shape']
+    if rows is not None:
+        rows = np.asarray(rows, dtype=np.int64)
+        if rows.size and (np.any(np.diff(rows) <= 0) or rows[0] < 0 or rows[-1] >= nx * ny * nz):
+            raise ValueError("Plan rows must be sorted, unique indices on the DVF grid")
+    n = nx * ny * nz if rows is None else rows.size
+    n_moving = int(np.prod(mshape))
+    itype = np.int32 if n_moving < 2**31 else np.int64
+
+    corners = np.empty((n, 8), dtype=itype)
+    weights = np.empty((n, 8), dtype=np.float32)
+    nearest = np.empty(n, dtype=itype)
+    inside = np.empty(n, dtype=bool)
+    disp = field['flat']
+    strides = np.array([1, mshape[0], mshape[0] * mshape[1]], dtype=np.int64)
+
+    def plan_slab(z0, z1):
+        # Plan entries r0:r1 are the planned voxels in slices z0:z1
+        if rows is None:
+            vox = np.arange(z0 * nx * ny, z1 * nx * ny)
+            r0, r1 = vox[0], vox[-1] + 1
+        else:
+            r0, r1 = np.searchsorted(rows, [z0 * nx * ny, z1 * nx * ny])
+            vox = rows[r0:r1]
+            if vox.size == 0:
+                return
+        z, rem = np.divmod(vox, nx * ny)
+        y, x = np.divmod(rem, nx)
+        p = index_to_physical(np.stack([x, y, z], axis=1).astype(np.float64), out_geom) + disp[vox]
+        cidx = physical_to_index(p, moving_geom)
+        inside[r0:r1] = np.all((cidx >= -0.5) & (cidx <= mshape - 0.5), axis=1)
+
+        i0 = np.floor(cidx)
+        frac = cidx - i0
+        i0 = i0.astype(np.int64)
+        lo = np.clip(i0, 0, mshape - 1)
+        hi = np.clip(i0 + 1, 0, mshape - 1)
+        k = 0
+        for cx in (0, 1):
+            for cy in (0, 1):
+                for cz in (0, 1):
+                    ix = np.where([cx, cy, cz], hi, lo)
+                    w = np.where([cx, cy, cz], frac, 1.0 - frac).prod(axis=1)
+                    corners[r0:r1, k] = ix @ strides
+                    weights[r0:r1, k] = w
+                    k += 1
+        near = np.clip(np.floor(cidx + 0.5).astype(np.int64), 0, mshape - 1)
+        nearest[r0:r1] = near @ strides
+
+    run_slabs(plan_slab, nz, slab=slab, n_threads=n_threads)
+    return {
+        'corners': corners, 'weights': weights, 'nearest': nearest, 'inside': inside,
+        'rows': rows, 'out_geom': out_geom, 'moving_geom': moving_geom
+    }
+
+def _flat_volume(vol):
+    """(N,) view of a moving volume in x-fastest order (no copy for ANTs/SimpleITK images)."""
+    if isinstance(vol, np.ndarray):
+        return np.ascontiguousarray(vol.T).ravel()  # (X,Y,Z) -> (Z,Y,X)
+    return to_numpy(vol, order="zyx").ravel()
+
+def apply_warp_plan(plan, volumes, interpolator='linear', fill=0.0, chunk=1 << 20, n_threads=None):
+    """
+    Warp scalar volumes with a plan in one vectorized pass.
+
+    Args:
+        plan: from build_warp_plan
+        volumes: list of (X,Y,Z) arrays or ANTs/SimpleITK images on the moving grid
+        interpolator: 'linear' or 'nearestNeighbor'
+        fill: value outside the moving image
+
+    Returns:
+        list of (X,Y,Z) float32 arrays on the DVF grid (fill outside the
+        plan rows)
+    """
+    if interpolator not in ('linear', 'nearestNeighbor'):
+        raise ValueError(f"Unsupported interpolator: {interpolator}")
+    mshape = tuple(plan['moving_geom']['shape'])
+    for v in volumes:
+        vshape = v.shape if isinstance(v, np.ndarray) else tuple(geometry(v)['shape'])
+        if tuple(vshape) != mshape:
+            raise ValueError(f"Volume shape {vshape} does not match plan moving grid {mshape}")
+
+    # (N_moving, K): one gather serves all volumes
+    stack = np.stack([_flat_volume(v) for v in volumes], axis=1).astype(np.float32, copy=False)
+    n = plan['inside'].shape[0]
+    out = np.empty((n, len(volumes)), dtype=np.float32)
+
+    def warp_rows(r0, r1):
+        if interpolator == 'linear':
+            idx = plan['corners'][r0:r1]
+            w = plan['weights'][r0:r1]
+            acc = np.zeros((r1 - r0, stack.shape[1]), dtype=np.float32)
+            for k in range(8):
+                acc += stack[idx[:, k]] * w[:, k:k+1]
+        else:
+            acc = stack[plan['nearest'][r0:r1]]
+        acc[~plan['inside'][r0:r1]] = fill
+        out[r0:r1] = acc
+
+    run_slabs(warp_rows, n, slab=chunk, n_threads=n_threads)
+
+    nx, ny, nz = plan['out_geom']['shape']
+    if plan.get('rows') is not None:
+        full = np.full((nx * ny * nz, len(volumes)), fill, dtype=np.float32)
+        full[plan['rows']] = out
+        out = full
+    return [out[:, k].reshape(nz, ny, nx).T for k in range(len(volumes))]
+
+def warped_images(plan, volumes, interpolator='linear', fill=0.0):
+    """apply_warp_plan, returned as ANTs images on the DVF grid."""
+    return [to_ants(np.ascontiguousarray(a), like=plan['out_geom'])
+            for a in apply_warp_plan(plan, volumes, interpolator=interpolator, fill=fill)]
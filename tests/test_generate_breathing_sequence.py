@@ -0,0 +1,22 @@
+import numpy as np
+
+from generate_breathing_sequence import synthesize_frames
+
+def _model(K=2, shape=(6, 5, 4)):
+    rng = np.random.default_rng(0)
+    idx = np.arange(0, int(np.prod(shape)), 2)
+    U, _ = np.linalg.qr(rng.standard_normal((3 * idx.size, K)))
+    return {
+        'mu': np.zeros(3 * idx.size, dtype=np.float32), 'U': U.astype(np.float32),
+        'scale': np.full(K, 10.0, dtype=np.float32), 'idx': idx, 'vol_shape': shape,
+        'geom': {'shape': shape, 'origin': np.zeros(3), 'spacing': np.full(3, 2.0),
+                 'direction': np.eye(3)}
+    }
+
+def test_reuse_disabled():
+    frames = list(synthesize_frames(_model(), np.zeros((3, 2)), reuse_mm=0))
+    assert [reused for *_, reused in frames] == [False, False, False]
+
+def test_identical_betas_reuse():
+    frames = list(synthesize_frames(_model(), np.zeros((3, 2))))
+    assert [reused for *_, reused in frames] == [False, True, True]
@@ -0,0 +1,29 @@
+import ants
+import numpy as np
+import pytest
+
+import mask_cache
+
+def _write_mask(path):
+    arr = np.zeros((20, 18, 16), dtype=np.float32)
+    arr[6:14, 5:11, 4:10] = 1
+    img = ants.from_numpy(arr, origin=(-10.0, 5.0, 2.5), spacing=(1.5, 1.5, 2.0))
+    ants.image_write(img, str(path))
+    return arr > 0, img
+
+@pytest.mark.parametrize("rule", mask_cache.RULES)
+def test_identical_grid_keeps_source_voxels(tmp_path, rule):
+    src, img = _write_mask(tmp_path / "mask.nii.gz")
+    mask_cache.clear_memory()
+    out = mask_cache.resampled_mask(tmp_path / "mask.nii.gz", img, rule=rule, cache_dir=tmp_path / "cache")
+    np.testing.assert_array_equal(out, src)
+    idx, shape = mask_cache.mask_indices(tmp_path / "mask.nii.gz", img, rule=rule, cache_dir=tmp_path / "cache")
+    np.testing.assert_array_equal(idx, np.flatnonzero(src.ravel()))
+
+def test_empty_mask_raises_and_is_not_cached(tmp_path):
+    img = ants.from_numpy(np.zeros((8, 8, 8), dtype=np.float32))
+    ants.image_write(img, str(tmp_path / "empty.nii.gz"))
+    mask_cache.clear_memory()
+    with pytest.raises(ValueError, match="empty"):
+        mask_cache.resampled_mask(tmp_path / "empty.nii.gz", img, rule='linear', cache_dir=tmp_path / "cache")
+    assert not list(tmp_path.glob("cache/*.npy"))